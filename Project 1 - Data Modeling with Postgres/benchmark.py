@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+from create_tables import create_database, drop_tables, create_tables
+from generate_data import generate
+import etl
+
+# per scale factor 1: 1000 songs, 500 artists, 100 users, 10 days of 1000 events
+BASE_SCALE = {'songs': 1000, 'artists': 500, 'users': 100, 'days': 10, 'events_per_day': 1000}
+
+# etl.py options of every benchmarked mode
+MODES = {'bulk': [],
+         'row-by-row': ['--row-by-row'],
+         'song-select': ['--song-select'],
+         'parallel': ['--workers', str(os.cpu_count() or 2)],
+         'bulk-load': ['--build-indexes']}
+
+# modes loading into the tables of create_tables.py --bulk-load
+BULK_LOAD_MODES = {'bulk-load'}
+
+COUNT_TABLES = ['songs', 'artists', 'users', 'time', 'songplays']
+
+
+def code_version():
+    """
+    Description: This function is used to tag the results with the commit of the code being measured.
+
+    Returns:
+        output of git describe, or 'unknown' outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def table_counts(cur):
+    counts = {}
+    for table in COUNT_TABLES:
+        cur.execute('SELECT count(*) FROM {}'.format(table))
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+
+def run_benchmark(data_dir, mode):
+    """
+    Description: This function is used to load a generated data set into a fresh sparkifydb with one mode
+    of etl.py and to measure every stage.
+
+    Arguments:
+        data_dir: directory holding song_data and log_data.
+        mode: key of MODES.
+
+    Returns:
+        dict with the wall time, the row counts, the rows per second of every stage and the etl.py metrics.
+    """
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_tables(cur, conn, bulk_load=mode in BULK_LOAD_MODES)
+
+    args = etl.parse_args(MODES[mode])
+    start = time.time()
+    summary = etl.run_etl(cur, conn, args, song_path=os.path.join(data_dir, 'song_data'),
+                          log_path=os.path.join(data_dir, 'log_data'))
+    wall = time.time() - start
+    counts = table_counts(cur)
+    conn.close()
+
+    seconds = summary['stage_seconds']
+    stage_rows = {'song_index': 0, 'song_data': counts['songs'], 'log_data': counts['songplays'],
+                  'build_indexes': counts['songplays']}
+    stages = {stage: {'seconds': round(seconds[stage], 4),
+                      'rows': stage_rows[stage],
+                      'rows_per_second': round(stage_rows[stage] / seconds[stage], 1) if seconds[stage] else None}
+              for stage in seconds}
+    return {'wall_seconds': round(wall, 4), 'stages': stages, 'table_rows': counts,
+            'failed_files': len(summary['failed_song_files']) + len(summary['failed_log_files']),
+            'metrics': summary['metrics']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark etl.py on synthetic data sets of growing size.')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10],
+                        help='scale factors applied to {}'.format(BASE_SCALE))
+    parser.add_argument('--modes', nargs='+', default=['bulk', 'row-by-row'], choices=sorted(MODES))
+    parser.add_argument('--match-fraction', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--keep-data', metavar='DIR',
+                        help='generate the data sets below DIR and keep them instead of using a temporary directory')
+    args = parser.parse_args()
+
+    version = code_version()
+    root = args.keep_data or tempfile.mkdtemp(prefix='sparkify-benchmark-')
+    try:
+        for scale in args.scales:
+            sizes = {name: max(1, int(value * scale)) for name, value in BASE_SCALE.items()}
+            data_dir = os.path.join(root, 'scale-{:g}'.format(scale))
+            if not os.path.isdir(data_dir):
+                generate(data_dir, sizes['songs'], sizes['artists'], sizes['users'], sizes['days'],
+                         sizes['events_per_day'], args.match_fraction, seed=args.seed)
+
+            for mode in args.modes:
+                result = {'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+                          'version': version,
+                          'host': platform.node(),
+                          'scale': scale,
+                          'mode': mode,
+                          'data': dict(sizes, match_fraction=args.match_fraction, seed=args.seed)}
+                result.update(run_benchmark(data_dir, mode))
+                with open(args.output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+                print('scale {:g} {}: {:.2f}s'.format(scale, mode, result['wall_seconds']))
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
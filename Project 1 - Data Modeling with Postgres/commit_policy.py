@@ -0,0 +1,66 @@
+import time
+
+
+class CommitPolicy:
+    """
+    Description: Decides when process_data commits. A commit is due as soon as one of the limits is
+    reached: a number of files, a number of rows or a number of seconds since the last commit. Limits
+    left as None are not checked, the default commits after every file like the original ETL.
+    """
+
+    def __init__(self, every_files=1, every_rows=None, every_seconds=None):
+        self.every_files = every_files
+        self.every_rows = every_rows
+        self.every_seconds = every_seconds
+        self.commits = 0
+        self.reset()
+
+    def reset(self):
+        self.files = 0
+        self.rows = 0
+        self.started = time.time()
+
+    def add(self, files, rows):
+        """
+        Description: This function is used to account for the work done since the last commit.
+
+        Arguments:
+            files: number of files loaded.
+            rows: number of records loaded.
+
+        Returns:
+            None
+        """
+        self.files += files
+        self.rows += rows or 0
+
+    def due(self):
+        """
+        Description: This function is used to check whether one of the limits is reached.
+
+        Returns:
+            True when process_data should commit now.
+        """
+        if self.files == 0:
+            return False
+        if self.every_files is not None and self.files >= self.every_files:
+            return True
+        if self.every_rows is not None and self.rows >= self.every_rows:
+            return True
+        if self.every_seconds is not None and time.time() - self.started >= self.every_seconds:
+            return True
+        return False
+
+    def commit(self, conn):
+        """
+        Description: This function is used to commit the pending work and to start counting again.
+
+        Arguments:
+            conn: connection to database.
+
+        Returns:
+            None
+        """
+        conn.commit()
+        self.commits += 1
+        self.reset()
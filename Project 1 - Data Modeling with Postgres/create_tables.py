@@ -1,6 +1,8 @@
 
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import (create_table_queries, drop_table_queries, bulk_create_table_queries, index_queries,
+                         songplay_primary_key_select, songplay_primary_key_create, analyze_tables)
 
 def create_database():
     # connect to default database
@@ -27,17 +29,49 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
-    for query in create_table_queries:
+def create_tables(cur, conn, bulk_load=False):
+    # in bulk-load mode songplays is partitioned by month and the songplays primary key and the
+    # secondary indexes are left for build_indexes, so the initial load does not maintain them row by row
+    if bulk_load:
+        queries = bulk_create_table_queries
+    else:
+        queries = create_table_queries + index_queries
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
+def build_indexes(cur, conn):
+    # the dimension tables keep their primary keys in bulk-load mode, the ON CONFLICT clauses of etl.py need them
+    cur.execute(songplay_primary_key_select)
+    if cur.fetchone()[0] == 0:
+        cur.execute(songplay_primary_key_create)
+    for query in index_queries:
+        cur.execute(query)
+    conn.commit()
+    cur.execute(analyze_tables)
+    conn.commit()
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Create sparkifydb and its tables.')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='partition songplays by month and leave the songplays primary key and the indexes '
+                             'for --build-indexes after the initial load')
+    parser.add_argument('--build-indexes', action='store_true',
+                        help='only build the primary key and indexes deferred by --bulk-load, keeping the data')
+    args = parser.parse_args()
+
+    if args.build_indexes:
+        conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+        build_indexes(conn.cursor(), conn)
+        conn.close()
+        return
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, args.bulk_load)
 
     conn.close()
 
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+
+class KeyCache:
+    """
+    Description: Bounded least recently used set of the keys of one dimensional table. A value can be kept
+    with every key, a key seen again with a different value is treated as new.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key, value=None):
+        """
+        Description: This function is used to register a key that is about to be written.
+
+        Arguments:
+            key: dimension key.
+            value: value that has to match for the key to count as already written.
+
+        Returns:
+            True when the row is new and has to be written, False when it is a duplicate.
+        """
+        if key in self._keys and self._keys[key] == value:
+            self._keys.move_to_end(key)
+            self.hits += 1
+            return False
+        self._keys[key] = value
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+        self.misses += 1
+        return True
+
+    def clear(self):
+        self._keys.clear()
+
+
+class DimensionCache:
+    """
+    Description: Keys of the users, time, songs and artists rows already written during this run. Rows
+    whose key is in the cache are dropped before they are sent to the database, where the ON CONFLICT
+    clauses would only throw them away.
+
+    Users are cached together with the columns the users upsert updates (first and last name, gender and
+    level), so a user any of them changed for is written again. Every
+    dimension keeps at most max_size keys, the least recently used ones are forgotten first and such rows
+    are simply sent to the database again. After a rollback the cache has to be cleared, it would otherwise
+    hide rows that never made it into the database.
+    """
+
+    def __init__(self, max_size=1000000):
+        self.users = KeyCache(max_size)
+        self.time = KeyCache(max_size)
+        self.songs = KeyCache(max_size)
+        self.artists = KeyCache(max_size)
+
+    def new_time(self, start_times):
+        """
+        Description: This function is used to select the time rows that still have to be written.
+
+        Arguments:
+            start_times: start_time of every row.
+
+        Returns:
+            list of booleans, True for the rows to write.
+        """
+        return [self.time.add(start_time) for start_time in start_times]
+
+    def new_users(self, user_ids, rows):
+        """
+        Description: This function is used to select the user rows that still have to be written.
+
+        Arguments:
+            user_ids: user_id of every row.
+            rows: (first_name, last_name, gender, level) of every row.
+
+        Returns:
+            list of booleans, True for the rows to write.
+        """
+        return [self.users.add(user_id, tuple(row)) for user_id, row in zip(user_ids, rows)]
+
+    def new_songs(self, song_ids):
+        """
+        Description: This function is used to select the song rows that still have to be written.
+
+        Arguments:
+            song_ids: song_id of every row.
+
+        Returns:
+            list of booleans, True for the rows to write.
+        """
+        return [self.songs.add(song_id) for song_id in song_ids]
+
+    def new_artists(self, artist_ids):
+        """
+        Description: This function is used to select the artist rows that still have to be written.
+
+        Arguments:
+            artist_ids: artist_id of every row.
+
+        Returns:
+            list of booleans, True for the rows to write.
+        """
+        return [self.artists.add(artist_id) for artist_id in artist_ids]
+
+    def clear(self):
+        for cache in (self.users, self.time, self.songs, self.artists):
+            cache.clear()
+
+    def stats(self):
+        """
+        Description: This function is used to summarize the cache for the run log.
+
+        Returns:
+            dict with the number of duplicate rows dropped per dimension.
+        """
+        return {'users': self.users.hits,
+                'time': self.time.hits,
+                'songs': self.songs.hits,
+                'artists': self.artists.hits}
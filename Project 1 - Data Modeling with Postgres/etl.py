@@ -1,13 +1,97 @@
 
 # Import necessary libraries
 
+import io
 import os
-import glob
+import json
+import time
+import argparse
+import functools
+import multiprocessing
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 from sql_queries import *
+from song_index import SongIndex
+from manifest import Manifest
+from dimension_cache import DimensionCache
+from commit_policy import CommitPolicy
+from metrics import Metrics, timed
+from partitions import SongplayPartitions
+from create_tables import build_indexes
 
-def process_song_file(cur, filepath):  
+# columns of a user row compared by the dimension cache, a change in any of them has to reach the users upsert
+USER_CACHE_COLUMNS = ['firstName', 'lastName', 'gender', 'level']
+
+def read_song_file(filepath, metrics=None):
+    """
+    Description: This function is used to read a song file (data/song_data) and to extract from it the
+    song and artist records.
+
+    Arguments:
+        filepath: song data file path.
+        metrics: optional Metrics timing the json_read and transform stages.
+
+    Returns:
+        song_data: values for song_table_insert.
+        artist_data: values for artist_table_insert.
+    """
+    # open song file, the numbers parsed exactly like json.loads does in read_song_batch
+    with timed(metrics, 'json_read', 1):
+        df = pd.read_json(filepath, lines=True, precise_float=True)
+
+    with timed(metrics, 'transform', 1):
+        # song record
+         
+        song_data=[]
+        tmp_songs=df[['song_id', 'title', 'artist_id', 'year', 'duration']].values
+        for item in tmp_songs[0]:
+            song_data.append(None if pd.isna(item) else item)
+        
+        # artist record
+        
+        artist_data=[]
+        tmp_artists=df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values
+        for item in tmp_artists[0]:
+            # a missing latitude or longitude is NULL, not NaN
+            artist_data.append(None if pd.isna(item) else item)
+
+    return song_data, artist_data
+
+def load_song_data(cur, data, song_index=None, cache=None, metrics=None):
+    """
+    Description: This function is used to insert the records returned by read_song_file into the songs
+    and artists dimensional tables.
+
+    Arguments:
+        cur: the cursor object.
+        data: (song_data, artist_data) as returned by read_song_file.
+        song_index: optional SongIndex kept up to date with the inserted songs and artists.
+        cache: optional DimensionCache, songs and artists already written in this run are skipped.
+        metrics: optional Metrics timing the inserts and counting the upsert conflicts.
+
+    Returns:
+        Number of song records loaded.
+    """
+    song_data, artist_data = data
+
+    if cache is None or cache.songs.add(song_data[0]):
+        with timed(metrics, 'insert_songs', 1):
+            cur.execute(song_table_insert, song_data)
+        count_conflicts(metrics, 'songs', 1, cur.rowcount)
+    
+    if cache is None or cache.artists.add(artist_data[0]):
+        with timed(metrics, 'insert_artists', 1):
+            cur.execute(artist_table_insert, artist_data)
+        count_conflicts(metrics, 'artists', 1, cur.rowcount)
+
+    if song_index is not None:
+        song_index.add_artist(artist_data[0], artist_data[1])
+        song_index.add_song(song_data[0], song_data[1], song_data[2], song_data[4])
+
+    return 1
+
+def process_song_file(cur, filepath, song_index=None):  
     """
     Description: This function is used to read the files in the filepath (data/song_data) in order
     to get the user and time info and with them populate the songs and artists dimensional tables.
@@ -15,46 +99,149 @@ def process_song_file(cur, filepath):
     Arguments:
         cur: the cursor object. 
         filepath: log data file path. 
+        song_index: optional SongIndex kept up to date with the inserted songs and artists.
     
     Returns:
         None
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    return load_song_data(cur, read_song_file(filepath), song_index)
 
-    # insert song record
-     
-    song_data=[]
-    tmp_songs=df[['song_id', 'title', 'artist_id', 'year', 'duration']].values
-    for item in tmp_songs[0]:
-        song_data.append(item)
-    
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    
-    artist_data=[]
-    tmp_artists=df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values
-    for item in tmp_artists[0]:
-        artist_data.append(item)
-    
-    cur.execute(artist_table_insert, artist_data)
+SONG_COLUMNS = ['song_id', 'title', 'artist_id', 'year', 'duration']
+ARTIST_COLUMNS = ['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']
 
-def process_log_file(cur, filepath):
+def count_conflicts(metrics, table, sent, inserted):
     """
-    Description: This function is used to read the files in the filepath (data/log_data) in order
-    to get the user and time info and with them used to populate the users and time dimensional tables.
-    
+    Description: This function is used to count the rows thrown away by an ON CONFLICT DO NOTHING insert.
+
     Arguments:
-        cur: the cursor object. 
-        filepath: log data file path. 
-    
+        metrics: Metrics or None.
+        table: name of the table.
+        sent: number of rows sent.
+        inserted: rowcount of the insert.
+
     Returns:
         None
     """
-    # open log file
-    df = pd.read_json(filepath,lines=True)
+    if metrics is not None and inserted >= 0:
+        metrics.count('upsert_conflicts_' + table, sent - inserted)
+
+def count_lookups(metrics, song_ids):
+    """
+    Description: This function is used to count the events that were matched or not to a song.
+
+    Arguments:
+        metrics: Metrics or None.
+        song_ids: song_id found for every event, None when there was no match.
+
+    Returns:
+        None
+    """
+    if metrics is not None:
+        hits = sum(1 for song_id in song_ids if song_id is not None)
+        metrics.count('song_lookup_hits', hits)
+        metrics.count('song_lookup_misses', len(song_ids) - hits)
+
+def read_song_batch(filepaths, metrics=None):
+    """
+    Description: This function is used to read many song files at once. Every line is decoded with the
+    json module, without the cost of building a pandas data frame per file, and the records are collected
+    column by column.
+
+    Arguments:
+        filepaths: song data file paths.
+        metrics: optional Metrics timing the json_read stage.
+
+    Returns:
+        dict with a list of values per column of SONG_COLUMNS and ARTIST_COLUMNS.
+    """
+    batch = {column: [] for column in SONG_COLUMNS + ARTIST_COLUMNS}
+    with timed(metrics, 'json_read', len(filepaths)):
+        for filepath in filepaths:
+            with open(filepath, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    for column, values in batch.items():
+                        values.append(record.get(column))
+    return batch
+
+def load_song_batch(cur, batch, song_index=None, cache=None, metrics=None):
+    """
+    Description: This function is used to insert a batch returned by read_song_batch into the songs and
+    artists dimensional tables with one multi-row INSERT per table.
+
+    Arguments:
+        cur: the cursor object.
+        batch: columns returned by read_song_batch.
+        song_index: optional SongIndex kept up to date with the inserted songs and artists.
+        cache: optional DimensionCache, songs and artists already written in this run are skipped.
+        metrics: optional Metrics timing the inserts and counting the upsert conflicts.
+
+    Returns:
+        Number of song records loaded.
+    """
+    songs = list(zip(*[batch[column] for column in SONG_COLUMNS]))
+    artists = list(zip(*[batch[column] for column in ARTIST_COLUMNS]))
+    if not songs:
+        return 0
+
+    new_songs, new_artists = songs, artists
+    if cache is not None:
+        new_songs = [song for song, new in zip(songs, cache.new_songs(batch['song_id'])) if new]
+        new_artists = [artist for artist, new in zip(artists, cache.new_artists(batch['artist_id'])) if new]
 
+    if new_songs:
+        with timed(metrics, 'insert_songs', len(new_songs)):
+            psycopg2.extras.execute_values(cur, song_table_batch_insert, new_songs, page_size=len(new_songs))
+        count_conflicts(metrics, 'songs', len(new_songs), cur.rowcount)
+    if new_artists:
+        with timed(metrics, 'insert_artists', len(new_artists)):
+            psycopg2.extras.execute_values(cur, artist_table_batch_insert, new_artists, page_size=len(new_artists))
+        count_conflicts(metrics, 'artists', len(new_artists), cur.rowcount)
+
+    if song_index is not None:
+        for song, artist in zip(songs, artists):
+            song_index.add_artist(artist[0], artist[1])
+            song_index.add_song(song[0], song[1], song[2], song[4])
+
+    return len(songs)
+
+def read_log_file(filepath, metrics=None):
+    """
+    Description: This function is used to read a log file (data/log_data) and to build from it the data frames
+    needed to populate the time and users dimensional tables as well as the songplays fact table.
+
+    Arguments:
+        filepath: log data file path.
+        metrics: optional Metrics timing the json_read and transform stages.
+
+    Returns:
+        df: NextSong events of the file.
+        time_df: time records of the events.
+        user_df: user records of the events.
+    """
+    # open log file. precise_float parses the length of an event to the same float as the duration of its
+    # song, else 438.43947 becomes 438.43947000000003 and the play is not matched
+    with timed(metrics, 'json_read', 1):
+        df = pd.read_json(filepath,lines=True, precise_float=True)
+
+    with timed(metrics, 'transform', 1):
+        df, time_df, user_df = transform_log_data(df)
+
+    return df, time_df, user_df
+
+def transform_log_data(df):
+    """
+    Description: This function is used to build the songplays, time and users data frames of read_log_file
+    from the events of a log file.
+
+    Arguments:
+        df: all the events of a log file.
+
+    Returns:
+        df, time_df, user_df: see read_log_file.
+    """
     # filter by NextSong action and assigns back to the same data frame. The main dataframe gets overwritten
     df = df[df['page']=='NextSong']
 
@@ -76,63 +263,672 @@ def process_log_file(cur, filepath):
     
     # We create a new data frame based on time_data and the defined column_labels
     time_df=pd.DataFrame(time_data, columns=columns_labels)
-    
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
         
     # load user table
     user_df = pd.DataFrame(df, columns=['userId','firstName', 'lastName', 'gender', 'level'])
 
+    return df, time_df, user_df
+
+def load_log_data(cur, data, song_index=None, cache=None, metrics=None, partitions=None):
+    """
+    Description: This function is used to insert the data frames returned by read_log_file into the time
+    and users dimensional tables and the songplays fact table, one statement per record.
+
+    Arguments:
+        cur: the cursor object.
+        data: (df, time_df, user_df) as returned by read_log_file.
+        song_index: optional SongIndex used instead of the song_select query.
+        cache: optional DimensionCache, time and user rows already written in this run are skipped.
+        metrics: optional Metrics timing the lookups and the inserts and counting hits and conflicts.
+        partitions: SongplayPartitions when songplays is partitioned by month.
+
+    Returns:
+        Number of songplay records loaded.
+    """
+    df, time_df, user_df = data
+
+    if partitions is not None:
+        partitions.ensure(cur, time_df['timestamp'])
+
+    if cache is not None:
+        time_df = time_df.loc[cache.new_time(time_df['timestamp'])]
+        user_rows = user_df[USER_CACHE_COLUMNS].itertuples(index=False)
+        user_df = user_df.loc[cache.new_users(user_df['userId'], user_rows)]
+    
+    inserted = 0
+    with timed(metrics, 'insert_time', len(time_df)):
+        for i, row in time_df.iterrows():
+            cur.execute(time_table_insert, list(row))
+            inserted += cur.rowcount
+    count_conflicts(metrics, 'time', len(time_df), inserted)
+
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    with timed(metrics, 'insert_users', len(user_df)):
+        for i, row in user_df.iterrows():
+            cur.execute(user_table_insert, row)
 
     # insert songplay records
+    lookup_seconds = 0.0
+    insert_start = time.perf_counter()
+    song_ids = []
     for index, row in df.iterrows():
         
         # get songid and artistid from song and artist tables based on the match of song, artist and length
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
+        lookup_start = time.perf_counter()
+        if song_index is not None:
+            songid, artistid = song_index.lookup(row.song, row.artist, row.length)
         else:
-            songid, artistid = None, None
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+            
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
+        lookup_seconds += time.perf_counter() - lookup_start
+        song_ids.append(songid)
 
         # insert songplay record
         songplay_data = (pd.to_datetime(row.ts, unit='ms'), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
         cur.execute(songplay_table_insert, songplay_data)
 
-def process_data(cur, conn, filepath, func):    
+    if metrics is not None:
+        metrics.record('song_lookup', lookup_seconds, len(df), calls=len(df))
+        metrics.record('insert_songplays', time.perf_counter() - insert_start - lookup_seconds, len(df))
+    count_lookups(metrics, song_ids)
+
+    return len(df)
+
+def process_log_file(cur, filepath, song_index=None):
+    """
+    Description: This function is used to read the files in the filepath (data/log_data) in order
+    to get the user and time info and with them used to populate the users and time dimensional tables.
+    Every record is sent to the database with its own statement, see process_log_file_bulk for the
+    COPY based alternative.
+    
+    Arguments:
+        cur: the cursor object. 
+        filepath: log data file path. 
+        song_index: optional SongIndex used instead of the song_select query.
+    
+    Returns:
+        None
+    """
+    return load_log_data(cur, read_log_file(filepath), song_index)
+
+def copy_dataframe(cur, df, table, columns):
+    """
+    Description: This function is used to stream a data frame into a table with a single COPY ... FROM STDIN.
+    
+    Arguments:
+        cur: the cursor object.
+        df: data frame whose columns are in the same order as columns.
+        table: name of the destination table.
+        columns: column names of the destination table.
+    
+    Returns:
+        None
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False, na_rep='\\N')
+    buf.seek(0)
+    cur.copy_expert(staging_copy.format(table, ', '.join(columns)), buf)
+
+def prepare_log_batch(filepath, metrics=None):
+    """
+    Description: This function is used to read a log file and to turn it into the data frames streamed
+    with COPY into the time_staging, user_staging and songplay_staging tables.
+
+    Arguments:
+        filepath: log data file path.
+        metrics: optional Metrics timing the json_read, transform and stage_frames stages.
+
+    Returns:
+        time_df, user_df, songplay_df: data frames with the columns of the staging tables.
+    """
+    df, time_df, user_df = read_log_file(filepath, metrics)
+    # a stage of its own, transform counts one call per file on both log paths
+    with timed(metrics, 'stage_frames', 1):
+        return staging_frames(df, time_df, user_df)
+
+def staging_frames(df, time_df, user_df):
+    """
+    Description: This function is used to turn the data frames of read_log_file into the ones of the
+    staging tables, see prepare_log_batch.
+    """
+    df = df.reset_index(drop=True)
+    user_df = user_df.reset_index(drop=True)
+    user_df.insert(0, 'seq', user_df.index)
+
+    songplay_df = pd.DataFrame({'seq': df.index,
+                                'start_time': pd.to_datetime(df['ts'], unit='ms'),
+                                'user_id': df['userId'],
+                                'level': df['level'],
+                                'song': df['song'],
+                                'artist': df['artist'],
+                                'length': df['length'],
+                                'song_id': None,
+                                'artist_id': None,
+                                'session_id': df['sessionId'],
+                                'location': df['location'],
+                                'user_agent': df['userAgent']})
+
+    return time_df, user_df, songplay_df
+
+def load_log_batch(cur, data, song_index=None, cache=None, metrics=None, partitions=None):
+    """
+    Description: This function is used to stream the data frames returned by prepare_log_batch into the
+    staging tables with COPY and to move them into the time, users and songplays tables with one
+    set-based INSERT ... SELECT each.
+
+    Arguments:
+        cur: the cursor object.
+        data: (time_df, user_df, songplay_df) as returned by prepare_log_batch.
+        song_index: optional SongIndex that resolves song_id and artist_id before the COPY, otherwise
+            they are looked up by the songplays INSERT ... SELECT.
+        cache: optional DimensionCache, time and user rows already written in this run are not copied.
+        metrics: optional Metrics timing the COPYs, the lookups and the inserts and counting hits and conflicts.
+        partitions: SongplayPartitions when songplays is partitioned by month.
+
+    Returns:
+        Number of songplay records loaded.
+    """
+    time_df, user_df, songplay_df = data
+
+    if partitions is not None:
+        partitions.ensure(cur, songplay_df['start_time'])
+
+    if cache is not None:
+        time_df = time_df.loc[cache.new_time(time_df['timestamp'])]
+        user_rows = user_df[USER_CACHE_COLUMNS].itertuples(index=False)
+        user_df = user_df.loc[cache.new_users(user_df['userId'], user_rows)]
+
+    for query in staging_table_queries:
+        cur.execute(query)
+    cur.execute(staging_table_truncate)
+
+    with timed(metrics, 'copy_time', len(time_df)):
+        copy_dataframe(cur, time_df, 'time_staging',
+                       ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'])
+
+    with timed(metrics, 'copy_users', len(user_df)):
+        copy_dataframe(cur, user_df, 'user_staging',
+                       ['seq', 'user_id', 'first_name', 'last_name', 'gender', 'level'])
+
+    if song_index is not None:
+        with timed(metrics, 'song_lookup', len(songplay_df)):
+            songplay_df['song_id'], songplay_df['artist_id'] = song_index.resolve(
+                songplay_df['song'], songplay_df['artist'], songplay_df['length'])
+        count_lookups(metrics, list(songplay_df['song_id']))
+    with timed(metrics, 'copy_songplays', len(songplay_df)):
+        copy_dataframe(cur, songplay_df, 'songplay_staging', list(songplay_df.columns))
+
+    with timed(metrics, 'insert_time', len(time_df)):
+        cur.execute(time_table_bulk_insert)
+    count_conflicts(metrics, 'time', len(time_df), cur.rowcount)
+    with timed(metrics, 'insert_users', len(user_df)):
+        cur.execute(user_table_bulk_insert)
+    # without the song index the lookups are part of the songplays INSERT ... SELECT
+    with timed(metrics, 'insert_songplays', len(songplay_df)):
+        if song_index is not None:
+            cur.execute(songplay_table_staged_insert)
+        else:
+            cur.execute(songplay_table_bulk_insert)
+    if song_index is None:
+        # the song_id of every inserted songplay is returned to count the lookup hits
+        count_lookups(metrics, [row[0] for row in cur.fetchall()])
+
+    return len(songplay_df)
+
+def process_log_file_bulk(cur, filepath, song_index=None):
+    """
+    Description: This function does the same work as process_log_file, but the records of the file are
+    streamed with COPY into temporary staging tables and moved into the time, users and songplays tables
+    with one set-based INSERT ... SELECT each, instead of one round trip per record.
+    
+    Arguments:
+        cur: the cursor object. 
+        filepath: log data file path. 
+        song_index: optional SongIndex that resolves song_id and artist_id before the COPY, otherwise
+            they are looked up by the songplays INSERT ... SELECT.
+    
+    Returns:
+        None
+    """
+    return load_log_batch(cur, prepare_log_batch(filepath), song_index)
+
+def find_json_files(filepath):
+    """
+    Description: This function is used to collect all JSON files below a directory. It walks the tree
+    with os.scandir, which reads the file types together with the names, and returns the files in the
+    same order as os.walk would.
+
+    Arguments:
+        filepath: data directory.
+
+    Returns:
+        list of absolute file paths.
+    """
+    all_files = []
+    subdirs = []
+    with os.scandir(filepath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.endswith('.json') and not entry.name.startswith('.'):
+                all_files.append(os.path.abspath(entry.path))
+    for subdir in subdirs:
+        all_files.extend(find_json_files(subdir))
+    return all_files
+
+def read_safely(reader, datafile, collect=False):
+    """
+    Description: This function is used to run a reader in a worker process without losing the whole
+    run when one file can not be read.
+
+    Arguments:
+        reader: function turning a file path into a ready to load batch.
+        datafile: argument for reader.
+        collect: time the reader with its own Metrics and return them with the batch.
+
+    Returns:
+        (batch, None, snapshot) or (None, the exception raised by reader, snapshot), snapshot is None
+        unless collect is set.
+    """
+    metrics = Metrics() if collect else None
+    try:
+        batch = reader(datafile, metrics=metrics) if collect else reader(datafile)
+        return batch, None, metrics and metrics.snapshot()
+    except Exception as e:
+        return None, e, metrics and metrics.snapshot()
+
+def unpack_batch(result, metrics=None):
+    """
+    Description: This function is used to get the batch back from a read_safely result, raising the error
+    of the reader in the writer so the file is handled as a failed file. The measures of the reader are
+    added to metrics.
+    """
+    batch, error, snapshot = result
+    if metrics is not None and snapshot is not None:
+        metrics.merge(snapshot)
+    if error is not None:
+        raise error
+    return batch
+
+def load_in_savepoint(cur, load):
+    """
+    Description: This function is used to run the load of one file inside its own savepoint. A file that
+    fails is rolled back alone, the work of the other files in the same transaction is kept.
+
+    Arguments:
+        cur: the cursor object.
+        load: function doing the work, it returns the number of records loaded.
+
+    Returns:
+        (rows, None) or (0, the exception that rolled the file back).
+    """
+    cur.execute(file_savepoint)
+    try:
+        rows = load()
+    except Exception as e:
+        cur.execute(file_savepoint_rollback)
+        return 0, e
+    cur.execute(file_savepoint_release)
+    return rows, None
+
+def process_data(cur, conn, filepath, func=None, reader=None, loader=None, workers=1, manifest=None,
+                 commit_policy=None, on_savepoint=None, on_rollback=None, metrics=None):    
     """
     Description: This function is used to collect all JSON files and call functions defined 
     above (process_song_file, process_log_file) to process logs.
+
+    Instead of func a reader and a loader can be given (e.g. read_log_file and load_log_data). With
+    more than one worker the files are read and transformed by reader in a pool of processes while
+    loader applies the batches on this connection in the original file order, so the database ends up
+    with the same contents as in a serial run.
+
+    Every file is loaded in a savepoint. A malformed file is rolled back and reported, the others go on,
+    and the transaction is committed whenever commit_policy says so.
     
     Arguments:
         cur: the cursor object
         conn: connection to database
         filepath: log data file path 
         func: function, in which we  processed log data 
+        reader: function turning a file path into a ready to load batch.
+        loader: function applying a batch returned by reader with the cursor.
+        workers: number of reader processes, 1 reads the files in this process.
+        manifest: optional Manifest, only the files it reports as new or changed are loaded and every
+            loaded file is recorded in it in the same transaction as its data.
+        commit_policy: CommitPolicy, by default the transaction is committed after every file.
+        on_savepoint: optional function called before every file is loaded, e.g. to mark the state of the
+            SongIndex that on_rollback restores.
+        on_rollback: optional function called after a file was rolled back, e.g. to clear caches.
+        metrics: optional Metrics, given to reader and timing the discovery and the commits. Every file
+            is written as a JSON line.
     
     Returns:
-        None
+        list of the files that failed.
     """  
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    with timed(metrics, 'discovery'):
+        # get all files matching extension from directory
+        all_files = find_json_files(filepath)
+
+        # get total number of files found
+        num_files = len(all_files)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        if manifest is not None:
+            all_files = manifest.pending(cur, all_files)
+            conn.commit()
+            print('{} files already loaded, {} new or changed'.format(num_files - len(all_files), len(all_files)))
+            num_files = len(all_files)
+
+    if func is None:
+        if metrics is not None:
+            func = lambda cur, datafile: loader(cur, reader(datafile, metrics=metrics))
+        else:
+            func = lambda cur, datafile: loader(cur, reader(datafile))
+    elif workers > 1:
+        raise ValueError('process_data needs a reader and a loader to use several workers')
+
+    if commit_policy is None:
+        commit_policy = CommitPolicy()
+    failed = []
+
+    def load_file(datafile, load):
+        def load_and_record():
+            if manifest is not None:
+                manifest.begin(cur, datafile)
+            rows = load()
+            if manifest is not None:
+                manifest.finish(cur, datafile)
+            return rows
+
+        if metrics is not None:
+            metrics.begin_file(datafile)
+            if metrics.should_profile(datafile):
+                # read the file again in this process so the profile covers the reader as well
+                load = functools.partial(metrics.profile, lambda: func(cur, datafile))
+        if on_savepoint is not None:
+            on_savepoint()
+        rows, error = load_in_savepoint(cur, load_and_record)
+        if error is not None:
+            failed.append(datafile)
+            print('{} failed and was rolled back: {}'.format(datafile, error))
+            if on_rollback is not None:
+                on_rollback()
+        else:
+            commit_policy.add(1, rows)
+            if commit_policy.due():
+                with timed(metrics, 'commit'):
+                    commit_policy.commit(conn)
+        if metrics is not None:
+            metrics.end_file('failed' if error is not None else 'loaded')
+
+    if workers > 1 and num_files > 1:
+        # the readers run ahead of the writer, imap hands their batches back in file order
+        with multiprocessing.Pool(min(workers, num_files)) as pool:
+            results = pool.imap(functools.partial(read_safely, reader, collect=metrics is not None), all_files,
+                                chunksize=max(1, min(64, num_files // (workers * 4))))
+            for i, (datafile, result) in enumerate(zip(all_files, results), 1):
+                load_file(datafile, lambda: loader(cur, unpack_batch(result, metrics)))
+                print('{}/{} files processed.'.format(i, num_files))
+    else:
+        # iterate over files and process
+        for i, datafile in enumerate(all_files, 1):
+            load_file(datafile, lambda: func(cur, datafile))
+            print('{}/{} files processed.'.format(i, num_files))
+
+    with timed(metrics, 'commit'):
+        commit_policy.commit(conn)
+    print('{} files loaded, {} failed.'.format(num_files - len(failed), len(failed)))
+    return failed
+
+def process_song_data(cur, conn, filepath, batch_size=1000, workers=1, song_index=None, manifest=None, cache=None,
+                      commit_policy=None, metrics=None):
+    """
+    Description: This function is used to load the song files in batches. Every batch of files is read by
+    read_song_batch and written by load_song_batch with one INSERT for songs and one for artists. It does
+    the same work as process_data with process_song_file, which needs a data frame and two round trips
+    per file.
+
+    A batch is loaded in a savepoint. When it fails it is rolled back and its files are loaded again one
+    by one, so only the malformed files are left out.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to database.
+        filepath: song data directory.
+        batch_size: number of files per batch.
+        workers: number of processes reading the batches.
+        song_index: optional SongIndex kept up to date with the inserted songs and artists.
+        manifest: optional Manifest, see process_data.
+        cache: optional DimensionCache, songs and artists already written in this run are skipped.
+        commit_policy: CommitPolicy, by default the transaction is committed after every batch.
+        metrics: optional Metrics, see process_data. Every batch is written as one JSON line.
+
+    Returns:
+        list of the files that failed.
+    """
+    start = time.time()
+    with timed(metrics, 'discovery'):
+        all_files = find_json_files(filepath)
+        num_files = len(all_files)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        if manifest is not None:
+            all_files = manifest.pending(cur, all_files)
+            conn.commit()
+            print('{} files already loaded, {} new or changed'.format(num_files - len(all_files), len(all_files)))
+            num_files = len(all_files)
+
+    if commit_policy is None:
+        commit_policy = CommitPolicy()
+    failed = []
+    chunks = [all_files[i:i + batch_size] for i in range(0, num_files, batch_size)]
+
+    collect = metrics is not None
+
+    def load_chunk(chunk, result):
+        def load_and_record():
+            rows = load_song_batch(cur, unpack_batch(result, metrics), song_index, cache, metrics)
+            if manifest is not None:
+                for datafile in chunk:
+                    manifest.finish(cur, datafile)
+            return rows
+
+        load = load_and_record
+        if metrics is not None:
+            metrics.begin_file(chunk[0])
+            if any(metrics.should_profile(datafile) for datafile in chunk):
+                result = read_safely(read_song_batch, chunk, collect)
+                load = functools.partial(metrics.profile, load_and_record)
+        if song_index is not None:
+            song_index.savepoint()
+        rows, error = load_in_savepoint(cur, load)
+        if metrics is not None:
+            # a failed batch is loaded again file by file, its files are counted as retried
+            status = 'loaded' if error is None else 'failed' if len(chunk) == 1 else 'retried'
+            metrics.end_file(status, len(chunk))
+        if error is not None:
+            if cache is not None:
+                cache.clear()
+            if song_index is not None:
+                song_index.rollback()
+            if len(chunk) == 1:
+                failed.append(chunk[0])
+                print('{} failed and was rolled back: {}'.format(chunk[0], error))
+            else:
+                for datafile in chunk:
+                    load_chunk([datafile], read_safely(read_song_batch, [datafile], collect))
+            return
+        commit_policy.add(len(chunk), rows)
+        if commit_policy.due():
+            with timed(metrics, 'commit'):
+                commit_policy.commit(conn)
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    def load(chunks_and_results):
+        done = 0
+        for chunk, result in chunks_and_results:
+            load_chunk(chunk, result)
+            done += len(chunk)
+            elapsed = time.time() - start
+            print('{}/{} files processed, {:.0f} files/s.'.format(done, num_files, done / elapsed if elapsed else 0))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+            load(zip(chunks, pool.imap(functools.partial(read_safely, read_song_batch, collect=collect), chunks)))
+    else:
+        load((chunk, read_safely(read_song_batch, chunk, collect)) for chunk in chunks)
+
+    with timed(metrics, 'commit'):
+        commit_policy.commit(conn)
+    print('{} files loaded, {} failed.'.format(num_files - len(failed), len(failed)))
+    return failed
+
+def parse_args(argv=None):
+    """
+    Description: This function is used to read the command line options of etl.py.
+
+    Arguments:
+        argv: list of options, the command line when None.
+
+    Returns:
+        argparse.Namespace with the options.
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify song and log files into sparkifydb.')
+    parser.add_argument('--row-by-row', action='store_true',
+                        help='insert the song and log records one statement at a time instead of in batches or with COPY')
+    parser.add_argument('--song-batch-size', type=int, default=1000,
+                        help='number of song files read and inserted together')
+    parser.add_argument('--song-select', action='store_true',
+                        help='look songs up with the song_select query instead of the in memory song index')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes reading and transforming the JSON files')
+    parser.add_argument('--dedup-cache-size', type=int, default=1000000,
+                        help='number of keys per dimensional table remembered to skip duplicate rows, 0 disables it')
+    parser.add_argument('--commit-every-files', type=int, default=None, metavar='N',
+                        help='commit after N files (song files are counted per batch), by default after every file')
+    parser.add_argument('--commit-every-rows', type=int, default=None, metavar='N',
+                        help='commit once N records were loaded')
+    parser.add_argument('--commit-every-seconds', type=float, default=None, metavar='T',
+                        help='commit when T seconds passed since the last commit')
+    parser.add_argument('--force', action='append', default=[], metavar='PATTERN',
+                        help='load the files matching this glob pattern again even if they did not change '
+                             '(e.g. "data/log_data/2018/11/*"), can be repeated')
+    parser.add_argument('--build-indexes', action='store_true',
+                        help='build the primary key and indexes deferred by create_tables.py --bulk-load after the load')
+    parser.add_argument('--metrics-jsonl', metavar='PATH',
+                        help='append the stages and counters of every file and of the run to this JSON lines file')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='write the totals of the run to this Prometheus text file')
+    parser.add_argument('--profile-file', metavar='PATTERN',
+                        help='run the load of the first file matching this glob pattern under cProfile')
+    parser.add_argument('--profile-output', default='etl.prof', metavar='PATH',
+                        help='file receiving the cProfile statistics')
+    return parser.parse_args(argv)
+
+def run_etl(cur, conn, args, song_path='data/song_data', log_path='data/log_data'):
+    """
+    Description: This function is used to run the whole ETL with the options of etl.py: the song files
+    first, then the log files.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to database.
+        args: options returned by parse_args.
+        song_path: song data directory.
+        log_path: log data directory.
+
+    Returns:
+        dict with the wall time in seconds of every stage, the failed files and the metrics summary.
+    """
+    stage_seconds = {}
+    metrics = Metrics(args.metrics_jsonl, args.profile_file, args.profile_output)
+    start = time.time()
+
+    song_index = None
+    if not args.song_select:
+        song_index = SongIndex.from_database(cur)
+        print('{} songs loaded in the song index'.format(len(song_index)))
+    stage_seconds['song_index'] = time.time() - start
+
+    cache = None
+    if args.dedup_cache_size > 0:
+        cache = DimensionCache(args.dedup_cache_size)
+
+    def commit_policy():
+        if args.commit_every_files is None and args.commit_every_rows is None and args.commit_every_seconds is None:
+            return CommitPolicy()
+        return CommitPolicy(args.commit_every_files, args.commit_every_rows, args.commit_every_seconds)
+
+    song_manifest = Manifest(cur, force=args.force)
+    log_manifest = Manifest(cur, force=args.force, track_songplays=True)
+
+    partitions = SongplayPartitions.from_database(cur)
+    if partitions is not None:
+        print('songplays is partitioned by month')
+
+    def clear_caches():
+        if cache is not None:
+            cache.clear()
+        if partitions is not None:
+            partitions.clear()
+
+    def roll_song_index_back():
+        # the songs and artists of a rolled back song file are not in the database either
+        clear_caches()
+        if song_index is not None:
+            song_index.rollback()
+
+    start = time.time()
+    if args.row_by_row:
+        failed_songs = process_data(cur, conn, filepath=song_path, reader=read_song_file,
+                                    loader=functools.partial(load_song_data, song_index=song_index, cache=cache,
+                                                             metrics=metrics),
+                                    workers=args.workers, manifest=song_manifest, commit_policy=commit_policy(),
+                                    on_savepoint=song_index.savepoint if song_index is not None else None,
+                                    on_rollback=roll_song_index_back, metrics=metrics)
+    else:
+        failed_songs = process_song_data(cur, conn, filepath=song_path, batch_size=args.song_batch_size,
+                                         workers=args.workers, song_index=song_index, manifest=song_manifest,
+                                         cache=cache, commit_policy=commit_policy(), metrics=metrics)
+    stage_seconds['song_data'] = time.time() - start
+
+    start = time.time()
+    if args.row_by_row:
+        failed_logs = process_data(cur, conn, filepath=log_path, reader=read_log_file,
+                                   loader=functools.partial(load_log_data, song_index=song_index, cache=cache,
+                                                            metrics=metrics, partitions=partitions),
+                                   workers=args.workers, manifest=log_manifest, commit_policy=commit_policy(),
+                                   on_rollback=clear_caches, metrics=metrics)
+    else:
+        failed_logs = process_data(cur, conn, filepath=log_path, reader=prepare_log_batch,
+                                   loader=functools.partial(load_log_batch, song_index=song_index, cache=cache,
+                                                            metrics=metrics, partitions=partitions),
+                                   workers=args.workers, manifest=log_manifest, commit_policy=commit_policy(),
+                                   on_rollback=clear_caches, metrics=metrics)
+    stage_seconds['log_data'] = time.time() - start
+
+    if args.build_indexes:
+        start = time.time()
+        with timed(metrics, 'build_indexes'):
+            build_indexes(cur, conn)
+        stage_seconds['build_indexes'] = time.time() - start
+
+    if song_index is not None:
+        print('song index: {songs} songs, {artists} artists, {hits} hits, {misses} misses'.format(**song_index.stats()))
+    if cache is not None:
+        print('duplicate rows skipped: {users} users, {time} time, {songs} songs, {artists} artists'.format(**cache.stats()))
+    print('{} failed files: {} song files, {} log files'.format(len(failed_songs) + len(failed_logs),
+                                                              len(failed_songs), len(failed_logs)))
+    for datafile in failed_songs + failed_logs:
+        print('  {}'.format(datafile))
+    metrics.close(args.metrics_prom)
+
+    return {'stage_seconds': stage_seconds, 'failed_song_files': failed_songs, 'failed_log_files': failed_logs,
+            'metrics': metrics.summary()}
 
 def main():
     
@@ -147,14 +943,15 @@ def main():
     Returns:
         None
     """ 
+    args = parse_args()
+
     conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    run_etl(cur, conn, args)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
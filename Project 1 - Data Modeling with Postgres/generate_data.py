@@ -0,0 +1,159 @@
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+PAGES = ['Home', 'Logout', 'Settings', 'Help', 'About', 'Downgrade', 'Upgrade']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) '
+               'Version/7.0 Mobile/11D257 Safari/9537.53"']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Portland-South Portland, ME', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Lansing-East Lansing, MI']
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(rng, output, num_songs, num_artists):
+    """
+    Description: This function is used to write one JSON file per song below output/song_data, with the
+    same fields and the same A/B/C/TRABC... layout as the Million Song Dataset subset.
+
+    Arguments:
+        rng: random.Random instance.
+        output: root directory of the generated data.
+        num_songs: number of song files.
+        num_artists: number of distinct artists.
+
+    Returns:
+        list of the song records.
+    """
+    artists = []
+    for i in range(num_artists):
+        located = rng.random() < 0.4
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_name': 'Artist {}'.format(i),
+                        'artist_location': rng.choice(LOCATIONS) if located else '',
+                        'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+                        'artist_longitude': round(rng.uniform(-150, 150), 5) if located else None})
+
+    songs = []
+    for i in range(num_songs):
+        record = {'num_songs': 1, 'song_id': random_id(rng, 'SO'), 'title': 'Song {}'.format(i),
+                  'duration': round(rng.uniform(60, 600), 5), 'year': rng.choice([0] + list(range(1960, 2011)))}
+        record.update(rng.choice(artists))
+        songs.append(record)
+
+        track_id = random_id(rng, 'TR')
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(record, f)
+    return songs
+
+
+def generate_logs(rng, output, songs, num_users, days, events_per_day, match_fraction, start_date):
+    """
+    Description: This function is used to write one event log file per day below
+    output/log_data/YYYY/MM/YYYY-MM-DD-events.json, with one JSON record per line.
+
+    Arguments:
+        rng: random.Random instance.
+        output: root directory of the generated data.
+        songs: song records returned by generate_songs.
+        num_users: number of distinct users.
+        days: number of daily log files.
+        events_per_day: number of events per log file, about 80% of them are NextSong events.
+        match_fraction: share of the NextSong events that refer to a generated song.
+        start_date: date of the first log file.
+
+    Returns:
+        Number of events written.
+    """
+    users = [{'userId': str(i + 1),
+              'firstName': 'First{}'.format(i + 1),
+              'lastName': 'Last{}'.format(i + 1),
+              'gender': rng.choice('MF'),
+              'level': rng.choice(['free', 'paid']),
+              'location': rng.choice(LOCATIONS),
+              'userAgent': rng.choice(USER_AGENTS),
+              'registration': float(rng.randint(1530000000000, 1540000000000))}
+             for i in range(num_users)]
+
+    total = 0
+    for day in range(days):
+        date = start_date + timedelta(days=day)
+        directory = os.path.join(output, 'log_data', '{:04d}'.format(date.year), '{:02d}'.format(date.month))
+        os.makedirs(directory, exist_ok=True)
+
+        day_start = int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+        timestamps = sorted(day_start + rng.randrange(86400000) for _ in range(events_per_day))
+        with open(os.path.join(directory, date.strftime('%Y-%m-%d-events.json')), 'w') as f:
+            for item, ts in enumerate(timestamps):
+                user = rng.choice(users)
+                # a few users change their subscription during the run
+                if rng.random() < 0.001:
+                    user['level'] = 'paid' if user['level'] == 'free' else 'free'
+
+                event = {'auth': 'Logged In', 'itemInSession': item % 100, 'method': 'PUT', 'status': 200,
+                         'sessionId': int(user['userId']) * 1000 + day, 'ts': ts}
+                event.update(user)
+                if rng.random() < 0.8:
+                    if rng.random() < match_fraction:
+                        song = rng.choice(songs)
+                        event.update({'song': song['title'], 'artist': song['artist_name'],
+                                      'length': song['duration']})
+                    else:
+                        event.update({'song': 'Unknown Song {}'.format(rng.randrange(10 ** 6)),
+                                      'artist': 'Unknown Artist', 'length': round(rng.uniform(60, 600), 5)})
+                    event['page'] = 'NextSong'
+                else:
+                    event.update({'song': None, 'artist': None, 'length': None, 'method': 'GET',
+                                  'page': rng.choice(PAGES)})
+                f.write(json.dumps(event) + '\n')
+                total += 1
+    return total
+
+
+def generate(output, songs=1000, artists=500, users=100, days=30, events_per_day=1000, match_fraction=0.5,
+             start_date='2018-11-01', seed=0):
+    """
+    Description: This function is used to write a synthetic Sparkify data set with the layout of the data
+    directory (song_data and log_data). The same arguments and seed always give the same files.
+
+    Returns:
+        dict with the number of song files, log files and events written.
+    """
+    rng = random.Random(seed)
+    song_records = generate_songs(rng, output, songs, artists)
+    events = generate_logs(rng, output, song_records, users, days, events_per_day, match_fraction,
+                           datetime.strptime(start_date, '%Y-%m-%d'))
+    return {'song_files': songs, 'log_files': days, 'events': events}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic Sparkify song_data and log_data trees.')
+    parser.add_argument('output', help='directory receiving song_data and log_data')
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--artists', type=int, default=500)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--events-per-day', type=int, default=1000)
+    parser.add_argument('--match-fraction', type=float, default=0.5,
+                        help='share of the NextSong events that match a generated song')
+    parser.add_argument('--start-date', default='2018-11-01')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate(args.output, args.songs, args.artists, args.users, args.days, args.events_per_day,
+                       args.match_fraction, args.start_date, args.seed)
+    print('{song_files} song files, {log_files} log files, {events} events written.'.format(**summary))
+
+
+if __name__ == "__main__":
+    main()
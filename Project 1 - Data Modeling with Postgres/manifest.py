@@ -0,0 +1,127 @@
+import os
+import fnmatch
+import hashlib
+
+from sql_queries import (manifest_table_create, manifest_select, manifest_upsert, manifest_touch,
+                         songplay_last_id, songplay_range_delete)
+
+
+def file_hash(filepath, chunk_size=1 << 20):
+    """
+    Description: This function is used to compute the content hash stored in the manifest.
+
+    Arguments:
+        filepath: path of the JSON file.
+        chunk_size: number of bytes read at a time.
+
+    Returns:
+        sha256 hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Description: Record of the files already loaded into sparkifydb, kept in the etl_manifest table.
+
+    A file is skipped when its size and mtime did not change since it was loaded. When they did, the
+    content hash decides whether the file really has to be loaded again. Files matching one of the force
+    patterns are always loaded again.
+
+    With track_songplays the songplays created by every file are remembered, so loading a log file again
+    replaces its songplays instead of adding them a second time. The dimensional tables need no such care
+    because their inserts already ignore the rows that exist.
+    """
+
+    def __init__(self, cur, force=(), track_songplays=False):
+        cur.execute(manifest_table_create)
+        cur.execute(manifest_select)
+        self._entries = {row[0]: row[1:] for row in cur.fetchall()}
+        self._force = [os.path.abspath(pattern) for pattern in force]
+        self._track_songplays = track_songplays
+        self._fingerprints = {}
+        self._last_songplay_id = None
+        self.skipped = 0
+
+    def _forced(self, path):
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self._force)
+
+    def pending(self, cur, all_files):
+        """
+        Description: This function is used to filter the files found by process_data down to the ones
+        that are new, changed or forced.
+
+        Arguments:
+            cur: the cursor object.
+            all_files: absolute paths of the JSON files.
+
+        Returns:
+            The files that have to be loaded, in the same order.
+        """
+        files = []
+        for path in all_files:
+            stat = os.stat(path)
+            entry = self._entries.get(path)
+            forced = self._forced(path)
+            if entry is not None and not forced and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                self.skipped += 1
+                continue
+
+            content_hash = file_hash(path)
+            if entry is not None and not forced and entry[2] == content_hash:
+                # only touched, remember the new mtime so the file is not hashed again next time
+                cur.execute(manifest_touch, (stat.st_mtime, path))
+                self.skipped += 1
+                continue
+
+            self._fingerprints[path] = (stat.st_size, stat.st_mtime, content_hash)
+            files.append(path)
+        return files
+
+    def begin(self, cur, path):
+        """
+        Description: This function is used before a file is loaded. It removes the songplays of an
+        earlier load of the same file.
+
+        Arguments:
+            cur: the cursor object.
+            path: absolute path of the file.
+
+        Returns:
+            None
+        """
+        if not self._track_songplays:
+            return
+        entry = self._entries.get(path)
+        if entry is not None and entry[3] is not None:
+            cur.execute(songplay_range_delete, (entry[3], entry[4]))
+        cur.execute(songplay_last_id)
+        self._last_songplay_id = cur.fetchone()[0]
+
+    def finish(self, cur, path):
+        """
+        Description: This function is used after a file is loaded, in the same transaction, to record it.
+
+        Arguments:
+            cur: the cursor object.
+            path: absolute path of the file.
+
+        Returns:
+            None
+        """
+        first_id, last_id = None, None
+        if self._track_songplays:
+            cur.execute(songplay_last_id)
+            last_id = cur.fetchone()[0]
+            # one writer per database: the ids handed out since begin belong to this file
+            if last_id > self._last_songplay_id:
+                first_id = self._last_songplay_id + 1
+            else:
+                last_id = None
+        size, mtime, content_hash = self._fingerprints.pop(path)
+        cur.execute(manifest_upsert, (path, size, mtime, content_hash, first_id, last_id))
+        self._entries[path] = (size, mtime, content_hash, first_id, last_id)
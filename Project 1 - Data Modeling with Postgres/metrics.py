@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import fnmatch
+import cProfile
+import contextlib
+from collections import defaultdict
+
+
+def timed(metrics, stage, rows=None):
+    """
+    Description: This function is used to time a block of code when metrics are collected and to do
+    nothing otherwise, so the ETL functions can be called with or without a Metrics object.
+
+    Arguments:
+        metrics: Metrics or None.
+        stage: name of the stage.
+        rows: optional number of rows handled by the block.
+
+    Returns:
+        context manager.
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(stage, rows)
+
+
+class Metrics:
+    """
+    Description: Wall time, call and row counts per ETL stage, plus plain counters (song lookup hits and
+    misses, upsert conflicts...). The totals of the run are written as a Prometheus text file, and every
+    file with its own stages is written as one JSON line.
+
+    Collecting a stage only costs two perf_counter calls and a few dict updates, well below the cost of
+    the database round trips it measures, so the metrics can stay on in production runs.
+    """
+
+    def __init__(self, jsonl_path=None, profile_pattern=None, profile_path='etl.prof'):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.rows = defaultdict(int)
+        self.counters = defaultdict(int)
+        self._file = None
+        self._jsonl = open(jsonl_path, 'a') if jsonl_path else None
+        self._profile_pattern = os.path.abspath(profile_pattern) if profile_pattern else None
+        self._profile_path = profile_path
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, rows)
+
+    def record(self, name, seconds, rows=None, calls=1):
+        """
+        Description: This function is used to add a measure to a stage of the run and of the current file.
+
+        Arguments:
+            name: name of the stage.
+            seconds: wall time spent.
+            rows: optional number of rows handled.
+            calls: number of calls the measure covers.
+
+        Returns:
+            None
+        """
+        targets = [(self.seconds, self.calls, self.rows)]
+        if self._file is not None:
+            targets.append((self._file['seconds'], self._file['calls'], self._file['rows']))
+        for seconds_by_stage, calls_by_stage, rows_by_stage in targets:
+            seconds_by_stage[name] += seconds
+            calls_by_stage[name] += calls
+            if rows is not None:
+                rows_by_stage[name] += rows
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+        if self._file is not None:
+            self._file['counters'][name] += value
+
+    def snapshot(self):
+        """
+        Description: This function is used to ship the measures of a worker process back to the writer.
+
+        Returns:
+            dict that can be given to merge.
+        """
+        return {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'rows': dict(self.rows),
+                'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        for name, seconds in snapshot['seconds'].items():
+            self.record(name, seconds, snapshot['rows'].get(name), snapshot['calls'].get(name, 1))
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def begin_file(self, path):
+        """
+        Description: This function is used to start the measures of one file (or batch of song files).
+
+        Arguments:
+            path: file path.
+
+        Returns:
+            None
+        """
+        self._file = {'path': path, 'started': time.perf_counter(), 'seconds': defaultdict(float),
+                      'calls': defaultdict(int), 'rows': defaultdict(int), 'counters': defaultdict(int)}
+
+    def end_file(self, status, files=1):
+        """
+        Description: This function is used to close the measures of the current file and write them as a
+        JSON line.
+
+        Arguments:
+            status: 'loaded' or 'failed'.
+            files: number of files covered, more than one for a batch of song files.
+
+        Returns:
+            None
+        """
+        record, self._file = self._file, None
+        if record is None:
+            return
+        self.count('files_' + status, files)
+        if self._jsonl is not None:
+            self._write({'event': 'file', 'path': record['path'], 'files': files, 'status': status,
+                         'seconds': round(time.perf_counter() - record['started'], 6),
+                         'stages': {name: {'seconds': round(seconds, 6),
+                                           'calls': record['calls'][name],
+                                           'rows': record['rows'].get(name)}
+                                    for name, seconds in record['seconds'].items()},
+                         'counters': dict(record['counters'])})
+
+    def should_profile(self, path):
+        return self._profile_pattern is not None and fnmatch.fnmatch(path, self._profile_pattern)
+
+    def profile(self, function):
+        """
+        Description: This function is used to run the load of a single file under cProfile. The statistics
+        are written to profile_path and can be read with pstats or snakeviz.
+
+        Arguments:
+            function: function doing the work.
+
+        Returns:
+            The result of function.
+        """
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function)
+        finally:
+            profiler.dump_stats(self._profile_path)
+            self._profile_pattern = None
+            print('profile written to {}'.format(self._profile_path))
+
+    def _write(self, record):
+        record['time'] = round(time.time(), 3)
+        self._jsonl.write(json.dumps(record) + '\n')
+        self._jsonl.flush()
+
+    def summary(self):
+        return {'seconds': round(time.time() - self.started, 6),
+                'stages': {name: {'seconds': round(seconds, 6), 'calls': self.calls[name],
+                                  'rows': self.rows.get(name)}
+                           for name, seconds in sorted(self.seconds.items())},
+                'counters': dict(sorted(self.counters.items()))}
+
+    def close(self, prometheus_path=None):
+        """
+        Description: This function is used at the end of the run to write the run summary as a JSON line
+        and, when a path is given, the Prometheus text file (for node_exporter's textfile collector).
+
+        Arguments:
+            prometheus_path: optional path of the .prom file.
+
+        Returns:
+            None
+        """
+        if self._jsonl is not None:
+            self._write(dict(self.summary(), event='run'))
+            self._jsonl.close()
+            self._jsonl = None
+        if prometheus_path:
+            write_prometheus(self, prometheus_path)
+
+
+def write_prometheus(metrics, path, prefix='sparkify_etl'):
+    """
+    Description: This function is used to write the totals of a run in the Prometheus text format. The file
+    is written next to its final name and renamed, so a collector never reads half of it.
+
+    Arguments:
+        metrics: Metrics of the run.
+        path: path of the .prom file.
+        prefix: prefix of every metric name.
+
+    Returns:
+        None
+    """
+    lines = ['# HELP {}_stage_seconds_total Wall time spent per stage.'.format(prefix),
+             '# TYPE {}_stage_seconds_total counter'.format(prefix)]
+    lines += ['{}_stage_seconds_total{{stage="{}"}} {:.6f}'.format(prefix, name, seconds)
+              for name, seconds in sorted(metrics.seconds.items())]
+    lines += ['# HELP {}_stage_calls_total Number of times a stage ran.'.format(prefix),
+              '# TYPE {}_stage_calls_total counter'.format(prefix)]
+    lines += ['{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, name, calls)
+              for name, calls in sorted(metrics.calls.items())]
+    lines += ['# HELP {}_stage_rows_total Rows handled per stage.'.format(prefix),
+              '# TYPE {}_stage_rows_total counter'.format(prefix)]
+    lines += ['{}_stage_rows_total{{stage="{}"}} {}'.format(prefix, name, rows)
+              for name, rows in sorted(metrics.rows.items())]
+    for name, value in sorted(metrics.counters.items()):
+        lines += ['# TYPE {}_{}_total counter'.format(prefix, name),
+                  '{}_{}_total {}'.format(prefix, name, value)]
+    lines += ['# TYPE {}_last_run_seconds gauge'.format(prefix),
+              '{}_last_run_seconds {:.6f}'.format(prefix, time.time() - metrics.started),
+              '# TYPE {}_last_run_timestamp_seconds gauge'.format(prefix),
+              '{}_last_run_timestamp_seconds {:.3f}'.format(prefix, time.time())]
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
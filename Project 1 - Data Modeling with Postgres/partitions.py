@@ -0,0 +1,63 @@
+from datetime import date
+
+from sql_queries import songplay_partitioned_select, songplay_partition_create
+
+
+def partition_name(year, month):
+    return 'songplays_{:04d}_{:02d}'.format(year, month)
+
+
+class SongplayPartitions:
+    """
+    Description: Monthly partitions of a songplays table created by `create_tables.py --bulk-load`. The
+    partitions are created on demand, before the songplays of a month are inserted for the first time.
+
+    The partitions are created with IF NOT EXISTS, the set of months only saves the statement for the
+    months already seen in this run. They are created inside the savepoint of the file being loaded, so
+    after a rollback the set has to be cleared like the DimensionCache.
+    """
+
+    def __init__(self):
+        self.months = set()
+
+    @classmethod
+    def from_database(cls, cur):
+        """
+        Description: This function is used to find out whether songplays is partitioned.
+
+        Arguments:
+            cur: the cursor object.
+
+        Returns:
+            SongplayPartitions, or None when songplays is a plain table.
+        """
+        cur.execute(songplay_partitioned_select)
+        row = cur.fetchone()
+        if row is None or not row[0]:
+            return None
+        return cls()
+
+    def ensure(self, cur, start_times):
+        """
+        Description: This function is used to create the missing partitions for a set of songplays.
+
+        Arguments:
+            cur: the cursor object.
+            start_times: pandas datetime Series with the start_time of the songplays.
+
+        Returns:
+            Number of months that were not seen before in this run.
+        """
+        months = set(zip(start_times.dt.year, start_times.dt.month)) - self.months
+        for year, month in sorted(months):
+            first_day = date(year, month, 1)
+            next_month = date(year + month // 12, month % 12 + 1, 1)
+            cur.execute(songplay_partition_create.format(partition_name(year, month)), (first_day, next_month))
+            self.months.add((year, month))
+        return len(months)
+
+    def clear(self):
+        self.months.clear()
+
+    def __len__(self):
+        return len(self.months)
@@ -0,0 +1,297 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+
+from sql_queries import song_index_select
+
+
+def song_key(title, artist_name, duration):
+    """
+    Description: This function is used to turn the (title, artist name, duration) triple matched by song_select
+    into a 64-bit integer. Durations are normalized through float so the numeric values read from the database
+    and the float lengths read from the log files give the same key.
+
+    Arguments:
+        title: song title.
+        artist_name: artist name.
+        duration: song duration in seconds.
+
+    Returns:
+        The key as an int, or None when one of the parts is missing (song_select never matches NULLs).
+    """
+    if title is None or artist_name is None or duration is None:
+        return None
+    try:
+        duration = repr(float(duration))
+    except (TypeError, ValueError):
+        return None
+    if duration == 'nan':
+        return None
+    raw = '\x1f'.join((str(title), str(artist_name), duration)).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'little')
+
+
+class SortedKeys:
+    """
+    Description: Map of 64-bit keys to int positions. The keys are spread on 4096 buckets by their top bits,
+    every bucket a pair of parallel arrays sorted on the key and searched with bisect, so adding a key only
+    shifts the few hundred keys of its bucket.
+    """
+
+    bucket_bits = 12
+
+    def __init__(self):
+        self._shift = 64 - self.bucket_bits
+        self._keys = [array('Q') for _ in range(1 << self.bucket_bits)]
+        self._values = [array('i') for _ in range(1 << self.bucket_bits)]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def get(self, key):
+        """
+        Description: This function is used to find the position stored for a key.
+
+        Returns:
+            The position, or None when the key is unknown.
+        """
+        bucket = key >> self._shift
+        keys = self._keys[bucket]
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return self._values[bucket][i]
+        return None
+
+    def add(self, key, value):
+        """
+        Description: This function is used to store a key; a key that is already stored keeps its position.
+
+        Returns:
+            True when the key was added.
+        """
+        bucket = key >> self._shift
+        keys = self._keys[bucket]
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return False
+        keys.insert(i, key)
+        self._values[bucket].insert(i, value)
+        self._size += 1
+        return True
+
+    def remove(self, key):
+        bucket = key >> self._shift
+        keys = self._keys[bucket]
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+            del self._values[bucket][i]
+            self._size -= 1
+
+
+class SongIndex:
+    """
+    Description: In memory replacement of the song_select query. It resolves song_id and artist_id from
+    (title, artist name, duration) without a round trip to the database.
+
+    Every song is stored as a 64-bit hash of its match key in a SortedKeys pointing to a position in two
+    parallel columns: the song ids, packed in a single buffer, and the index of the artist in an interned artist
+    list. Artists are kept once no matter how many songs they have, a song costs about 45 bytes (42 of them
+    array data for an 18 character song_id). A song_id always comes with the same title, artist and duration,
+    so a song loaded twice is recognized by its match key.
+    """
+
+    def __init__(self):
+        self._positions = SortedKeys()
+        self._song_ids = bytearray()
+        self._song_offsets = array('Q', [0])
+        self._song_artists = array('i')
+        self._artist_ids = []
+        self._artist_names = []
+        self._artist_positions = {}
+        self._pending_songs = {}
+        # songs and artists counts at the savepoint, and the undo log of the other changes since
+        self._savepoint = None
+        self._undo = None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_database(cls, cur, fetch_size=10000):
+        """
+        Description: This function is used to build the index from the songs and artists tables.
+
+        Arguments:
+            cur: the cursor object.
+            fetch_size: number of rows fetched per round trip.
+
+        Returns:
+            SongIndex with every song already stored in sparkifydb.
+        """
+        index = cls()
+        cur.execute(song_index_select)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            for song_id, title, duration, artist_id, artist_name in rows:
+                index.add_artist(artist_id, artist_name)
+                index.add_song(song_id, title, artist_id, duration)
+        return index
+
+    def __len__(self):
+        return len(self._song_artists)
+
+    def add_artist(self, artist_id, artist_name):
+        """
+        Description: This function is used to register an artist. As with artist_table_insert the first
+        name stored for an artist_id wins.
+
+        Arguments:
+            artist_id: artist id.
+            artist_name: artist name.
+
+        Returns:
+            Position of the artist in the interned artist list.
+        """
+        position = self._artist_positions.get(artist_id)
+        if position is None:
+            position = len(self._artist_ids)
+            self._artist_positions[artist_id] = position
+            self._artist_ids.append(artist_id)
+            self._artist_names.append(artist_name)
+            pending = self._pending_songs.pop(artist_id, ())
+            if pending and self._undo is not None:
+                self._undo.append(('resolved', artist_id, pending))
+            for song_id, title, duration in pending:
+                self._store_song(song_id, title, position, duration)
+        return position
+
+    def add_song(self, song_id, title, artist_id, duration):
+        """
+        Description: This function is used to register a song the same way song_table_insert does: a song
+        that is already stored, recognized by its match key, is ignored. Songs whose artist is not known yet
+        become searchable once the artist is added, like the JOIN in song_select.
+
+        Arguments:
+            song_id: song id.
+            title: song title.
+            artist_id: artist id.
+            duration: song duration in seconds.
+
+        Returns:
+            None
+        """
+        artist = self._artist_positions.get(artist_id)
+        if artist is None:
+            self._pending_songs.setdefault(artist_id, []).append((song_id, title, duration))
+            if self._undo is not None:
+                self._undo.append(('pending', artist_id))
+            return
+        self._store_song(song_id, title, artist, duration)
+
+    def _store_song(self, song_id, title, artist, duration):
+        key = song_key(title, self._artist_names[artist], duration)
+        if key is None or not self._positions.add(key, len(self._song_artists)):
+            return
+        self._song_ids += str(song_id).encode('utf-8')
+        self._song_offsets.append(len(self._song_ids))
+        self._song_artists.append(artist)
+        if self._undo is not None:
+            self._undo.append(('song', key))
+
+    def savepoint(self):
+        """
+        Description: This function is used to mark the state of the index before a batch is loaded in a
+        database savepoint, so rollback can forget the songs and artists of the batch with it.
+
+        Returns:
+            None
+        """
+        self._savepoint = (len(self._song_artists), len(self._artist_ids))
+        self._undo = []
+
+    def rollback(self):
+        """
+        Description: This function is used to bring the index back to the last savepoint after the batch
+        was rolled back in the database, otherwise later plays would match songs that are not in songs.
+
+        Returns:
+            None
+        """
+        if self._savepoint is None:
+            return
+        for change in reversed(self._undo):
+            if change[0] == 'song':
+                self._positions.remove(change[1])
+            elif change[0] == 'pending':
+                pending = self._pending_songs[change[1]]
+                pending.pop()
+                if not pending:
+                    del self._pending_songs[change[1]]
+            else:
+                self._pending_songs[change[1]] = change[2]
+        songs, artists = self._savepoint
+        del self._song_artists[songs:]
+        del self._song_ids[self._song_offsets[songs]:]
+        del self._song_offsets[songs + 1:]
+        for artist_id in self._artist_ids[artists:]:
+            del self._artist_positions[artist_id]
+        del self._artist_ids[artists:]
+        del self._artist_names[artists:]
+        self._undo = []
+
+    def _song_id(self, position):
+        return self._song_ids[self._song_offsets[position]:self._song_offsets[position + 1]].decode('utf-8')
+
+    def lookup(self, title, artist_name, duration):
+        """
+        Description: This function is used to resolve a single event.
+
+        Arguments:
+            title: song title of the event.
+            artist_name: artist name of the event.
+            duration: length of the event.
+
+        Returns:
+            (song_id, artist_id) or (None, None) when no song matches.
+        """
+        key = song_key(title, artist_name, duration)
+        position = None if key is None else self._positions.get(key)
+        if position is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return self._song_id(position), self._artist_ids[self._song_artists[position]]
+
+    def resolve(self, titles, artist_names, durations):
+        """
+        Description: This function is used to resolve a whole batch of events at once.
+
+        Arguments:
+            titles: song titles of the events.
+            artist_names: artist names of the events.
+            durations: lengths of the events.
+
+        Returns:
+            song_ids, artist_ids: two lists aligned with the input, None where no song matches.
+        """
+        song_ids, artist_ids = [], []
+        for title, artist_name, duration in zip(titles, artist_names, durations):
+            song_id, artist_id = self.lookup(title, artist_name, duration)
+            song_ids.append(song_id)
+            artist_ids.append(artist_id)
+        return song_ids, artist_ids
+
+    def stats(self):
+        """
+        Description: This function is used to summarize the index for the run log.
+
+        Returns:
+            dict with the number of songs, artists, hits and misses.
+        """
+        return {'songs': len(self._song_artists),
+                'artists': len(self._artist_ids),
+                'hits': self.hits,
+                'misses': self.misses}
@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS times;"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest;"
 
 # CREATE TABLES
 
@@ -21,6 +22,27 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays \
                         location varchar,\
                         user_agent varchar)\
                         ;""")
+# bulk-load variant (create_tables.py --bulk-load): one partition per start_time month and no primary key
+# until create_tables.build_indexes runs after the initial load. The partitions are created by etl.py
+# (partitions.py) before the songplays of a new month are inserted.
+
+songplay_table_partitioned_create = ("""CREATE TABLE IF NOT EXISTS songplays \
+                                    (songplay_id serial,\
+                                    start_time timestamp NOT NULL,\
+                                    user_id int NOT NULL,\
+                                    level varchar,\
+                                    song_id varchar,\
+                                    artist_id varchar,\
+                                    session_id int, \
+                                    location varchar,\
+                                    user_agent varchar)\
+                                    PARTITION BY RANGE (start_time)\
+                                    ;""")
+
+songplay_partition_create = "CREATE TABLE IF NOT EXISTS {} PARTITION OF songplays FOR VALUES FROM (%s) TO (%s);"
+
+songplay_partitioned_select = "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('songplays')"
+
 # DIM TABLES
 
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users \
@@ -57,6 +79,21 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time\
                     weekday smallint)\
                     ;""")
 
+# ETL MANIFEST
+
+# one row per loaded JSON file, used by etl.py to skip the files that did not change since the last run.
+# songplay_id_min/max keep the songplays created by a log file so they can be replaced when it is loaded again.
+
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS etl_manifest \
+                        (path varchar PRIMARY KEY, \
+                        size bigint, \
+                        mtime double precision, \
+                        content_hash varchar, \
+                        songplay_id_min int, \
+                        songplay_id_max int, \
+                        loaded_at timestamp)\
+                        ;""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""INSERT INTO songplays\
@@ -68,7 +105,7 @@ songplay_table_insert = ("""INSERT INTO songplays\
 user_table_insert = ("""INSERT INTO users \
                     (user_id, first_name, last_name, gender, level) \
                     VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user_id)\
-                    DO UPDATE SET level=users.level, last_name=users.last_name, gender=users.gender""")
+                    DO UPDATE SET level=EXCLUDED.level, last_name=EXCLUDED.last_name, gender=EXCLUDED.gender""")
 
 song_table_insert = ("""INSERT INTO songs \
                     (song_id, title, artist_id, year, duration)\
@@ -82,13 +119,165 @@ time_table_insert = ("""INSERT INTO time \
                     (start_time, hour, day, week, month, year, weekday) \
                     VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (start_time) DO NOTHING""")
 
+# batch versions of song_table_insert and artist_table_insert, the VALUES list is filled by psycopg2.extras.execute_values
+
+song_table_batch_insert = ("""INSERT INTO songs \
+                          (song_id, title, artist_id, year, duration)\
+                          VALUES %s ON CONFLICT (song_id) DO NOTHING""")
+
+artist_table_batch_insert = ("""INSERT INTO artists\
+                            (artist_id, name, location, latitude, longitude) \
+                            VALUES %s ON CONFLICT (artist_id) DO NOTHING""")
+
 # FIND SONGS
 
 song_select = ("""SELECT s.song_id, a.artist_id from songs s JOIN artists a on s.artist_id = a.artist_id \
                WHERE s.title = %s AND a.name = %s AND s.duration = %s""")
 
+# every song that song_select can match, used to build the in memory SongIndex (song_index.py)
+
+song_index_select = ("""SELECT s.song_id, s.title, s.duration, a.artist_id, a.name from songs s \
+                     JOIN artists a on s.artist_id = a.artist_id""")
+
+# STAGING TABLES (BULK LOAD)
+
+# Temporary tables only live for the session of the etl.py connection. Every log file is streamed into them
+# with COPY and then moved into the final tables with a few set-based statements. The seq column keeps the
+# original order of the events in the file, so the bulk path inserts rows in the same order as the per-row path.
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging \
+                      (start_time timestamp, \
+                      hour smallint, \
+                      day smallint, \
+                      week smallint, \
+                      month smallint, \
+                      year int, \
+                      weekday smallint)\
+                      ;""")
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS user_staging \
+                      (seq int, \
+                      user_id int, \
+                      first_name varchar, \
+                      last_name varchar, \
+                      gender varchar, \
+                      level varchar)\
+                      ;""")
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplay_staging \
+                          (seq int, \
+                          start_time timestamp, \
+                          user_id int, \
+                          level varchar, \
+                          song varchar, \
+                          artist varchar, \
+                          length numeric, \
+                          song_id varchar, \
+                          artist_id varchar, \
+                          session_id int, \
+                          location varchar, \
+                          user_agent varchar)\
+                          ;""")
+
+staging_table_truncate = "TRUNCATE time_staging, user_staging, songplay_staging;"
+
+staging_copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+# INSERT RECORDS FROM STAGING
+
+time_table_bulk_insert = ("""INSERT INTO time \
+                         (start_time, hour, day, week, month, year, weekday) \
+                         SELECT start_time, hour, day, week, month, year, weekday FROM time_staging \
+                         ON CONFLICT (start_time) DO NOTHING""")
+
+# A single INSERT can not update the same user twice, so only the last event of every user in the batch is kept.
+# That is the row the per-row path ends with, every event updating the user in turn.
+
+user_table_bulk_insert = ("""INSERT INTO users \
+                         (user_id, first_name, last_name, gender, level) \
+                         SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level FROM user_staging \
+                         ORDER BY user_id, seq DESC \
+                         ON CONFLICT (user_id)\
+                         DO UPDATE SET level=EXCLUDED.level, last_name=EXCLUDED.last_name, gender=EXCLUDED.gender""")
+
+songplay_table_bulk_insert = ("""INSERT INTO songplays \
+                             (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
+                             SELECT st.start_time, st.user_id, st.level, m.song_id, m.artist_id, st.session_id, \
+                             st.location, st.user_agent FROM songplay_staging st \
+                             LEFT JOIN LATERAL (SELECT s.song_id, a.artist_id FROM songs s \
+                             JOIN artists a ON s.artist_id = a.artist_id \
+                             WHERE s.title = st.song AND a.name = st.artist AND s.duration = st.length LIMIT 1) m ON true \
+                             ORDER BY st.seq RETURNING song_id""")
+
+# song_id and artist_id already resolved in memory by the SongIndex, no lookup needed
+
+songplay_table_staged_insert = ("""INSERT INTO songplays \
+                               (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
+                               SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent \
+                               FROM songplay_staging ORDER BY seq""")
+
+# MANIFEST RECORDS
+
+manifest_select = "SELECT path, size, mtime, content_hash, songplay_id_min, songplay_id_max FROM etl_manifest"
+
+manifest_upsert = ("""INSERT INTO etl_manifest \
+                  (path, size, mtime, content_hash, songplay_id_min, songplay_id_max, loaded_at) \
+                  VALUES (%s, %s, %s, %s, %s, %s, now()) ON CONFLICT (path) \
+                  DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime, content_hash=EXCLUDED.content_hash, \
+                  songplay_id_min=EXCLUDED.songplay_id_min, songplay_id_max=EXCLUDED.songplay_id_max, \
+                  loaded_at=EXCLUDED.loaded_at""")
+
+manifest_touch = "UPDATE etl_manifest SET mtime = %s WHERE path = %s"
+
+# last songplay_id handed out by the serial sequence, read before and after a file is loaded. Unlike
+# max(songplay_id) it does not need an index on songplays, which may not exist yet during a bulk load.
+
+songplay_last_id = "SELECT coalesce(pg_sequence_last_value(pg_get_serial_sequence('songplays', 'songplay_id')), 0)"
+
+songplay_range_delete = "DELETE FROM songplays WHERE songplay_id BETWEEN %s AND %s"
+
+# SAVEPOINTS
+
+# every file is loaded inside its own savepoint, a file that fails is rolled back without losing the others
+
+file_savepoint = "SAVEPOINT etl_file"
+file_savepoint_release = "RELEASE SAVEPOINT etl_file"
+file_savepoint_rollback = "ROLLBACK TO SAVEPOINT etl_file"
+
+# INDEXES
+
+# created together with the tables, or by create_tables.build_indexes after a bulk load. The primary key of
+# a partitioned table has to contain the partition key.
+
+songplay_primary_key_select = "SELECT count(*) FROM pg_constraint WHERE conrelid = 'songplays'::regclass AND contype = 'p'"
+
+songplay_primary_key_create = "ALTER TABLE songplays ADD PRIMARY KEY (songplay_id, start_time);"
+
+# song_select and the songplays lookup filter on title, duration and artist name: one probe in each index,
+# the INCLUDE columns answer the query without reading the songs heap
+
+song_lookup_index_create = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration) INCLUDE (artist_id, song_id);"
+
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name, artist_id);"
+
+# analytics: plays over time, per user and per song or artist
+
+songplay_start_time_index_create = "CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays (start_time);"
+
+songplay_user_index_create = "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id, start_time);"
+
+songplay_song_index_create = "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id) WHERE song_id IS NOT NULL;"
+
+songplay_artist_index_create = "CREATE INDEX IF NOT EXISTS songplays_artist_id_idx ON songplays (artist_id) WHERE artist_id IS NOT NULL;"
+
+analyze_tables = "ANALYZE;"
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
+staging_table_queries = [time_staging_create, user_staging_create, songplay_staging_create]
+index_queries = [song_lookup_index_create, artist_name_index_create, songplay_start_time_index_create,
+                 songplay_user_index_create, songplay_song_index_create, songplay_artist_index_create]
+bulk_create_table_queries = [songplay_table_partitioned_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create]
 
@@ -0,0 +1,182 @@
+import json
+import shutil
+import tempfile
+
+import psycopg2
+import pytest
+
+import etl
+from create_tables import create_database, drop_tables, create_tables
+from generate_data import generate
+from manifest import Manifest
+
+# the tests reload sparkifydb, like create_tables.py and benchmark.py
+try:
+    psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student").close()
+except psycopg2.OperationalError:
+    pytest.skip('no Postgres server for sparkifydb', allow_module_level=True)
+
+TABLE_SELECTS = {'songs': 'SELECT song_id, title, artist_id, year, duration FROM songs',
+                 'artists': 'SELECT artist_id, name, location, latitude, longitude FROM artists',
+                 'users': 'SELECT user_id, first_name, last_name, gender, level FROM users',
+                 'songplays': 'SELECT start_time, user_id, level, song_id, artist_id, session_id, location, '
+                              'user_agent FROM songplays'}
+
+
+@pytest.fixture(scope='module')
+def data_dir():
+    directory = tempfile.mkdtemp(prefix='sparkify-test-')
+    generate(directory, songs=200, artists=100, users=20, days=3, events_per_day=300, match_fraction=0.8)
+    yield directory
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def load(data_dir, options):
+    """
+    Description: This function is used to load a data set into a fresh sparkifydb with options of etl.py.
+
+    Returns:
+        dict with the sorted rows of every table of TABLE_SELECTS, as text so NaN compares equal.
+    """
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    etl.run_etl(cur, conn, etl.parse_args(options), song_path=data_dir + '/song_data',
+                log_path=data_dir + '/log_data')
+    tables = {}
+    for table, query in TABLE_SELECTS.items():
+        cur.execute(query)
+        tables[table] = sorted(tuple(str(value) for value in row) for row in cur.fetchall())
+    conn.close()
+    return tables
+
+
+def test_readers_parse_durations_and_lengths_alike(tmp_path):
+    # pandas parses 438.43947 as 438.43947000000003 unless precise_float is set
+    song = {'num_songs': 1, 'song_id': 'SOTEST', 'title': 'Song', 'artist_id': 'ARTEST', 'year': 2000,
+            'duration': 438.43947, 'artist_name': 'Artist', 'artist_location': '', 'artist_latitude': None,
+            'artist_longitude': None}
+    event = {'song': 'Song', 'artist': 'Artist', 'length': 438.43947, 'page': 'NextSong', 'ts': 1541000000000,
+             'userId': '1', 'firstName': 'First', 'lastName': 'Last', 'gender': 'F', 'level': 'free'}
+    (tmp_path / 'song.json').write_text(json.dumps(song))
+    (tmp_path / 'events.json').write_text(json.dumps(event) + '\n')
+
+    song_data, artist_data = etl.read_song_file(str(tmp_path / 'song.json'))
+    batch = etl.read_song_batch([str(tmp_path / 'song.json')])
+    df, _, _ = etl.read_log_file(str(tmp_path / 'events.json'))
+    assert song_data[4] == batch['duration'][0] == df['length'].iloc[0] == 438.43947
+    assert artist_data[3:] == [batch['artist_latitude'][0], batch['artist_longitude'][0]] == [None, None]
+
+
+def test_batch_and_row_by_row_load_the_same_rows(data_dir):
+    batch = load(data_dir, [])
+    row_by_row = load(data_dir, ['--row-by-row'])
+    for table in TABLE_SELECTS:
+        assert batch[table] == row_by_row[table], table
+    # 80% of the generated plays refer to a song, they have to be matched by both paths
+    assert sum(1 for row in batch['songplays'] if row[3] != 'None') > 0.7 * len(batch['songplays'])
+
+
+def write_user_plays(directory, days):
+    """
+    Description: This function is used to write a song file and one log file per day of plays of user 7.
+
+    Arguments:
+        directory: directory receiving song_data and log_data.
+        days: dict of the date of every log file to the list of the user fields of its events.
+
+    Returns:
+        None
+    """
+    song = {'num_songs': 1, 'song_id': 'SOTEST', 'title': 'Song', 'artist_id': 'ARTEST', 'year': 2000,
+            'duration': 200.5, 'artist_name': 'Artist', 'artist_location': '', 'artist_latitude': None,
+            'artist_longitude': None}
+    (directory / 'song_data').mkdir()
+    (directory / 'song_data' / 'song.json').write_text(json.dumps(song))
+    (directory / 'log_data').mkdir()
+    for day, (date, users) in enumerate(sorted(days.items())):
+        events = []
+        for i, user in enumerate(users):
+            event = {'song': 'Song', 'artist': 'Artist', 'length': 200.5, 'page': 'NextSong',
+                     'ts': 1541030400000 + 86400000 * day + 1000 * i, 'userId': '7', 'firstName': 'First',
+                     'lastName': 'Last', 'gender': 'F', 'level': 'free', 'sessionId': day, 'location': 'Here',
+                     'userAgent': 'Agent'}
+            event.update(user)
+            events.append(event)
+        (directory / 'log_data' / (date + '-events.json')).write_text(
+            ''.join(json.dumps(event) + '\n' for event in events))
+
+
+def run_days(cur, conn, directory, options, later_days):
+    """
+    Description: This function is used to load the log files of write_user_plays in two runs, the files of
+    later_days only in the second one, so the second run sees the user already written.
+
+    Returns:
+        None
+    """
+    for date in later_days:
+        (directory / 'log_data' / (date + '-events.json')).rename(directory / (date + '.json'))
+    etl.run_etl(cur, conn, etl.parse_args(options), song_path=str(directory / 'song_data'),
+                log_path=str(directory / 'log_data'))
+    for date in later_days:
+        (directory / (date + '.json')).rename(directory / 'log_data' / (date + '-events.json'))
+    etl.run_etl(cur, conn, etl.parse_args(options), song_path=str(directory / 'song_data'),
+                log_path=str(directory / 'log_data'))
+
+
+@pytest.mark.parametrize('options', [[], ['--row-by-row']])
+def test_user_level_change_is_written(tmp_path, options):
+    # user 7 listens on the free level, then upgrades: in the middle of a file and again in the next one
+    days = {'2018-11-01': ['free', 'free', 'paid'], '2018-11-02': ['paid', 'free', 'paid']}
+    write_user_plays(tmp_path, {date: [{'level': level} for level in levels] for date, levels in days.items()})
+
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    run_days(cur, conn, tmp_path, options, ['2018-11-02'])
+    cur.execute('SELECT level FROM users WHERE user_id = 7')
+    assert cur.fetchall() == [('paid',)]
+    cur.execute('SELECT level FROM songplays ORDER BY start_time')
+    assert [row[0] for row in cur.fetchall()] == days['2018-11-01'] + days['2018-11-02']
+    conn.close()
+
+
+@pytest.mark.parametrize('options', [[], ['--row-by-row']])
+def test_user_last_name_change_is_written(tmp_path, options):
+    # the level stays the same, the dimension cache must not take the renamed user for a duplicate; the
+    # changes are in one file, the log files are not loaded in date order
+    write_user_plays(tmp_path, {'2018-11-01': [{}, {}, {'lastName': 'Married'},
+                                               {'lastName': 'Married', 'gender': 'M'}]})
+
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    run_days(cur, conn, tmp_path, options, [])
+    cur.execute('SELECT first_name, last_name, gender, level FROM users WHERE user_id = 7')
+    assert cur.fetchall() == [('First', 'Married', 'M', 'free')]
+    conn.close()
+
+
+@pytest.mark.parametrize('options', [[], ['--row-by-row']])
+def test_rolled_back_song_file_leaves_the_song_index(tmp_path, monkeypatch, options):
+    # the song is inserted, then recording its file fails and the savepoint of the file is rolled back
+    write_user_plays(tmp_path, {'2018-11-01': [{}]})
+    finish = Manifest.finish
+
+    def failing_finish(self, cur, path):
+        if path.endswith('song.json'):
+            raise RuntimeError('manifest write failed')
+        return finish(self, cur, path)
+
+    monkeypatch.setattr(Manifest, 'finish', failing_finish)
+    cur, conn = create_database()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    etl.run_etl(cur, conn, etl.parse_args(options), song_path=str(tmp_path / 'song_data'),
+                log_path=str(tmp_path / 'log_data'))
+    cur.execute('SELECT count(*) FROM songs')
+    assert cur.fetchall() == [(0,)]
+    cur.execute('SELECT song_id, artist_id FROM songplays')
+    assert cur.fetchall() == [(None, None)]
+    conn.close()
@@ -0,0 +1,270 @@
+import re
+import time
+import hashlib
+import argparse
+from collections import Counter
+
+from sql_queries import (songplay_table_create, user_table_create, song_table_create, artist_table_create,
+                         time_table_create, create_table_queries, drop_table_queries, load_steps,
+                         analytic_queries, PARALLELISM, BACKEND)
+from backends import connect, execute
+from scheduler import run_steps
+from compact import cluster_slices
+
+FINAL_TABLES = {'fact_songplays': songplay_table_create,
+                'dim_users': user_table_create,
+                'dim_songs': song_table_create,
+                'dim_artists': artist_table_create,
+                'dim_time': time_table_create}
+
+# staging column each candidate key is loaded from, with the rows of staging it comes from. The song of a play
+# is profiled by its title, song_id is only known once the play is matched.
+SOURCES = {('fact_songplays', 'start_time'): ('staging_events', 'ts', "page = 'NextSong'"),
+           ('fact_songplays', 'user_id'): ('staging_events', 'userId', "page = 'NextSong'"),
+           ('fact_songplays', 'song_id'): ('staging_events', 'song', "page = 'NextSong'"),
+           ('fact_songplays', 'artist_id'): ('staging_events', 'artist', "page = 'NextSong'"),
+           ('fact_songplays', 'session_id'): ('staging_events', 'sessionId', "page = 'NextSong'"),
+           ('dim_users', 'user_id'): ('staging_events', 'userId', 'userId IS NOT NULL'),
+           ('dim_songs', 'song_id'): ('staging_songs', 'song_id', 'song_id IS NOT NULL'),
+           ('dim_songs', 'artist_id'): ('staging_songs', 'artist_id', 'song_id IS NOT NULL'),
+           ('dim_artists', 'artist_id'): ('staging_songs', 'artist_id', 'artist_id IS NOT NULL'),
+           ('dim_time', 'start_time'): ('staging_events', 'ts', 'ts IS NOT NULL')}
+
+# dimensions up to this many rows are copied to every node, above it they are distributed on their join key
+ALL_MAX_ROWS = 1000000
+# largest acceptable ratio between the rows of the fullest slice and the average slice for a distkey
+MAX_SLICE_SKEW = 1.5
+
+VALUE_COUNTS = "SELECT {column}, count(*) FROM {table} WHERE {where} GROUP BY 1;"
+
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|USING)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+EQUALITY = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+RANGE = re.compile(r'\b(\w+)\.(\w+)\s*(?:>=|<=|>|<|BETWEEN\b)', re.IGNORECASE)
+NOT_ALIASES = {'on', 'where', 'join', 'left', 'right', 'inner', 'full', 'group', 'order', 'limit', 'using'}
+
+COLUMN_KEYS = re.compile(r'\s+(sortkey|distkey)\b', re.IGNORECASE)
+STATEMENT_END = re.compile(r'\)\s*;\s*$')
+
+
+def aliases(query):
+    """
+    Function to map the aliases of a query, and the table names themselves, to their table
+    """
+    names = {}
+    for table, alias in TABLE_REFERENCE.findall(query):
+        names[table.lower()] = table.lower()
+        if alias and alias.lower() not in NOT_ALIASES:
+            names[alias.lower()] = table.lower()
+    return names
+
+
+def query_keys(queries):
+    """
+    Function to find the equality joins and the range filters of a set of queries. Returns a Counter of
+    ((table, column), (table, column)) joins and a Counter of (table, column) range filters. Columns of
+    subqueries, whose alias is no table, are left out.
+    """
+    joins, ranges = Counter(), Counter()
+    for query in queries:
+        names = aliases(query)
+        for left_alias, left_column, right_alias, right_column in EQUALITY.findall(query):
+            left, right = names.get(left_alias.lower()), names.get(right_alias.lower())
+            if left and right and left != right:
+                joins[tuple(sorted([(left, left_column.lower()), (right, right_column.lower())]))] += 1
+        for alias, column in RANGE.findall(query):
+            if alias.lower() in names:
+                ranges[(names[alias.lower()], column.lower())] += 1
+    return joins, ranges
+
+
+def load_statements(steps):
+    """
+    Function to list the statements run by the load steps of scheduler.py, step after step
+    """
+    return [query for queries, _ in steps.values() for query in queries]
+
+
+def slice_of(value, slices):
+    """
+    Function to place a value on a slice the way a distkey would, every NULL lands on the same slice
+    """
+    if value is None:
+        return 0
+    return int(hashlib.md5(str(value).encode()).hexdigest(), 16) % slices
+
+
+def profile_column(cur, table, column, where, slices):
+    """
+    Function to compute the rows, cardinality, NULL fraction, share of the most frequent value and
+    slice skew of a staging column
+    """
+    execute(cur, VALUE_COUNTS.format(column=column, table=table, where=where))
+    counts = cur.fetchall()
+    rows = sum(count for _, count in counts)
+    per_slice = [0] * slices
+    for value, count in counts:
+        per_slice[slice_of(value, slices)] += count
+    return {'rows': rows,
+            'distinct': sum(1 for value, _ in counts if value is not None),
+            'null_fraction': sum(count for value, count in counts if value is None) / rows if rows else 0,
+            'top_share': max((count for _, count in counts), default=0) / rows if rows else 0,
+            'slice_skew': max(per_slice) / (rows / slices) if rows else 0}
+
+
+def profile(cur, slices):
+    """
+    Function to profile the staging column behind every candidate key
+    """
+    return {key: profile_column(cur, table, column, where, slices)
+            for key, (table, column, where) in SOURCES.items()}
+
+
+def recommend(stats, joins, ranges, slices):
+    """
+    Function to choose the distribution style, distkey and sortkey of every final table. Small dimensions
+    are copied to every node. The fact table and the large dimensions share the distkey of their most
+    joined large dimension when that key spreads evenly over the slices. The sortkey is the column most
+    filtered on a range, else the most joined one.
+    """
+    def usable(key):
+        return (key in stats and stats[key]['slice_skew'] <= MAX_SLICE_SKEW
+                and stats[key]['distinct'] >= 10 * slices)
+
+    table_rows = {table: max(stats[key]['distinct'] if table != 'fact_songplays' else stats[key]['rows']
+                             for key in SOURCES if key[0] == table)
+                  for table in FINAL_TABLES}
+    layouts = {}
+    for table in FINAL_TABLES:
+        if table != 'fact_songplays' and table_rows[table] <= ALL_MAX_ROWS:
+            layouts[table] = {'diststyle': 'all', 'distkey': None}
+        else:
+            layouts[table] = {'diststyle': 'even', 'distkey': None}
+
+    # joins of the fact table to the dimensions not copied everywhere, largest dimension first
+    fact_joins = []
+    for (left, right), count in joins.items():
+        for (table, column), (other, other_column) in [(left, right), (right, left)]:
+            if table == 'fact_songplays' and other in FINAL_TABLES and layouts[other]['diststyle'] != 'all':
+                fact_joins.append((table_rows[other], count, column, other, other_column))
+    for _, _, column, other, other_column in sorted(fact_joins, reverse=True):
+        if usable(('fact_songplays', column)) and usable((other, other_column)):
+            layouts['fact_songplays'] = {'diststyle': 'key', 'distkey': column}
+            layouts[other] = {'diststyle': 'key', 'distkey': other_column}
+            break
+
+    joined = Counter()
+    for (left, right), count in joins.items():
+        joined[left] += count
+        joined[right] += count
+    for table, layout in layouts.items():
+        filtered = sorted(((count, column) for (t, column), count in ranges.items() if t == table), reverse=True)
+        used = sorted(((count, column) for (t, column), count in joined.items() if t == table), reverse=True)
+        layout['sortkey'] = (filtered or used or [(0, None)])[0][1]
+        layout['rows'] = table_rows[table]
+    return layouts
+
+
+def variant_ddl(query, diststyle, distkey=None, sortkey=None):
+    """
+    Function to rewrite a CREATE TABLE of sql_queries.py with other distribution and sort keys
+    """
+    attributes = ' DISTSTYLE {}'.format(diststyle.upper())
+    if distkey:
+        attributes += ' DISTKEY({})'.format(distkey)
+    if sortkey:
+        attributes += ' SORTKEY({})'.format(sortkey)
+    return STATEMENT_END.sub(')' + attributes + ';', COLUMN_KEYS.sub('', query).rstrip())
+
+
+def variants(layouts):
+    """
+    Function to build the CREATE TABLE variants compared by the benchmark, each one mapping the current
+    CREATE TABLE of a final table to its replacement
+    """
+    return {'advised': {FINAL_TABLES[table]: variant_ddl(FINAL_TABLES[table], layout['diststyle'],
+                                                         layout['distkey'], layout['sortkey'])
+                        for table, layout in layouts.items()},
+            'even': {FINAL_TABLES[table]: variant_ddl(FINAL_TABLES[table], 'even') for table in FINAL_TABLES},
+            'current': {}}
+
+
+def run_variant(ddl, repeat):
+    """
+    Function to recreate the tables with a variant, load them and time the analytic queries, the best
+    of repeat runs each
+    """
+    conn = connect()
+    cur = conn.cursor()
+    for query in drop_table_queries:
+        execute(cur, query)
+    for query in create_table_queries:
+        execute(cur, ddl.get(query, query))
+    conn.commit()
+
+    start = time.time()
+    run_steps(load_steps, connect, PARALLELISM)
+    timings = {'load': time.time() - start}
+    for name, query in analytic_queries.items():
+        best = None
+        for _ in range(repeat):
+            query_start = time.time()
+            execute(cur, query)
+            cur.fetchall()
+            best = min(best or float('inf'), time.time() - query_start)
+        timings[name] = best
+    conn.commit()
+    conn.close()
+    return timings
+
+
+def print_profile(stats):
+    print("{:<28} {:>10} {:>10} {:>7} {:>7} {:>7}".format('key', 'rows', 'distinct', 'nulls', 'top', 'skew'))
+    for (table, column), s in stats.items():
+        print("{:<28} {:>10} {:>10} {:>6.1%} {:>6.1%} {:>7.2f}".format(
+            table + '.' + column, s['rows'], s['distinct'], s['null_fraction'], s['top_share'], s['slice_skew']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recommend distribution and sort keys from the loaded staging '
+                                                 'tables and the joins of the load and analytic queries.')
+    parser.add_argument('--slices', type=int, default=None,
+                        help='slices of the cluster, by default the ones of the [DWH] cluster')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='reload the warehouse with the advised, even and current layouts and time the load '
+                             'and the analytic queries, the current layout is loaded last')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every analytic query, the best is kept')
+    args = parser.parse_args()
+    slices = args.slices or cluster_slices()
+
+    conn = connect()
+    cur = conn.cursor()
+    stats = profile(cur, slices)
+    conn.close()
+    print("Staging profile over {} slices".format(slices))
+    print_profile(stats)
+
+    joins, ranges = query_keys(load_statements(load_steps) + list(analytic_queries.values()))
+    print("\nJoins")
+    for ((left, left_column), (right, right_column)), count in joins.most_common():
+        print("    {}.{} = {}.{} ({}x)".format(left, left_column, right, right_column, count))
+
+    layouts = recommend(stats, joins, ranges, slices)
+    ddl = variants(layouts)
+    print("\nAdvised layout")
+    for table, layout in layouts.items():
+        print("    {:<16} {:>10} rows  diststyle {:<5} distkey {:<12} sortkey {}".format(
+            table, layout['rows'], layout['diststyle'], layout['distkey'] or '-', layout['sortkey'] or '-'))
+    for table in FINAL_TABLES:
+        print("\n" + ddl['advised'][FINAL_TABLES[table]])
+
+    if args.benchmark:
+        if BACKEND != 'redshift':
+            print("\nThe {} backend ignores distribution and sort keys, the timings only compare noise".format(BACKEND))
+        results = {name: run_variant(variant, args.repeat) for name, variant in ddl.items()}
+        print("\n{:<24}".format('') + "".join("{:>12}".format(name) for name in results))
+        for measure in ['load'] + list(analytic_queries):
+            print("{:<24}".format(measure) + "".join("{:>11.3f}s".format(results[name][measure]) for name in results))
+
+
+if __name__ == "__main__":
+    main()
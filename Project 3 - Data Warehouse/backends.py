@@ -0,0 +1,320 @@
+import io
+import os
+import re
+import csv
+import gzip
+import json
+import threading
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from sql_queries import config, BACKEND, staging_events_table_create, staging_songs_table_create
+
+if BACKEND == 'duckdb':
+    import duckdb
+    DB_ERRORS = (psycopg2.Error, duckdb.Error)
+else:
+    DB_ERRORS = (psycopg2.Error,)
+
+# [LOCAL] options giving the JSON files COPY would read from S3 per staging table: a directory, and the
+# local manifest of compact.py used instead by the COPY ... MANIFEST statements
+LOCAL_SOURCES = {'staging_events': ('LOG_DATA', 'LOG_MANIFEST'), 'staging_songs': ('SONG_DATA', 'SONG_MANIFEST')}
+
+S3_COPY = re.compile(r"^\s*COPY\s+(\w+)\s*(?:\([^)]*\))?\s*FROM\s+'s3://", re.IGNORECASE)
+MANIFEST_COPY = re.compile(r"\bMANIFEST\s*;?\s*$", re.IGNORECASE)
+
+# Redshift only syntax and its equivalent on the local backends. Redshift does not enforce primary and foreign
+# keys, they are dropped so the local backends accept the same rows as the cluster.
+LOCAL_REWRITES = [
+    (re.compile(r'\s+(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\s+distkey\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\s+diststyle\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\s+encode\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\s+(sortkey|distkey)\b', re.IGNORECASE), ''),
+    (re.compile(r'\s+REFERENCES\s+\w+\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\s+PRIMARY KEY\b(?!\s*\()', re.IGNORECASE), ''),
+    (re.compile(r'extract\s*\(\s*weekday\s+from', re.IGNORECASE), 'extract(dow from'),
+    (re.compile(r'getdate\(\)', re.IGNORECASE), 'now()'),
+]
+
+IDENTITY = re.compile(r'IDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)', re.IGNORECASE)
+
+POSTGRES_REWRITES = [
+    (IDENTITY, r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)'),
+] + LOCAL_REWRITES + [
+    (re.compile(r'\bfnv_hash\s*\(', re.IGNORECASE), 'hashtextextended('),
+]
+
+# DuckDB has no identity columns, the CREATE TABLE gets a sequence instead (see to_duckdb), and FNV_HASH is
+# replaced by a macro over the 64-bit hash of DuckDB, shifted to the signed range of a BIGINT
+DUCKDB_MACROS = ["CREATE OR REPLACE MACRO fnv_hash(value, seed) AS "
+                 "(hash(value, seed)::HUGEINT - 9223372036854775808)::BIGINT;"]
+
+CREATE_TABLE = re.compile(r'^\s*CREATE TABLE\s+(?:IF NOT EXISTS\s+)?(\w+)', re.IGNORECASE)
+DROP_TABLE = re.compile(r'^\s*DROP TABLE\s+(?:IF EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+# lengths of the staging varchar columns, DuckDB does not keep them and Redshift gives 256 to a bare varchar
+VARCHAR = re.compile(r'^\s*\(?\s*(\w+)\s+varchar(?:\s*\(\s*(\d+)\s*\))?', re.IGNORECASE | re.MULTILINE)
+STAGING_VARCHARS = {table: {name.lower(): int(length or 256) for name, length in VARCHAR.findall(query)}
+                    for table, query in [('staging_events', staging_events_table_create),
+                                         ('staging_songs', staging_songs_table_create)]}
+
+_duckdb_database = None
+_duckdb_lock = threading.Lock()
+
+
+class DuckDBConnection:
+    """
+    Connection to the DuckDB database of the [LOCAL] section behaving like a psycopg2 connection: the
+    statements run in a transaction opened by the first of them and ended by commit or rollback
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+        self.in_transaction = False
+
+    def cursor(self):
+        return DuckDBCursor(self)
+
+    def execute(self, query, params=None):
+        if not self.in_transaction:
+            self._handle.execute('BEGIN TRANSACTION')
+            self.in_transaction = True
+        return self._handle.execute(query.replace('%s', '?'), params)
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self._handle.execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self._handle.execute('ROLLBACK')
+
+    def close(self):
+        self.rollback()
+        self._handle.close()
+
+
+class DuckDBCursor:
+    """
+    Cursor of a DuckDBConnection, the rows affected by an INSERT, UPDATE or DELETE are in rowcount
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = -1
+        self.description = None
+        self._rows = []
+
+    def execute(self, query, params=None):
+        result = self.conn.execute(query, params)
+        self.description = result.description
+        self._rows = result.fetchall() if result.description else []
+        self.rowcount = -1
+        if self.description and [column[0] for column in self.description] == ['Count']:
+            self.rowcount = self._rows[0][0] if self._rows else -1
+            self.description, self._rows = None, []
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+def connect():
+    """
+    Function to connect to the cluster, or to the local Postgres stand-in or DuckDB database when BACKEND
+    is postgres or duckdb
+    """
+    if BACKEND == 'duckdb':
+        return connect_duckdb()
+    section = config['LOCAL'] if BACKEND == 'postgres' else config['CLUSTER']
+    return psycopg2.connect("host={} dbname={} user={} password={} port={}".format(
+        section['HOST'], section['DB_NAME'], section['DB_USER'], section['DB_PASSWORD'], section['DB_PORT']))
+
+
+def connect_duckdb():
+    """
+    Function to open a connection to the DuckDB database file, all the connections of the process share it
+    """
+    global _duckdb_database
+    with _duckdb_lock:
+        if _duckdb_database is None:
+            _duckdb_database = duckdb.connect(config.get('LOCAL', 'DUCKDB_DATABASE'))
+            for macro in DUCKDB_MACROS:
+                _duckdb_database.execute(macro)
+        return DuckDBConnection(_duckdb_database.cursor())
+
+
+def to_postgres(query):
+    """
+    Function to rewrite the Redshift specific parts of a query for Postgres
+    """
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def to_duckdb(query):
+    """
+    Function to rewrite the Redshift specific parts of a query for DuckDB, an IDENTITY column becomes the
+    default value of a sequence created with the table and dropped after it
+    """
+    create = CREATE_TABLE.match(query)
+    identity = IDENTITY.search(query)
+    if create and identity:
+        sequence = create.group(1) + '_identity'
+        query = "CREATE SEQUENCE IF NOT EXISTS {0} START WITH {1} INCREMENT BY {2} MINVALUE {1};\n{3}".format(
+            sequence, identity.group(1), identity.group(2),
+            IDENTITY.sub("DEFAULT nextval('{}')".format(sequence), query))
+    drop = DROP_TABLE.match(query)
+    if drop:
+        query += "\nDROP SEQUENCE IF EXISTS {}_identity;".format(drop.group(1))
+    for pattern, replacement in LOCAL_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def execute(cur, query, params=None):
+    """
+    Function to run a query of sql_queries.py on the configured backend. On the local backends
+    the S3 COPY statements load the staging table from the local JSON files instead.
+    """
+    if BACKEND == 'redshift':
+        cur.execute(query, params)
+        return
+    match = S3_COPY.match(query)
+    if match:
+        table = match.group(1).lower()
+        data, manifest = LOCAL_SOURCES[table]
+        if MANIFEST_COPY.search(query):
+            filepaths = manifest_files(config.get('LOCAL', manifest))
+        else:
+            filepaths = find_json_files(config.get('LOCAL', data))
+        if BACKEND == 'duckdb':
+            copy_duckdb_json(cur, table, filepaths)
+        else:
+            copy_local_json(cur, table, filepaths)
+    elif BACKEND == 'duckdb':
+        cur.execute(to_duckdb(query), params)
+    else:
+        cur.execute(to_postgres(query), params)
+
+
+def find_json_files(path):
+    """
+    Function to list the JSON files below a directory, in a stable order
+    """
+    all_files = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        all_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.json'))
+    return all_files
+
+
+def manifest_files(manifest):
+    """
+    Function to list the files of a COPY manifest, the local parts written by compact.py
+    """
+    with open(manifest) as f:
+        return [entry['url'] for entry in json.load(f)['entries']]
+
+
+def read_json_records(filepaths):
+    """
+    Function to read the records of JSON files, one per line like the S3 objects, gzip files included
+    """
+    for filepath in filepaths:
+        opener = gzip.open if filepath.endswith('.gz') else open
+        with opener(filepath, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def staging_columns(cur, table):
+    """
+    Function to get the name, type and maximum length of every column of a staging table
+    """
+    cur.execute("""SELECT column_name, data_type, character_maximum_length FROM information_schema.columns
+                   WHERE table_name = %s ORDER BY ordinal_position""", (table,))
+    return cur.fetchall()
+
+
+def copy_value(value, data_type, max_length):
+    """
+    Function to convert a JSON value the way the Redshift COPY options of sql_queries.py do:
+    epoch milliseconds for timestamps, BLANKSASNULL EMPTYASNULL and TRUNCATECOLUMNS
+    """
+    if value is None:
+        return None
+    if data_type.startswith('timestamp') and isinstance(value, (int, float)):
+        return (datetime(1970, 1, 1) + timedelta(milliseconds=value)).isoformat(sep=' ')
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        if max_length is not None:
+            return value[:max_length]
+    return value
+
+
+def copy_local_json(cur, table, filepaths):
+    """
+    Function to load a staging table from local JSON files with COPY FROM STDIN. Like
+    COPY ... JSON 'auto' the JSON keys are matched to the column names ignoring case.
+    """
+    columns = staging_columns(cur, table)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in read_json_records(filepaths):
+        record = {key.lower(): value for key, value in record.items()}
+        row = [copy_value(record.get(name), data_type, max_length) for name, data_type, max_length in columns]
+        writer.writerow(['\\N' if value is None else value for value in row])
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+        table, ', '.join(name for name, _, _ in columns)), buffer)
+
+
+def duckdb_value(column, json_type, data_type, max_length):
+    """
+    Function to convert a column read by read_json the way the Redshift COPY options of sql_queries.py do
+    """
+    if data_type.startswith('TIMESTAMP') and json_type in ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT',
+                                                           'UBIGINT', 'DOUBLE'):
+        return 'epoch_ms(CAST("{}" AS BIGINT))'.format(column)
+    if data_type == 'VARCHAR':
+        return "CASE WHEN trim(CAST(\"{0}\" AS VARCHAR)) = '' THEN NULL ELSE left(CAST(\"{0}\" AS VARCHAR), {1}) END".format(
+            column, max_length)
+    return 'TRY_CAST("{}" AS {})'.format(column, data_type)
+
+
+def copy_duckdb_json(cur, table, filepaths):
+    """
+    Function to load a staging table straight from the local JSON files with the read_json of DuckDB,
+    gzip parts included. Like COPY ... JSON 'auto' the JSON keys are matched to the column names ignoring
+    case, the columns without key are left NULL.
+    """
+    if not filepaths:
+        return
+    source = "read_json([{}], format='newline_delimited', union_by_name=true, sample_size=-1)".format(
+        ', '.join("'{}'".format(filepath.replace("'", "''")) for filepath in filepaths))
+    cur.execute("DESCRIBE SELECT * FROM " + source)
+    json_columns = {row[0].lower(): (row[0], row[1]) for row in cur.fetchall()}
+    columns = staging_columns(cur, table)
+    values = []
+    for name, data_type, _ in columns:
+        if name.lower() in json_columns:
+            values.append(duckdb_value(*json_columns[name.lower()], data_type,
+                                       STAGING_VARCHARS[table].get(name.lower(), 256)))
+        else:
+            values.append('NULL')
+    cur.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+        table, ', '.join(name for name, _, _ in columns), ', '.join(values), source))
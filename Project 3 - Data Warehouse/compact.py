@@ -0,0 +1,101 @@
+import os
+import gzip
+import json
+import heapq
+import argparse
+
+from sql_queries import config
+from backends import find_json_files, read_json_records, manifest_files
+
+# slices per node of the Redshift node types, the part count defaults to one part per slice
+SLICES_PER_NODE = {'dc2.large': 2, 'dc2.8xlarge': 16, 'ds2.xlarge': 2, 'ds2.8xlarge': 16,
+                   'ra3.xlplus': 2, 'ra3.4xlarge': 4, 'ra3.16xlarge': 16}
+
+
+def cluster_slices():
+    """
+    Function to compute the number of slices of the cluster described in the [DWH] section of dwh.cfg
+    """
+    nodes = config.getint('DWH', 'DWH_NUM_NODES', fallback=1)
+    if config.get('DWH', 'DWH_CLUSTER_TYPE', fallback='').strip() == 'single-node':
+        nodes = 1
+    return nodes * SLICES_PER_NODE.get(config.get('DWH', 'DWH_NODE_TYPE', fallback='').strip(), 2)
+
+
+def compact(source, output, parts, url_prefix=None, compresslevel=6):
+    """
+    Function to rewrite the JSON files below source as parts gzip files of about the same size, one
+    JSON record per line, and to write the COPY manifest listing them. Every record goes to the part
+    holding the fewest bytes so far. The manifest urls are url_prefix + the part name, by default the
+    local path of the part.
+    """
+    os.makedirs(output, exist_ok=True)
+    # parts of an earlier run with more parts would be uploaded with the new ones
+    for name in os.listdir(output):
+        if name.startswith('part-') and name.endswith('.json.gz'):
+            os.remove(os.path.join(output, name))
+    names = ['part-{:05d}.json.gz'.format(i) for i in range(parts)]
+    outputs = [gzip.open(os.path.join(output, name), 'wt', encoding='utf-8', compresslevel=compresslevel)
+               for name in names]
+    sizes = [(0, i) for i in range(parts)]
+    records = [0] * parts
+    files = 0
+    bytes_in = 0
+    try:
+        for filepath in find_json_files(source):
+            files += 1
+            bytes_in += os.path.getsize(filepath)
+            with open(filepath, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.dumps(json.loads(line)) + '\n'
+                    size, i = heapq.heappop(sizes)
+                    outputs[i].write(record)
+                    records[i] += 1
+                    heapq.heappush(sizes, (size + len(record), i))
+    finally:
+        for f in outputs:
+            f.close()
+
+    prefix = url_prefix if url_prefix is not None else os.path.abspath(output) + os.sep
+    entries = []
+    for name in names:
+        length = os.path.getsize(os.path.join(output, name))
+        entries.append({'url': prefix + name, 'mandatory': True, 'meta': {'content_length': length}})
+    manifest = output.rstrip(os.sep) + '.manifest'
+    with open(manifest, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+
+    return {'manifest': manifest, 'files': files, 'records': sum(records), 'bytes_in': bytes_in,
+            'bytes_out': sum(entry['meta']['content_length'] for entry in entries),
+            'part_records': records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact the local log and song JSON files into gzip parts '
+                                                 'and write the COPY manifests.')
+    parser.add_argument('--output', default='./compacted', help='directory receiving log_data and song_data parts')
+    parser.add_argument('--parts', type=int, default=None,
+                        help='number of parts per data set, by default the slices of the [DWH] cluster')
+    parser.add_argument('--url-prefix', default=None,
+                        help='S3 prefix the output directory is uploaded to (e.g. s3://bucket/sparkify/), '
+                             'by default the manifests list the local paths')
+    args = parser.parse_args()
+
+    parts = args.parts or cluster_slices()
+    for name in ['LOG_DATA', 'SONG_DATA']:
+        data_set = name.lower()
+        prefix = args.url_prefix + data_set + '/' if args.url_prefix else None
+        stats = compact(config.get('LOCAL', name), os.path.join(args.output, data_set), parts, prefix)
+        print("{}: {} files, {} records, {} bytes -> {} parts, {} bytes, {} to {} records per part".format(
+            data_set, stats['files'], stats['records'], stats['bytes_in'], parts, stats['bytes_out'],
+            min(stats['part_records']), max(stats['part_records'])))
+        print("Manifest written to {}".format(stats['manifest']))
+        if args.url_prefix is None:
+            read_back = sum(1 for _ in read_json_records(manifest_files(stats['manifest'])))
+            print("Records read back from the parts: {}".format(read_back))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
-import configparser
-import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
+from backends import connect, execute, DB_ERRORS
 
 def drop_tables(cur, conn):
     """
@@ -8,10 +7,10 @@ def drop_tables(cur, conn):
     """
     for idx, query in enumerate(drop_table_queries):
         try:
-            cur.execute(query)
+            execute(cur, query)
             conn.commit()
             print("Success Dropping Table {}".format(idx))
-        except psycopg2.Error as e:
+        except DB_ERRORS as e:
             print("Error Dropping Table {}".format(idx))
             print (e)
 
@@ -21,19 +20,16 @@ def create_tables(cur, conn):
     """
     for idx, query in enumerate(create_table_queries):
         try:
-            cur.execute(query)
+            execute(cur, query)
             conn.commit()
             print("Success Creating Table {}".format(idx))
-        except psycopg2.Error as e:
+        except DB_ERRORS as e:
             print("Error Creating Table {}".format(idx))
             print (e)
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = connect()
     cur = conn.cursor()
 
     
@@ -1,37 +1,16 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
-
-
-def load_staging_tables(cur, conn):
-    """
-    Function to load staging tables
-    """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
-
-
-def insert_tables(cur, conn):
-    """
-    Function to create the final tables of the dimensional model
-    """
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+from sql_queries import load_steps, PARALLELISM, PROFILE
+from backends import connect
+from scheduler import run_steps, print_report
+from profiler import Profiler
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
-
-    conn.close()
+    # the steps run over up to PARALLELISM connections, see load_steps in sql_queries.py
+    profiler = Profiler() if PROFILE else None
+    if profiler is not None:
+        print("Run {} recorded in etl_run_history".format(profiler.run_id))
+    results = run_steps(load_steps, connect, PARALLELISM, profiler)
+    print_report(load_steps, results)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import re
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from sql_queries import run_history_insert, run_history_last_runs, run_history_select
+from backends import connect, execute
+
+# statements EXPLAIN accepts, COPY and TRUNCATE have no plan
+EXPLAINABLE = re.compile(r'^\s*(INSERT|DELETE|UPDATE|SELECT|WITH)\b', re.IGNORECASE)
+
+# Redshift join steps moving rows between nodes, a new one in a plan usually means a lost distkey join
+DATA_MOVEMENT = re.compile(r'DS_BCAST_INNER|DS_DIST_ALL_INNER|DS_DIST_BOTH|DS_DIST_INNER|DS_DIST_OUTER')
+
+# row estimates and costs, they change with the data without the plan changing (DuckDB writes ~123 rows)
+PLAN_NUMBERS = re.compile(r'\((cost|actual time)=[^)]*\)|\b(rows|width)=\d+|~[\d,.]+\s*rows?\b', re.IGNORECASE)
+
+# DuckDB draws its plans as boxes, the operator on the first line of each. With other row estimates it swaps
+# the sides of a join, moves filters and projections and renumbers the #N columns, so only its operators and
+# tables are compared.
+DUCKDB_BOX = re.compile('[\u2500-\u257f]')
+DUCKDB_TABLE = re.compile(r'\b\w+\.\w+\.(\w+)\b')
+DUCKDB_MOVABLE = {'PROJECTION', 'FILTER'}
+
+
+def split_statements(query):
+    """
+    Function to split an entry of the query lists into its statements
+    """
+    return [statement.strip() for statement in query.split(';') if statement.strip()]
+
+
+def explain(cur, statement):
+    """
+    Function to get the plan of a statement before it runs, None for statements without plan
+    """
+    if not EXPLAINABLE.match(statement):
+        return None
+    execute(cur, 'EXPLAIN ' + statement)
+    # Postgres and Redshift give one line of the plan per row, DuckDB the whole plan in the last column
+    return '\n'.join(row[-1] for row in cur.fetchall())[:65535]
+
+
+class Profiler:
+    """
+    Runs the load statements and records for every one of them its plan, wall time and rows affected
+    in etl_run_history, under one run_id per run of etl.py
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or datetime.utcnow().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+
+    def run(self, cur, conn, step, query):
+        """
+        Function to run one entry of the query lists, its statements in one transaction, and to
+        record them. The history is written even when a statement fails.
+        """
+        history = []
+        try:
+            for index, statement in enumerate(split_statements(query)):
+                plan = explain(cur, statement)
+                started_at = datetime.utcnow()
+                start = time.time()
+                try:
+                    execute(cur, statement)
+                except Exception as e:
+                    history.append([self.run_id, step, index, statement, plan, None, started_at,
+                                    time.time() - start, 'failed', str(e)[:1024]])
+                    raise
+                history.append([self.run_id, step, index, statement, plan, cur.rowcount, started_at,
+                                time.time() - start, 'ok', None])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            for row in history:
+                if row[8] == 'ok':
+                    row[8] = 'rolled back'
+            raise
+        finally:
+            for row in history:
+                execute(cur, run_history_insert, row)
+            conn.commit()
+
+
+def normalize_plan(plan):
+    """
+    Function to reduce a plan to what changes with the query, not with the data
+    """
+    plan = PLAN_NUMBERS.sub('', plan or '')
+    if DUCKDB_BOX.search(plan):
+        lines = plan.splitlines()
+        operators = {name.strip() for top, title in zip(lines, lines[1:]) if '\u250c' in top
+                     for name in title.split('\u2502') if name.strip()} - DUCKDB_MOVABLE
+        return ' '.join(sorted(operators)) + ' | ' + ' '.join(sorted(set(DUCKDB_TABLE.findall(plan))))
+    return ' '.join(plan.split())
+
+
+def compare_runs(cur, old_run, new_run, slower=1.5, min_seconds=1.0):
+    """
+    Function to print the statements of two runs side by side, flagging the ones that got slower
+    (by more than the factor slower and min_seconds), changed plan or started moving data between nodes
+    """
+    runs = []
+    for run_id in (old_run, new_run):
+        execute(cur, run_history_select, (run_id,))
+        runs.append({(step, index): (seconds, rows, plan, status)
+                     for step, index, seconds, rows, plan, status in cur.fetchall()})
+    old, new = runs
+    print("{:<16} {:>3} {:>10} {:>10} {:>10}  {}".format('step', '#', old_run[-6:], new_run[-6:], 'rows', 'notes'))
+    for key in sorted(set(old) | set(new)):
+        notes = []
+        if key not in old or key not in new:
+            notes.append('only in one run')
+        else:
+            if new[key][0] > old[key][0] * slower and new[key][0] - old[key][0] > min_seconds:
+                notes.append('slower')
+            if normalize_plan(new[key][2]) != normalize_plan(old[key][2]):
+                notes.append('plan changed')
+            moved = set(DATA_MOVEMENT.findall(new[key][2] or '')) - set(DATA_MOVEMENT.findall(old[key][2] or ''))
+            if moved:
+                notes.append('new data movement: ' + ', '.join(sorted(moved)))
+            if new[key][3] != 'ok':
+                notes.append(new[key][3])
+        print("{:<16} {:>3} {:>10} {:>10} {:>10}  {}".format(
+            key[0], key[1],
+            '{:.2f}s'.format(old[key][0]) if key in old else '-',
+            '{:.2f}s'.format(new[key][0]) if key in new else '-',
+            new[key][1] if key in new and new[key][1] is not None else '-',
+            ', '.join(notes)))
+
+
+def main():
+    """
+    Compare two runs of etl_run_history, by default the last two: python profiler.py [old_run new_run]
+    """
+    conn = connect()
+    cur = conn.cursor()
+    if len(sys.argv) == 3:
+        old_run, new_run = sys.argv[1:]
+    else:
+        execute(cur, run_history_last_runs)
+        run_ids = [row[0] for row in cur.fetchall()]
+        if len(run_ids) < 2:
+            print("etl_run_history holds {} run(s), two are needed".format(len(run_ids)))
+            return
+        new_run, old_run = run_ids
+    compare_runs(cur, old_run, new_run)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
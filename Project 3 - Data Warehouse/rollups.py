@@ -0,0 +1,110 @@
+import argparse
+from datetime import datetime
+
+from sql_queries import rollup_tables
+from backends import connect, execute
+
+# grains of the questions, from the finest. A rollup answers the grains equal to or coarser than its own.
+GRAINS = ['hour', 'day', 'week', 'month', 'year']
+
+# fact columns a question may group by, the ones without rollup are answered from fact_songplays
+FACT_COLUMNS = ['song_id', 'artist_id', 'level', 'location', 'user_id', 'session_id', 'user_agent']
+
+ROLLUP_SELECT = ("""SELECT date_trunc('{grain}', period) AS period, {column}, sum(plays) AS plays
+                 FROM {table}
+                 WHERE {where}
+                 GROUP BY 1, 2
+                 ORDER BY 1, 3 DESC, 2
+                 ;""")
+
+FACT_SELECT = ("""SELECT date_trunc('{grain}', start_time) AS period, {column}, count(*) AS plays
+               FROM fact_songplays
+               WHERE {where}
+               GROUP BY 1, 2
+               ORDER BY 1, 3 DESC, 2
+               ;""")
+
+
+def aligned(ts, grain):
+    """
+    Function to check that a bound of the question falls on the start of a period of the grain
+    """
+    if ts is None:
+        return True
+    if ts.minute or ts.second or ts.microsecond:
+        return False
+    return grain == 'hour' or ts.hour == 0
+
+
+def choose_rollup(column, grain, start=None, end=None):
+    """
+    Function to find the coarsest rollup able to answer plays by column per grain between start and end,
+    None when the question has to read fact_songplays
+    """
+    candidates = [(GRAINS.index(rollup_grain), table) for table, (rollup_grain, rollup_column) in rollup_tables.items()
+                  if rollup_column == column
+                  and GRAINS.index(rollup_grain) <= GRAINS.index(grain)
+                  and aligned(start, rollup_grain) and aligned(end, rollup_grain)]
+    return max(candidates)[1] if candidates else None
+
+
+def plays_query(column, grain='day', start=None, end=None):
+    """
+    Function to build the query counting the plays by column per grain, start included and end excluded.
+    Returns the query, its parameters and the table it reads.
+    """
+    if column not in FACT_COLUMNS:
+        raise ValueError("Unknown songplays column {}".format(column))
+    if grain not in GRAINS:
+        raise ValueError("Unknown grain {}, expected one of {}".format(grain, ", ".join(GRAINS)))
+    table = choose_rollup(column, grain, start, end)
+    time_column = 'start_time' if table is None else 'period'
+    conditions, params = ['1 = 1'], []
+    if start is not None:
+        conditions.append('{} >= %s'.format(time_column))
+        params.append(start)
+    if end is not None:
+        conditions.append('{} < %s'.format(time_column))
+        params.append(end)
+    where = ' AND '.join(conditions)
+    if table is None:
+        # the rollups count a missing level or location as 'unknown', so does the fallback
+        key = "coalesce({0}, 'unknown') AS {0}".format(column) if column in ('level', 'location') else column
+        return FACT_SELECT.format(grain=grain, column=key, where=where), params, 'fact_songplays'
+    return ROLLUP_SELECT.format(grain=grain, column=column, table=table, where=where), params, table
+
+
+def plays(cur, column, grain='day', start=None, end=None):
+    """
+    Function to count the plays by column per grain, from a rollup when the grain and bounds allow it
+    """
+    query, params, table = plays_query(column, grain, start, end)
+    execute(cur, query, params)
+    return table, cur.fetchall()
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the plays by a songplays column per period, '
+                                                 'reading a rollup table when possible.')
+    parser.add_argument('column', choices=FACT_COLUMNS)
+    parser.add_argument('grain', choices=GRAINS, nargs='?', default='day')
+    parser.add_argument('--start', type=parse_time, help='first period included, e.g. 2018-11-01')
+    parser.add_argument('--end', type=parse_time, help='first period excluded, e.g. 2018-12-01')
+    parser.add_argument('--limit', type=int, default=20, help='number of rows printed')
+    args = parser.parse_args()
+
+    conn = connect()
+    cur = conn.cursor()
+    table, rows = plays(cur, args.column, args.grain, args.start, args.end)
+    print("Read from {}, {} rows".format(table, len(rows)))
+    for period, key, count in rows[:args.limit]:
+        print("{}  {:<40} {:>8}".format(period, key, count))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from backends import execute
+
+
+class ConnectionPool:
+    """
+    Connections opened on demand, at most one per worker thread of the scheduler
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._idle = queue.Queue()
+        self._all = []
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+            self._all.append(conn)
+            return conn
+
+    def put(self, conn):
+        self._idle.put(conn)
+
+    def close(self):
+        for conn in self._all:
+            conn.close()
+
+
+def check_steps(steps):
+    """
+    Function to check that every dependency exists and that the steps do not form a cycle
+    """
+    for name, (_, deps) in steps.items():
+        for dep in deps:
+            if dep not in steps:
+                raise ValueError("Step {} depends on unknown step {}".format(name, dep))
+    done = set()
+    while len(done) < len(steps):
+        ready = [name for name, (_, deps) in steps.items() if name not in done and set(deps) <= done]
+        if not ready:
+            raise ValueError("Cycle between the steps {}".format(sorted(set(steps) - done)))
+        done.update(ready)
+
+
+def run_step(pool, name, queries, start, profiler=None):
+    """
+    Function to run the statements of a step on a connection of the pool, one commit per statement.
+    With a profiler the statements are also recorded in etl_run_history.
+    """
+    conn = pool.get()
+    began = time.time() - start
+    try:
+        cur = conn.cursor()
+        timings = []
+        for query in queries:
+            query_start = time.time()
+            if profiler is not None:
+                profiler.run(cur, conn, name, query)
+            else:
+                try:
+                    execute(cur, query)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            timings.append((query, time.time() - query_start))
+        return began, time.time() - start, timings
+    finally:
+        pool.put(conn)
+
+
+def critical_path(steps, results):
+    """
+    Function to find the chain of dependent steps with the longest total duration, the lower bound
+    of the load time whatever the parallelism
+    """
+    longest = {}
+
+    def chain(name):
+        if name not in longest:
+            before = max((chain(dep) for dep in steps[name][1]), key=lambda c: c[0], default=(0, []))
+            duration = results[name][1] - results[name][0]
+            longest[name] = (before[0] + duration, before[1] + [name])
+        return longest[name]
+
+    return max((chain(name) for name in steps), key=lambda c: c[0])
+
+
+def run_steps(steps, connect, parallelism=1, profiler=None):
+    """
+    Function to run the load steps (see load_steps in sql_queries.py) as soon as their dependencies are
+    done, with at most parallelism statements at the same time. Returns the start and end of every step,
+    in seconds since the beginning of the run, and the time of every statement.
+    """
+    check_steps(steps)
+    pool = ConnectionPool(connect)
+    results = {}
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            running = {}
+            failed = None
+            while len(results) < len(steps) and failed is None:
+                for name, (queries, deps) in steps.items():
+                    if name not in results and name not in running.values() and set(deps) <= set(results):
+                        running[executor.submit(run_step, pool, name, queries, start, profiler)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        failed = (name, e)
+            # let the steps already started finish before reporting the failure
+            wait(running)
+            if failed is not None:
+                raise RuntimeError("Step {} failed: {}".format(*failed)) from failed[1]
+    finally:
+        pool.close()
+    return results
+
+
+def print_report(steps, results):
+    """
+    Function to print the time of every statement, the critical path and the wall time of the load
+    """
+    for name, (began, ended, timings) in sorted(results.items(), key=lambda item: item[1][0]):
+        print("{:<16} {:8.2f}s - {:8.2f}s".format(name, began, ended))
+        for query, seconds in timings:
+            print("    {:8.2f}s  {}".format(seconds, " ".join(query.split())[:60]))
+    length, path = critical_path(steps, results)
+    wall = max(ended for _, ended, _ in results.values())
+    print("Critical path: {} ({:.2f}s)".format(" -> ".join(path), length))
+    print("Wall time: {:.2f}s".format(wall))
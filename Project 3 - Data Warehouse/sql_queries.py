@@ -10,8 +10,20 @@ config.read('dwh.cfg')
 LOG_DATA = config.get("S3","LOG_DATA")
 LOG_PATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
+# manifests of the gzip parts written by compact.py, when set the staging COPYs read the parts instead
+LOG_MANIFEST = config.get("S3", "LOG_MANIFEST", fallback="")
+SONG_MANIFEST = config.get("S3", "SONG_MANIFEST", fallback="")
 IAM_ROLE = config.get("IAM_ROLE","ARN")
 
+# redshift runs on the cluster, postgres on the local stand-in of the [LOCAL] section (see backends.py)
+BACKEND = config.get("ETL", "BACKEND", fallback="redshift")
+# full reloads all of staging, incremental only merges the events newer than the watermarks
+LOAD_MODE = config.get("ETL", "LOAD_MODE", fallback="full")
+# number of load statements run at the same time by etl.py, each on its own connection
+PARALLELISM = config.getint("ETL", "PARALLELISM", fallback=1)
+# record the time, rows and plan of every load statement in etl_run_history (see profiler.py)
+PROFILE = config.getboolean("ETL", "PROFILE", fallback=False)
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
@@ -21,6 +33,8 @@ user_table_drop = "DROP TABLE IF EXISTS dim_users;"
 song_table_drop = "DROP TABLE IF EXISTS dim_songs;"
 artist_table_drop = "DROP TABLE IF EXISTS dim_artists;"
 time_table_drop = "DROP TABLE IF EXISTS dim_time;"
+watermark_table_drop = "DROP TABLE IF EXISTS etl_watermarks;"
+rollup_table_drop = "DROP TABLE IF EXISTS {};"
 
 # CREATE TABLES
 
@@ -42,7 +56,8 @@ staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS staging_events
                          status int,
                          ts timestamp,
                          userAgent varchar(150),
-                         userId int)
+                         userId int,
+                         match_key bigint)
                          ;""")
                                 
 staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs 
@@ -55,7 +70,8 @@ staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs
                          year int,
                          duration numeric,
                          artist_id varchar,
-                         artist_location varchar(100))
+                         artist_location varchar(100),
+                         match_key bigint)
                          ;""")                 
 
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS fact_songplays 
@@ -104,16 +120,74 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS dim_time
                     weekday smallint)
                     ;""")
 
+# high-water mark on ts of every table loaded from staging_events, used by the incremental load mode
+
+watermark_table_create = ("""CREATE TABLE IF NOT EXISTS etl_watermarks
+                         (table_name varchar(64) PRIMARY KEY,
+                         high_water_ts timestamp NOT NULL)
+                         ;""")
+
+watermark_table_seed = ("""INSERT INTO etl_watermarks (table_name, high_water_ts)
+                       VALUES ('fact_songplays', '1900-01-01'), ('dim_users', '1900-01-01'), ('dim_time', '1900-01-01')
+                       ;""")
+
+# ROLLUPS
+
+# plays per hour and per day of fact_songplays by song, artist, user level and location, for the dashboards.
+# The key column has the name of its fact column, a missing level or location is counted as 'unknown'.
+# The tables are small, their distribution is left to Redshift.
+
+ROLLUP_GRAINS = {'hour': 'hourly', 'day': 'daily'}
+ROLLUP_COLUMNS = ['song_id', 'artist_id', 'level', 'location']
+
+rollup_tables = {'rollup_{}_{}'.format(column.replace('_id', ''), suffix): (grain, column)
+                 for column in ROLLUP_COLUMNS for grain, suffix in ROLLUP_GRAINS.items()}
+
+rollup_table_create = ("""CREATE TABLE IF NOT EXISTS {0}
+                      (period timestamp NOT NULL sortkey,
+                      {1} varchar NOT NULL,
+                      plays bigint NOT NULL)
+                      ;""")
+
+# the rollups are updated together and share one watermark, the latest start_time of fact_songplays counted
+
+ROLLUP_WATERMARK = 'rollups'
+
+rollup_watermark_seed = ("""INSERT INTO etl_watermarks (table_name, high_water_ts)
+                        VALUES ('{}', '1900-01-01')
+                        ;""").format(ROLLUP_WATERMARK)
+
+# one row per statement run by etl.py with PROFILE on. It is not dropped by create_tables.py, so runs
+# before and after a schema change can be compared.
+
+run_history_table_create = ("""CREATE TABLE IF NOT EXISTS etl_run_history
+                           (run_id varchar(64) NOT NULL,
+                           step varchar(64) NOT NULL,
+                           statement_index int NOT NULL,
+                           query varchar(65535),
+                           explain_plan varchar(65535),
+                           rows_affected bigint,
+                           started_at timestamp,
+                           seconds double precision,
+                           status varchar(16),
+                           error varchar(1024))
+                           ;""")
+
 # STAGING TABLES
 
+# the columns of log_json_path.json, in its order. match_key is left out, it is set by staging_events_match_key
+# and the jsonpaths file has to give exactly one value per column listed.
+STAGING_EVENTS_COLUMNS = ("artist, auth, firstName, gender, itemInSession, lastName, length, level, location, "
+                          "method, page, registration, sessionId, song, status, ts, userAgent, userId")
+
 staging_events_copy = ("""
-    COPY staging_events FROM {}
+    COPY staging_events ({}) FROM {}
     CREDENTIALS 'aws_iam_role={}'
     COMPUPDATE OFF region 'us-west-2' 
     FORMAT AS JSON {}
     TIMEFORMAT as 'epochmillisecs'
     TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
-""").format(LOG_DATA, IAM_ROLE, LOG_PATH)
+""").format(STAGING_EVENTS_COLUMNS, LOG_DATA, IAM_ROLE, LOG_PATH)
 
 staging_songs_copy = ("""
     COPY staging_songs FROM {}
@@ -122,6 +196,52 @@ staging_songs_copy = ("""
     FORMAT AS JSON 'auto'
     TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
 """).format(SONG_DATA, IAM_ROLE)      
+
+# the same COPYs from the parts listed in a manifest (see compact.py), one part per slice loads in parallel
+
+staging_events_manifest_copy = ("""
+    COPY staging_events ({}) FROM {}
+    CREDENTIALS 'aws_iam_role={}'
+    COMPUPDATE OFF region 'us-west-2' 
+    FORMAT AS JSON {}
+    TIMEFORMAT as 'epochmillisecs'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    GZIP MANIFEST;
+""").format(STAGING_EVENTS_COLUMNS, LOG_MANIFEST, IAM_ROLE, LOG_PATH)
+
+staging_songs_manifest_copy = ("""
+    COPY staging_songs FROM {}
+    CREDENTIALS 'aws_iam_role={}'
+    COMPUPDATE OFF region 'us-west-2'
+    FORMAT AS JSON 'auto'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    GZIP MANIFEST;
+""").format(SONG_MANIFEST, IAM_ROLE)
+
+# A play is matched to its song on one 64-bit hash of the normalized title, artist name and duration
+# instead of the three columns. Only the plays get a key, the other events never take part in the join.
+
+MATCH_KEY = "fnv_hash(lower(trim({0})) || '|' || lower(trim({1})) || '|' || round({2}, 5)::varchar, 0)"
+
+staging_events_match_key = ("""UPDATE staging_events
+                           SET match_key = {}
+                           WHERE page = 'NextSong'
+                           ;""").format(MATCH_KEY.format('song', 'artist', 'length'))
+
+staging_songs_match_key = ("""UPDATE staging_songs
+                          SET match_key = {}
+                          ;""").format(MATCH_KEY.format('title', 'artist_name', 'duration'))
+
+# one song per key, a song listed twice in song_data would count its plays twice
+MATCHED_SONGS = ("""(SELECT match_key, song_id, artist_id, artist_location,
+                    ROW_NUMBER() OVER (PARTITION BY match_key ORDER BY song_id) AS rn
+                    FROM staging_songs
+                    WHERE match_key IS NOT NULL) so""")
+
+if LOG_MANIFEST:
+    staging_events_copy = staging_events_manifest_copy
+if SONG_MANIFEST:
+    staging_songs_copy = staging_songs_manifest_copy
         
 
 # FINAL TABLES
@@ -135,8 +255,7 @@ songplay_table_insert = ("""INSERT INTO fact_songplays
                         session_id,
                         location,
                         user_agent)
-                        SELECT DISTINCT
-                        to_timestamp(to_char(ev.ts, '9999-99-99 99:99:99'),'YYYY-MM-DD HH24:MI:SS'),
+                        SELECT ev.ts,
                         ev.userId as user_id,
                         ev.level as level,
                         so.song_id as song_id,
@@ -145,11 +264,11 @@ songplay_table_insert = ("""INSERT INTO fact_songplays
                         so.artist_location as location,
                         ev.userAgent as user_agent
                         FROM staging_events ev
-                        JOIN staging_songs so
-                        ON ev.song = so.title
-                        AND ev.artist = so.artist_name
-                        AND ev.length = so.duration 
-                        ;""")
+                        JOIN {}
+                        ON so.match_key = ev.match_key
+                        AND so.rn = 1
+                        WHERE ev.page = 'NextSong'
+                        ;""").format(MATCHED_SONGS)
 
 
 user_table_insert = ("""INSERT INTO dim_users 
@@ -220,6 +339,278 @@ time_table_insert = ("""INSERT INTO dim_time
                     WHERE ts IS NOT NULL
                     ;""")
 
+# INCREMENTAL LOAD
+
+# Staging is emptied before every COPY and the events older than all the watermarks are deleted right after,
+# so the statements below only read the new slice. Every statement merges one table and moves its watermark
+# in the same transaction.
+
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+
+WATERMARK = "(SELECT coalesce(max(high_water_ts), '1900-01-01'::timestamp) FROM etl_watermarks WHERE table_name = '{}')"
+
+staging_events_trim = ("""DELETE FROM staging_events
+                      WHERE ts <= (SELECT min(high_water_ts) FROM etl_watermarks
+                      WHERE table_name IN ('fact_songplays', 'dim_users', 'dim_time'))
+                      ;""")
+
+watermark_update = ("""UPDATE etl_watermarks
+                   SET high_water_ts = staged.ts
+                   FROM (SELECT max(ts) AS ts FROM staging_events) staged
+                   WHERE table_name = '{0}'
+                   AND staged.ts > etl_watermarks.high_water_ts
+                   ;""")
+
+songplay_table_merge = ("""INSERT INTO fact_songplays 
+                       (start_time,
+                       user_id,
+                       level,
+                       song_id,
+                       artist_id,
+                       session_id,
+                       location,
+                       user_agent)
+                       SELECT ev.ts,
+                       ev.userId as user_id,
+                       ev.level as level,
+                       so.song_id as song_id,
+                       so.artist_id as artist_id,
+                       ev.sessionId as session_id,
+                       so.artist_location as location,
+                       ev.userAgent as user_agent
+                       FROM staging_events ev
+                       JOIN {2}
+                       ON so.match_key = ev.match_key
+                       AND so.rn = 1
+                       WHERE ev.page = 'NextSong'
+                       AND ev.ts > {1}
+                       ;""" + watermark_update).format('fact_songplays', WATERMARK.format('fact_songplays'), MATCHED_SONGS)
+
+# upsert: the users of the slice are deleted and inserted again with their latest event
+
+user_table_merge = ("""DELETE FROM dim_users
+                   USING staging_events ev
+                   WHERE dim_users.user_id = ev.userId
+                   AND ev.ts > {1}
+                   ;
+                   INSERT INTO dim_users 
+                   (user_id,
+                   first_name,
+                   last_name,
+                   gender,
+                   level)
+                   SELECT userId,
+                   firstName,
+                   lastName,
+                   gender,
+                   level
+                   FROM (SELECT userId, firstName, lastName, gender, level,
+                         ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS rn
+                         FROM staging_events
+                         WHERE userId IS NOT NULL
+                         AND ts > {1}) ev
+                   WHERE rn = 1
+                   ;""" + watermark_update).format('dim_users', WATERMARK.format('dim_users'))
+
+# anti-joins: only the keys missing from the dimension are inserted
+
+song_table_merge = ("""INSERT INTO dim_songs
+                   (song_id,
+                   title,
+                   artist_id,
+                   year,
+                   duration)
+                   SELECT so.song_id,
+                   so.title,
+                   so.artist_id,
+                   so.year,
+                   so.duration
+                   FROM (SELECT song_id, title, artist_id, year, duration,
+                         ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title) AS rn
+                         FROM staging_songs
+                         WHERE song_id IS NOT NULL) so
+                   LEFT JOIN dim_songs d
+                   ON d.song_id = so.song_id
+                   WHERE so.rn = 1
+                   AND d.song_id IS NULL
+                   ;""")
+
+artist_table_merge = ("""INSERT INTO dim_artists
+                     (artist_id,
+                     artist_name,
+                     artist_location,
+                     artist_latitude,
+                     artist_longitude)
+                     SELECT so.artist_id,
+                     so.artist_name,
+                     so.artist_location,
+                     so.artist_latitude,
+                     so.artist_longitude
+                     FROM (SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+                           ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS rn
+                           FROM staging_songs
+                           WHERE artist_id IS NOT NULL) so
+                     LEFT JOIN dim_artists d
+                     ON d.artist_id = so.artist_id
+                     WHERE so.rn = 1
+                     AND d.artist_id IS NULL
+                     ;""")
+
+time_table_merge = ("""INSERT INTO dim_time 
+                   (start_time,
+                   hour,
+                   day,
+                   week,
+                   month,
+                   year,
+                   weekday)
+                   SELECT ev.ts,
+                   extract(hour from ev.ts),
+                   extract(day from ev.ts),
+                   extract(week from ev.ts),
+                   extract(month from ev.ts),
+                   extract(year from ev.ts),
+                   extract(weekday from ev.ts)
+                   FROM (SELECT DISTINCT ts FROM staging_events
+                         WHERE ts IS NOT NULL
+                         AND ts > {1}) ev
+                   LEFT JOIN dim_time t
+                   ON t.start_time = ev.ts
+                   WHERE t.start_time IS NULL
+                   ;""" + watermark_update).format('dim_time', WATERMARK.format('dim_time'))
+
+# ROLLUP UPDATES
+
+# All the rollups are updated in one step, a single transaction ending with the only update of their watermark,
+# so no two transactions write etl_watermarks at the same time (see LOAD STEPS).
+#
+# A full load rebuilds them from the whole fact table. An incremental load relies on plays being additive: the
+# fact rows newer than the watermark are counted on their own and added to the rollups, the periods already
+# there are updated, the others inserted. This assumes fact_songplays is append-only with increasing
+# start_time, which songplay_table_merge guarantees: it only inserts the events newer than the fact watermark,
+# itself never older than the latest start_time of the fact table. Rows inserted or deleted by other means
+# require a full load.
+
+ROLLUP_DELTA = ("""(SELECT date_trunc('{0}', start_time) AS period,
+                   coalesce({1}, 'unknown') AS {1},
+                   count(*) AS plays
+                   FROM fact_songplays
+                   WHERE start_time > {2}
+                   GROUP BY 1, 2) delta""")
+
+rollup_table_rebuild = ("""DELETE FROM {table}
+                       ;
+                       INSERT INTO {table}
+                       (period,
+                       {column},
+                       plays)
+                       SELECT date_trunc('{grain}', start_time),
+                       coalesce({column}, 'unknown'),
+                       count(*)
+                       FROM fact_songplays
+                       GROUP BY 1, 2
+                       ;""")
+
+rollup_table_update = ("""UPDATE {table}
+                      SET plays = {table}.plays + delta.plays
+                      FROM {delta}
+                      WHERE {table}.period = delta.period
+                      AND {table}.{column} = delta.{column}
+                      ;
+                      INSERT INTO {table}
+                      (period,
+                      {column},
+                      plays)
+                      SELECT delta.period,
+                      delta.{column},
+                      delta.plays
+                      FROM {delta}
+                      LEFT JOIN {table} r
+                      ON r.period = delta.period
+                      AND r.{column} = delta.{column}
+                      WHERE r.period IS NULL
+                      ;""")
+
+rollup_watermark_update = ("""UPDATE etl_watermarks
+                          SET high_water_ts = loaded.ts
+                          FROM (SELECT max(start_time) AS ts FROM fact_songplays) loaded
+                          WHERE table_name = '{}'
+                          AND loaded.ts IS NOT NULL
+                          ;""").format(ROLLUP_WATERMARK)
+
+rollup_tables_rebuild = "\n".join(
+    [rollup_table_rebuild.format(table=table, column=column, grain=grain)
+     for table, (grain, column) in rollup_tables.items()] + [rollup_watermark_update])
+
+rollup_tables_update = "\n".join(
+    [rollup_table_update.format(table=table, column=column,
+                                delta=ROLLUP_DELTA.format(grain, column, WATERMARK.format(ROLLUP_WATERMARK)))
+     for table, (grain, column) in rollup_tables.items()] + [rollup_watermark_update])
+
+# RUN HISTORY
+
+run_history_insert = ("""INSERT INTO etl_run_history
+                     (run_id, step, statement_index, query, explain_plan, rows_affected, started_at, seconds, status, error)
+                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                     ;""")
+
+run_history_last_runs = ("""SELECT run_id FROM etl_run_history
+                        GROUP BY run_id
+                        ORDER BY min(started_at) DESC
+                        LIMIT 2
+                        ;""")
+
+run_history_select = ("""SELECT step, statement_index, seconds, rows_affected, explain_plan, status
+                     FROM etl_run_history
+                     WHERE run_id = %s
+                     ORDER BY step, statement_index
+                     ;""")
+
+# ANALYTIC QUERIES
+
+# reference set of dashboard queries on the star schema, used by advisor.py to find the join and range
+# filter columns and to benchmark table layouts
+
+analytic_queries = {'plays_by_weekday_hour': ("""SELECT t.weekday, t.hour, count(*) AS plays
+                                              FROM fact_songplays sp
+                                              JOIN dim_time t
+                                              ON t.start_time = sp.start_time
+                                              GROUP BY t.weekday, t.hour
+                                              ORDER BY t.weekday, t.hour
+                                              ;"""),
+                    'top_songs': ("""SELECT s.title, a.artist_name, count(*) AS plays
+                                  FROM fact_songplays sp
+                                  JOIN dim_songs s
+                                  ON s.song_id = sp.song_id
+                                  JOIN dim_artists a
+                                  ON a.artist_id = sp.artist_id
+                                  GROUP BY s.title, a.artist_name
+                                  ORDER BY plays DESC
+                                  LIMIT 10
+                                  ;"""),
+                    'plays_by_level_gender': ("""SELECT u.level, u.gender, count(*) AS plays
+                                              FROM fact_songplays sp
+                                              JOIN dim_users u
+                                              ON u.user_id = sp.user_id
+                                              GROUP BY u.level, u.gender
+                                              ;"""),
+                    'monthly_active_users': ("""SELECT date_trunc('month', sp.start_time) AS month,
+                                             count(DISTINCT sp.user_id) AS users
+                                             FROM fact_songplays sp
+                                             WHERE sp.start_time >= '2018-11-01'
+                                             AND sp.start_time < '2019-01-01'
+                                             GROUP BY 1
+                                             ;"""),
+                    'artist_catalogue': ("""SELECT a.artist_name, count(*) AS songs, avg(s.duration) AS duration
+                                         FROM dim_songs s
+                                         JOIN dim_artists a
+                                         ON a.artist_id = s.artist_id
+                                         GROUP BY a.artist_name
+                                         ORDER BY songs DESC
+                                         LIMIT 10
+                                         ;""")}
+
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create, 
@@ -228,7 +619,12 @@ create_table_queries = [staging_events_table_create,
                         song_table_create,
                         artist_table_create, 
                         time_table_create,
-                        songplay_table_create]
+                        songplay_table_create,
+                        watermark_table_create,
+                        watermark_table_seed,
+                        rollup_watermark_seed,
+                        run_history_table_create] + [
+                        rollup_table_create.format(table, column) for table, (_, column) in rollup_tables.items()]
 
 drop_table_queries = [staging_events_table_drop, 
                       staging_songs_table_drop, 
@@ -236,13 +632,43 @@ drop_table_queries = [staging_events_table_drop,
                       user_table_drop, 
                       song_table_drop, 
                       artist_table_drop, 
-                      time_table_drop]
+                      time_table_drop,
+                      watermark_table_drop] + [
+                      rollup_table_drop.format(table) for table in rollup_tables]
+
+# LOAD STEPS
+
+# the statements of the load as a dependency graph for scheduler.py: every step runs its statements in order on
+# one connection once the steps it depends on are done. The staging COPYs are independent, every dimension
+# only needs its staging table, fact_songplays waits for the dimensions it references and the rollups, one
+# step, for fact_songplays.
+#
+# In incremental mode dim_users, dim_time and fact_songplays also move their row of etl_watermarks. Concurrent
+# transactions updating the same table fail on Redshift with a serializable isolation violation (error 1023),
+# so those steps run one after the other: dim_time waits for dim_users, fact_songplays for both and the
+# rollups, the only other writer, for fact_songplays.
+
+load_steps = {'staging_events': ([staging_events_copy, staging_events_match_key], []),
+              'staging_songs': ([staging_songs_copy, staging_songs_match_key], []),
+              'dim_users': ([user_table_insert], ['staging_events']),
+              'dim_songs': ([song_table_insert], ['staging_songs']),
+              'dim_artists': ([artist_table_insert], ['staging_songs']),
+              'dim_time': ([time_table_insert], ['staging_events']),
+              'fact_songplays': ([songplay_table_insert], ['staging_events', 'staging_songs', 'dim_users',
+                                                          'dim_songs', 'dim_artists', 'dim_time'])}
+
+incremental_load_steps = {'staging_events': ([staging_events_truncate, staging_events_copy, staging_events_trim,
+                                               staging_events_match_key], []),
+                          'staging_songs': ([staging_songs_truncate, staging_songs_copy, staging_songs_match_key], []),
+                          'dim_users': ([user_table_merge], ['staging_events']),
+                          'dim_songs': ([song_table_merge], ['staging_songs']),
+                          'dim_artists': ([artist_table_merge], ['staging_songs']),
+                          'dim_time': ([time_table_merge], ['staging_events', 'dim_users']),
+                          'fact_songplays': ([songplay_table_merge], ['staging_events', 'staging_songs', 'dim_users',
+                                                                      'dim_songs', 'dim_artists', 'dim_time'])}
 
-copy_table_queries = [staging_events_copy, 
-                      staging_songs_copy]
+load_steps['rollups'] = ([rollup_tables_rebuild], ['fact_songplays'])
+incremental_load_steps['rollups'] = ([rollup_tables_update], ['fact_songplays'])
 
-insert_table_queries = [songplay_table_insert, 
-                        user_table_insert, 
-                        song_table_insert, 
-                        artist_table_insert, 
-                        time_table_insert]
+if LOAD_MODE == 'incremental':
+    load_steps = incremental_load_steps
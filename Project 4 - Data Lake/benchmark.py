@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from pyspark.sql import functions as F
+
+from etl import create_spark_session, add_time_columns, build_time_table, parse_args, run, LOG_SCHEMA
+from metrics import WriteMetrics
+
+PAGES = ['Home', 'Logout', 'Settings', 'Help', 'About', 'Downgrade', 'Upgrade']
+
+
+def generate(output, songs=1000, artists=500, users=100, days=30, events_per_day=1000, match_fraction=0.5,
+             start_date='2018-11-01', seed=0):
+    """
+    Description: This function is used to write a synthetic data set with the layout read by etl.py:
+    one JSON file per song below song-data/A/B/C/ and one file of events per day in log-data/.
+
+    Parameters:
+        output: directory receiving song-data and log-data.
+        songs, artists, users: number of distinct songs, artists and users.
+        days: number of daily log files.
+        events_per_day: events per log file, about 80% of them are NextSong events.
+        match_fraction: share of the NextSong events that refer to a generated song.
+        start_date: date of the first log file.
+        seed: the same arguments and seed always give the same files.
+
+    Returns:
+        dict with the number of song files, log files and events written.
+    """
+    rng = random.Random(seed)
+    artist_records = [{'artist_id': 'AR{:016d}'.format(i), 'artist_name': 'Artist {}'.format(i),
+                       'artist_location': '', 'artist_latitude': None, 'artist_longitude': None}
+                      for i in range(artists)]
+    song_records = []
+    for i in range(songs):
+        record = {'num_songs': 1, 'song_id': 'SO{:016d}'.format(i), 'title': 'Song {}'.format(i),
+                  'duration': round(rng.uniform(60, 600), 5), 'year': rng.choice([0] + list(range(1960, 2011)))}
+        record.update(rng.choice(artist_records))
+        song_records.append(record)
+        track_id = 'TR{}{:08d}'.format(''.join(rng.choice('ABCDEFGHIJ') for _ in range(3)), i)
+        directory = os.path.join(output, 'song-data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(record, f)
+
+    os.makedirs(os.path.join(output, 'log-data'), exist_ok=True)
+    events = 0
+    first_day = datetime.strptime(start_date, '%Y-%m-%d')
+    for day in range(days):
+        date = first_day + timedelta(days=day)
+        day_start = int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+        with open(os.path.join(output, 'log-data', date.strftime('%Y-%m-%d-events.json')), 'w') as f:
+            for ts in sorted(day_start + rng.randrange(86400000) for _ in range(events_per_day)):
+                user = rng.randrange(users) + 1
+                event = {'userId': str(user), 'firstName': 'First{}'.format(user), 'lastName': 'Last{}'.format(user),
+                         'gender': 'MF'[user % 2], 'level': ['free', 'paid'][user % 3 == 0],
+                         'location': 'Location {}'.format(user % 20), 'userAgent': 'Agent {}'.format(user % 5),
+                         'sessionId': user * 1000 + day, 'itemInSession': events % 100, 'ts': ts,
+                         'auth': 'Logged In', 'method': 'PUT', 'status': 200, 'registration': 1.5e12}
+                if rng.random() < 0.8:
+                    if rng.random() < match_fraction:
+                        song = rng.choice(song_records)
+                        event.update({'song': song['title'], 'artist': song['artist_name'],
+                                      'length': song['duration']})
+                    else:
+                        event.update({'song': 'Unknown Song {}'.format(rng.randrange(10 ** 6)),
+                                      'artist': 'Unknown Artist', 'length': round(rng.uniform(60, 600), 5)})
+                    event['page'] = 'NextSong'
+                else:
+                    event.update({'song': None, 'artist': None, 'length': None, 'method': 'GET',
+                                  'page': rng.choice(PAGES)})
+                f.write(json.dumps(event) + '\n')
+                events += 1
+    return {'song_files': songs, 'log_files': days, 'events': events}
+
+
+def udf_time_tables(df):
+    """
+    Description: This function is used to derive the time table and the songplays year/month the way
+    process_log_data did before, through two row-at-a-time Python UDFs, as the baseline of the benchmark.
+    The first UDF returns a string, the second one converts it back with float().
+
+    Parameters:
+        df: DataFrame of NextSong log events.
+
+    Returns:
+        (time table, log events with the songplays year and month) DataFrames.
+    """
+    get_timestamp = F.udf(lambda x: x / 1000.0)
+    df = df.withColumn("timestamp", get_timestamp("ts"))
+    get_datetime = F.udf(lambda x: datetime.utcfromtimestamp(float(x)).strftime('%Y-%m-%d %H:%M:%S'))
+    df = df.withColumn("date_sp", get_datetime("timestamp"))
+    time_table = df.withColumn("hour", F.hour(df.date_sp)) \
+        .withColumn("year", F.year(df.date_sp)) \
+        .withColumn("day", F.dayofmonth(df.date_sp)) \
+        .withColumn("week", F.weekofyear(df.date_sp)) \
+        .withColumn("month", F.month(df.date_sp)) \
+        .withColumn("weekday", F.dayofweek(df.date_sp)) \
+        .withColumnRenamed('ts', 'start_time') \
+        .select(['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']) \
+        .dropDuplicates()
+    songplays = df.withColumn("year", F.year(df.date_sp)).withColumn("month", F.month(df.date_sp))
+    return time_table, songplays
+
+
+def native_time_tables(df):
+    """
+    Description: This function is used to derive the same outputs with the native expressions of etl.py.
+
+    Parameters:
+        df: DataFrame of NextSong log events.
+
+    Returns:
+        (time table, log events with the songplays year and month) DataFrames.
+    """
+    df = add_time_columns(df)
+    return build_time_table(df), df
+
+
+def checksum(df):
+    """
+    Description: This function is used to force the computation of every column of a DataFrame, without
+    the cost of a write.
+
+    Returns:
+        sum of the hashes of the rows.
+    """
+    return df.select(F.sum(F.hash(*df.columns).cast('long'))).collect()[0][0]
+
+
+def bench_time_derivation(spark, data_dir, repeat):
+    """
+    Description: This function is used to time the UDF and the native derivation of the time columns on
+    the same cached log events, so JSON parsing is left out of the measure.
+
+    Parameters:
+        spark: the SparkSession.
+        data_dir: directory holding log-data.
+        repeat: number of runs of each variant, the best one is kept.
+
+    Returns:
+        dict with the events, the best seconds of each variant and the speedup.
+    """
+    df = spark.read.json(os.path.join(data_dir, 'log-data', '*.json'), schema=LOG_SCHEMA) \
+        .filter(F.col('page') == 'NextSong').cache()
+    events = df.count()
+    result = {'events': events}
+    for name, derive in [('udf', udf_time_tables), ('native', native_time_tables)]:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            time_table, songplays = derive(df)
+            checksum(time_table)
+            checksum(songplays.select('ts', 'year', 'month'))
+            best = min(best or float('inf'), time.time() - start)
+        result[name + '_seconds'] = round(best, 3)
+    result['speedup'] = round(result['udf_seconds'] / result['native_seconds'], 2)
+    df.unpersist()
+    return result
+
+
+def bench_etl(spark, data_dir, repeat):
+    """
+    Description: This function is used to time the whole ETL of etl.py, the song and log stages, on a data
+    set, each run writing to an empty temporary output.
+
+    Parameters:
+        spark: the SparkSession.
+        data_dir: directory holding song-data and log-data.
+        repeat: number of runs, the best one is kept.
+
+    Returns:
+        dict with the best seconds and the summed write metrics of that run.
+    """
+    best = None
+    for _ in range(repeat):
+        output = tempfile.mkdtemp(prefix='sparkify-lake-output-')
+        try:
+            metrics = WriteMetrics(spark)
+            start = time.time()
+            run(spark, parse_args(['--input', data_dir + '/', '--output', output + '/', '--metrics', '']), metrics)
+            seconds = time.time() - start
+        finally:
+            shutil.rmtree(output, ignore_errors=True)
+        if best is None or seconds < best['seconds']:
+            best = dict(metrics.totals(), seconds=round(seconds, 3))
+    return best
+
+
+def bench_scaling(data_dir, scales, cores, args):
+    """
+    Description: This function is used to run the ETL in local mode for every scale of the synthetic data
+    and every number of cores. A scale multiplies the songs and the events per day of the data set.
+
+    Parameters:
+        data_dir: directory receiving a scale-N data set per scale, kept ones are reused.
+        scales: multipliers of the data set.
+        cores: numbers of cores of the local[N] sessions.
+        args: options of main.
+
+    Returns:
+        list of result dicts, one per scale and number of cores.
+    """
+    results = []
+    for scale in scales:
+        scale_dir = os.path.join(data_dir, 'scale-{}'.format(scale))
+        if not os.path.isdir(os.path.join(scale_dir, 'log-data')):
+            generate(scale_dir, songs=args.songs * scale, artists=max(1, args.songs * scale // 2), days=args.days,
+                     events_per_day=args.events_per_day * scale)
+        events = args.days * args.events_per_day * scale
+        baseline = None
+        for n in cores:
+            # the number of cores of a local session is fixed when its context starts
+            spark = create_spark_session(master='local[{}]'.format(n))
+            result = {'benchmark': 'etl_scaling', 'spark': spark.version, 'scale': scale, 'cores': n,
+                      'events': events}
+            result.update(bench_etl(spark, scale_dir, args.repeat))
+            spark.stop()
+            result['events_per_second'] = round(events / result['seconds'])
+            baseline = baseline or (n, result['seconds'])
+            # 1.0 when the cores are used as well as by the first run of the scale
+            result['scaling_efficiency'] = round(baseline[1] * baseline[0] / (result['seconds'] * n), 2)
+            print('scale {scale} ({events} events) on {cores} cores: {seconds}s, {events_per_second} events/s, '
+                  'efficiency {scaling_efficiency}'.format(**result))
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Spark ETL stages on synthetic data.')
+    parser.add_argument('--benchmark', choices=['time_derivation', 'etl_scaling'], default='time_derivation',
+                        help='UDF against native time columns, or the whole ETL in local mode at several scales '
+                             'and numbers of cores')
+    parser.add_argument('--days', type=int, default=30, help='daily log files generated')
+    parser.add_argument('--events-per-day', type=int, default=10000)
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4],
+                        help='etl_scaling: multipliers of the songs and events per day')
+    parser.add_argument('--cores', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                        help='etl_scaling: cores of the local[N] sessions')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every variant, the best one is kept')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--keep-data', metavar='DIR',
+                        help='generate the data below DIR and keep it instead of using a temporary directory')
+    args = parser.parse_args()
+
+    data_dir = args.keep_data or tempfile.mkdtemp(prefix='sparkify-lake-benchmark-')
+    timestamp = datetime.utcnow().isoformat(timespec='seconds')
+    try:
+        if args.benchmark == 'etl_scaling':
+            results = bench_scaling(data_dir, args.scales, args.cores, args)
+        else:
+            if not os.path.isdir(os.path.join(data_dir, 'log-data')):
+                generate(data_dir, songs=args.songs, artists=max(1, args.songs // 2), days=args.days,
+                         events_per_day=args.events_per_day)
+            spark = create_spark_session()
+            result = {'benchmark': 'time_derivation', 'spark': spark.version}
+            result.update(bench_time_derivation(spark, data_dir, args.repeat))
+            print('time derivation on {events} events: UDF {udf_seconds}s, native {native_seconds}s, '
+                  '{speedup}x faster'.format(**result))
+            results = [result]
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(timestamp=timestamp, **result)) + '\n')
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+from pyspark import StorageLevel
+from pyspark.sql.functions import broadcast, col, count, current_date, input_file_name, lit, to_date
+
+from incremental import list_files, path_exists
+
+# directory of the output holding the raw records converted to parquet
+BRONZE_DIR = 'bronze/'
+
+# raw files of every dataset and the date its bronze table is partitioned on. The songs carry no date
+# of their own, they are partitioned on the day they were ingested.
+DATASETS = {'song_data': ('song-data/*/*/*/*.json', 'ingest_date'),
+            'log_data': ('log-data/*.json', 'event_date')}
+
+SOURCES_TABLE = 'sources'
+
+
+def bronze_path(output_data, dataset):
+    return output_data + BRONZE_DIR + dataset
+
+
+def partition_value(dataset):
+    """
+    Description: This function is used to build the date a raw record is partitioned on, the UTC day of
+    the event for the log records and the day of the ingest for the song records.
+    """
+    if dataset == 'log_data':
+        return to_date((col('ts') / 1000).cast('timestamp'))
+    return current_date()
+
+
+def loaded_files(spark, path):
+    """
+    Description: This function is used to find the raw files already converted, from the source_file
+    column of the bronze table itself, so a run failing after its write is not converted twice.
+    """
+    if not path_exists(spark, path):
+        return set()
+    return {row.source_file for row in spark.read.parquet(path).select('source_file').distinct().collect()}
+
+
+def qualify_sources(spark, df):
+    """
+    Description: This function is used to rewrite the URIs given by input_file_name (file:///a%20b) as
+    the Hadoop paths listed by list_files (file:/a b), so both can be compared.
+    """
+    jvm = spark.sparkContext._jvm
+    uris = [row.source_file for row in df.select('source_file').distinct().collect()]
+    paths = spark.createDataFrame([(uri, jvm.org.apache.hadoop.fs.Path(jvm.java.net.URI(uri)).toString())
+                                   for uri in uris], 'source_file string, source_path string')
+    return df.join(broadcast(paths), 'source_file').drop('source_file') \
+        .withColumnRenamed('source_path', 'source_file')
+
+
+def ingest(spark, input_data, output_data, dataset, schema):
+    """
+    Description: This function is used to convert the raw JSON files of a dataset not converted yet into
+    its bronze parquet table, typed with schema, partitioned on the date of DATASETS and keeping the
+    file every row comes from.
+
+    Parameters:
+        spark: the SparkSession.
+        input_data: path holding song-data and log-data.
+        output_data: path of the lake, the bronze tables are written below its bronze/ directory.
+        dataset: song_data or log_data.
+        schema: declared schema of the raw records.
+
+    Returns:
+        list of the files converted.
+    """
+    pattern, partition = DATASETS[dataset]
+    path = bronze_path(output_data, dataset)
+    files = sorted(set(list_files(spark, input_data + pattern)) - loaded_files(spark, path))
+    if not files:
+        return files
+
+    # parsed once, for the source files and for the write
+    df = spark.read.json(files, schema=schema).withColumn('source_file', input_file_name()) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
+    qualify_sources(spark, df).withColumn(partition, partition_value(dataset)) \
+        .repartition(partition) \
+        .write.mode('append').partitionBy(partition).parquet(path)
+    df.unpersist()
+    return files
+
+
+def write_sources(spark, output_data):
+    """
+    Description: This function is used to rewrite the sources table of the bronze layer, listing the raw
+    files behind every partition of the bronze tables with their number of rows.
+
+    Returns:
+        None
+    """
+    tables = []
+    for dataset, (_, partition) in DATASETS.items():
+        path = bronze_path(output_data, dataset)
+        if path_exists(spark, path):
+            tables.append(spark.read.parquet(path)
+                          .groupBy(col(partition).cast('string').alias('partition_value'), 'source_file')
+                          .agg(count(lit(1)).alias('rows'))
+                          .select(lit(dataset).alias('dataset'), lit(partition).alias('partition_column'),
+                                  'partition_value', 'source_file', 'rows'))
+    if not tables:
+        return
+    sources = tables[0]
+    for table in tables[1:]:
+        sources = sources.unionByName(table)
+    sources.coalesce(1).write.mode('overwrite').parquet(output_data + BRONZE_DIR + SOURCES_TABLE)
+
+
+def read_bronze(spark, output_data, dataset, schema, files=None):
+    """
+    Description: This function is used to read the records of a dataset from its bronze table, with the
+    columns of the raw records.
+
+    Parameters:
+        spark: the SparkSession.
+        output_data: path of the lake.
+        dataset: song_data or log_data.
+        schema: declared schema of the raw records.
+        files: raw files whose records are read, all of them when None.
+
+    Returns:
+        DataFrame of the records, None when the bronze table does not exist.
+    """
+    path = bronze_path(output_data, dataset)
+    if not path_exists(spark, path):
+        return None
+    df = spark.read.parquet(path)
+    if files is not None:
+        df = df.filter(col('source_file').isin(list(files)))
+    return df.select([field.name for field in schema.fields])
@@ -0,0 +1,97 @@
+import math
+import argparse
+
+from etl import create_spark_session
+from incremental import path_exists, rename_path, partition_columns, table_files
+
+# output tables and the columns their queries filter on, the rows of a file are sorted on them so the
+# min/max statistics of the parquet row groups let the readers skip most of them
+TABLES = {'songs_table': ['artist_id', 'song_id'],
+          'artists_table': ['artist_id'],
+          'users_table': ['userId'],
+          'time_table': ['start_time'],
+          'songplays_table': ['start_time', 'userId']}
+
+TARGET_FILE_MB = 128
+
+
+def compact_table(spark, path, sort_by=(), partition_by=None, target_file_mb=TARGET_FILE_MB):
+    """
+    Description: This function is used to rewrite a table as files of about target_file_mb, the rows of
+    each file sorted on sort_by. A partitioned table is shuffled on its partition columns, so every
+    partition is written by one task, and split in files of maxRecordsPerFile rows; an unpartitioned one
+    is range partitioned on sort_by. The new files are written next to the table and swapped in once complete.
+
+    Parameters:
+        spark: the SparkSession.
+        path: path of the table.
+        sort_by: columns the rows of a file are sorted on.
+        partition_by: new partition columns, [] for none, the current ones when None.
+        target_file_mb: size aimed at for every file.
+
+    Returns:
+        (before, after) dicts of table_files.
+    """
+    before = table_files(spark, path)
+    if partition_by is None:
+        partition_by = partition_columns(spark, path)
+    partition_by, sort_by = list(partition_by), [column for column in sort_by if column not in partition_by]
+    target_bytes = target_file_mb * 1024 * 1024
+
+    df = spark.read.parquet(path)
+    rows = df.count()
+    # parquet bytes per row of the current files, the new ones compress about as well or better once sorted
+    rows_per_file = max(1, int(target_bytes * rows / before['bytes'])) if before['bytes'] else rows or 1
+    if partition_by:
+        df = df.repartition(*partition_by).sortWithinPartitions(*(partition_by + sort_by))
+    else:
+        files = max(1, math.ceil(before['bytes'] / target_bytes))
+        df = (df.repartitionByRange(files, *sort_by) if sort_by else df.repartition(files))
+        df = df.sortWithinPartitions(*sort_by) if sort_by else df
+
+    staging = path.rstrip('/') + '_compacted'
+    writer = df.write.mode("overwrite").option("maxRecordsPerFile", rows_per_file)
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(staging)
+    rename_path(spark, staging, path.rstrip('/'))
+    return before, table_files(spark, path)
+
+
+def print_report(name, before, after):
+    print("{:<16} {:>7} -> {:<7} files {:>6} -> {:<6} partitions {:>10.1f} -> {:<10.1f} MB".format(
+        name, before['files'], after['files'], before['partitions'], after['partitions'],
+        before['bytes'] / 2 ** 20, after['bytes'] / 2 ** 20))
+
+
+def parse_partition(value):
+    return [column.strip() for column in value.split(',') if column.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact the parquet tables of the lake into fewer, larger '
+                                                 'files sorted on the columns their queries filter on.')
+    parser.add_argument('--output', default='./temp/', help='path holding the parquet tables of etl.py')
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    parser.add_argument('--target-file-mb', type=float, default=TARGET_FILE_MB,
+                        help='size aimed at for every parquet file')
+    parser.add_argument('--no-sort', action='store_true', help='keep the rows of a file in any order')
+    parser.add_argument('--songs-partition-by', type=parse_partition, default=None, metavar='COLUMNS',
+                        help='migrate songs_table to these comma separated partition columns, e.g. "year", '
+                             'or "" for none; the later writes of etl.py follow the new scheme')
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    for name in args.tables:
+        path = args.output + name
+        if not path_exists(spark, path):
+            print("{:<16} not written yet".format(name))
+            continue
+        partition_by = args.songs_partition_by if name == 'songs_table' else None
+        before, after = compact_table(spark, path, [] if args.no_sort else TABLES[name], partition_by,
+                                      args.target_file_mb)
+        print_report(name, before, after)
+
+
+if __name__ == "__main__":
+    main()
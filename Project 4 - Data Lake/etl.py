@@ -1,9 +1,17 @@
 import configparser
-from datetime import datetime
+import argparse
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format, dayofweek
+from contextlib import nullcontext
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import col, lit, rand, array, explode, desc, row_number, spark_partition_id
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType
+
+from incremental import (IngestManifest, list_files, path_exists, partition_columns, schema_conflicts,
+                         overwrite_partitions, merge_table)
+from bronze import BRONZE_DIR, ingest, write_sources, read_bronze
+from metrics import WriteMetrics
 
 
 config = configparser.ConfigParser()
@@ -12,16 +20,327 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
+# declared schemas of the raw JSON records, Spark does not have to scan the files to infer them
+SONG_SCHEMA = StructType([
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_name", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("num_songs", LongType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("year", LongType()),
+])
+
+LOG_SCHEMA = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", LongType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("status", LongType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType()),
+])
+
+
+# the join columns of the songplays, on the log side and on the song side
+LOG_MATCH_COLUMNS = ["song", "artist", "length"]
+SONG_MATCH_COLUMNS = ["title", "artist_name", "duration"]
+
+# a log event is identified by its time, user, session and position in the session, an incremental run
+# keeps one songplay per event
+SONGPLAY_KEYS = ["start_time", "userId", "sessionId", "itemInSession"]
+
+JOIN_STRATEGIES = ['BroadcastHashJoin', 'ShuffledHashJoin', 'SortMergeJoin', 'BroadcastNestedLoopJoin',
+                   'CartesianProduct']
+
+
+def create_spark_session(broadcast_threshold_mb=64, master=None):
+    """
+    Description: This function is used to create the SparkSession. Joins with a side smaller than
+    broadcast_threshold_mb are broadcast, and adaptive execution splits the skewed partitions of the
+    other joins at runtime.
 
-def create_spark_session():
-    spark = SparkSession \
-        .builder \
+    Parameters:
+        broadcast_threshold_mb: size under which a join side is broadcast, -1 disables broadcasting.
+        master: master URL such as local[4], the one of spark-submit when None.
+
+    Returns:
+        SparkSession
+    """
+    threshold = -1 if broadcast_threshold_mb < 0 else int(broadcast_threshold_mb * 1024 * 1024)
+    builder = SparkSession.builder
+    if master:
+        builder = builder.master(master)
+    spark = builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .config("spark.sql.autoBroadcastJoinThreshold", str(threshold)) \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def add_time_columns(df):
+    """
+    Description: This function is used to derive, once, the start_time of the log events and the year
+    and month shared by the time and songplays tables. ts holds epoch milliseconds, the division and the
+    cast run as native Spark expressions (no Python UDF), and the session time zone is UTC.
+
+    Parameters:
+        df: DataFrame of log events with the ts column.
+
+    Returns:
+        DataFrame with the start_time (timestamp), year and month columns added.
+    """
+    return df.withColumn("start_time", (col("ts") / 1000).cast("timestamp")) \
+        .withColumn("year", year("start_time")) \
+        .withColumn("month", month("start_time"))
+
+
+def build_users_table(df):
+    """
+    Description: This function is used to keep one row per user, the one of its latest event, so a user
+    who moved within the loaded files is written once with the last location, and an incremental run
+    merging on userId replaces the row with the latest one.
+
+    Parameters:
+        df: DataFrame of NextSong log events.
+
+    Returns:
+        DataFrame with the columns of the users table.
+    """
+    latest = Window.partitionBy("userId").orderBy(desc("ts"))
+    return df.withColumn("_event_rank", row_number().over(latest)) \
+        .filter(col("_event_rank") == 1) \
+        .select(["userId", "firstName", 'lastName', 'location', 'gender'])
+
+
+def build_time_table(df):
+    """
+    Description: This function is used to break the distinct start times of the songplays down into
+    the columns of the time table.
+
+    Parameters:
+        df: DataFrame returned by add_time_columns.
+
+    Returns:
+        DataFrame with start_time, hour, day, week, month, year and weekday.
+    """
+    return df.select("start_time", "year", "month").dropDuplicates() \
+        .withColumn("hour", hour("start_time")) \
+        .withColumn("day", dayofmonth("start_time")) \
+        .withColumn("week", weekofyear("start_time")) \
+        .withColumn("weekday", dayofweek("start_time")) \
+        .select(["start_time", "hour", "day", "week", "month", "year", "weekday"])
+
+
+def read_song_data(spark, input_data, files=None, output_data=None):
+    """
+    Description: This function is used to read the song data once, with its declared schema, and to
+    persist it for the songs, artists and songplays stages. The parquet bronze layer of output_data is
+    read instead of the JSON when it exists.
+
+    Parameters:
+        spark: the SparkSession.
+        input_data: path to the bucket containing song-data.
+        files: song files to read, all of them when None.
+        output_data: path of the lake holding the bronze layer, the JSON is read when None.
+
+    Returns:
+        persisted DataFrame of the song records.
+    """
+    df = read_bronze(spark, output_data, 'song_data', SONG_SCHEMA, files) if output_data else None
+    if df is None:
+        song_data = files if files is not None else input_data + 'song-data/*/*/*/*.json'
+        df = spark.read.json(song_data, schema=SONG_SCHEMA)
+    return df.persist(StorageLevel.MEMORY_AND_DISK)
+
+
+def read_log_data(spark, input_data, files=None, output_data=None):
+    """
+    Description: This function is used to read the log data with its declared schema, from the parquet
+    bronze layer of output_data when it exists.
+
+    Parameters:
+        spark: the SparkSession.
+        input_data: path to the bucket containing log-data.
+        files: log files to read, all of them when None.
+        output_data: path of the lake holding the bronze layer, the JSON is read when None.
+
+    Returns:
+        DataFrame of the log events.
+    """
+    df = read_bronze(spark, output_data, 'log_data', LOG_SCHEMA, files) if output_data else None
+    if df is None:
+        # log_data = input_data + 'log-data/*/*/*.json'
+        log_data = files if files is not None else input_data + 'log-data/*.json'
+        df = spark.read.json(log_data, schema=LOG_SCHEMA)
+    return df
+
+
+def ingest_bronze(spark, input_data, output_data):
+    """
+    Description: This function is used to convert the song and log JSON files not converted yet into the
+    bronze layer of the lake, date partitioned parquet tables keeping the file of every record, and to
+    rewrite the sources table listing the files behind every partition.
+
+    Parameters:
+        spark: the SparkSession.
+        input_data: path holding song-data and log-data.
+        output_data: path of the lake.
+
+    Returns:
+        None
+    """
+    song_files = ingest(spark, input_data, output_data, 'song_data', SONG_SCHEMA)
+    log_files = ingest(spark, input_data, output_data, 'log_data', LOG_SCHEMA)
+    print('Bronze layer: {} song files and {} log files converted'.format(len(song_files), len(log_files)))
+    if song_files or log_files:
+        write_sources(spark, output_data)
+
+
+def read_song_tables(spark, output_data):
+    """
+    Description: This function is used to rebuild the columns of the song data needed by the songplays
+    join from the songs_table and artists_table already written, instead of the raw JSON.
+
+    Parameters:
+        spark: the SparkSession.
+        output_data: path to the bucket holding songs_table and artists_table.
+
+    Returns:
+        persisted DataFrame with the song and artist columns of the song records.
+    """
+    songs = spark.read.parquet(output_data + 'songs_table').dropDuplicates(["song_id"])
+    artists = spark.read.parquet(output_data + 'artists_table').dropDuplicates(["artist_id"])
+    return songs.join(artists, "artist_id") \
+        .select(["song_id", "title", "artist_id", "artist_name", "artist_location", "duration", "year"]) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
+
+
+def join_songplays(df, song_df, salt=0):
+    """
+    Description: This function is used to match the song plays to their song. The song side is
+    projected down to the match columns and the ids, small enough to be broadcast for most catalogues.
+    With salt > 1 every song is replicated salt times and every play gets a random salt, so the plays
+    of a popular song are spread over salt partitions when the join is shuffled.
+
+    Parameters:
+        df: DataFrame returned by add_time_columns.
+        song_df: song data with the match columns, song_id and artist_id.
+        salt: number of salt values, 0 or 1 to join without salting.
+
+    Returns:
+        DataFrame with the columns of the songplays table.
+    """
+    songs = song_df.select(SONG_MATCH_COLUMNS + ["song_id", "artist_id"]).dropDuplicates()
+    plays = df.filter(col("song").isNotNull())
+    if salt > 1:
+        songs = songs.withColumn("salt", explode(array(*[lit(i) for i in range(salt)])))
+        plays = plays.withColumn("salt", (rand() * salt).cast("int"))
+    keys = [plays[log] == songs[song] for log, song in zip(LOG_MATCH_COLUMNS, SONG_MATCH_COLUMNS)]
+    if salt > 1:
+        keys.append(plays.salt == songs.salt)
+    return plays.join(songs, keys) \
+        .select(plays.start_time, plays.userId, plays.level, songs.song_id, songs.artist_id, plays.sessionId,
+                plays.itemInSession, plays.location, plays.userAgent, plays.year, plays.month)
+
+
+def join_strategy(df):
+    """
+    Description: This function is used to find the join algorithm planned for a DataFrame. With adaptive
+    execution a SortMergeJoin may still become a broadcast once the real sizes are known.
+
+    Returns:
+        name of the first join operator of the physical plan, or None.
+    """
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    found = [(plan.find(name), name) for name in JOIN_STRATEGIES if name in plan]
+    return min(found)[1] if found else None
+
+
+def join_key_report(df, partitions, top=5):
+    """
+    Description: This function is used to measure how the plays would spread over the partitions of a
+    shuffled join on the match columns, and which keys weigh the most.
+
+    Parameters:
+        df: DataFrame of song plays.
+        partitions: number of shuffle partitions.
+        top: number of heaviest keys reported.
+
+    Returns:
+        dict with the rows of the smallest, median and largest partition and the heaviest keys.
+    """
+    df = df.filter(col("song").isNotNull())
+    sizes = sorted(row[1] for row in df.repartition(partitions, *LOG_MATCH_COLUMNS)
+                   .groupBy(spark_partition_id()).count().collect())
+    sizes = [0] * (partitions - len(sizes)) + sizes
+    heaviest = df.groupBy(LOG_MATCH_COLUMNS).count().orderBy(desc("count")).limit(top).collect()
+    median = sizes[len(sizes) // 2]
+    return {'partitions': partitions, 'min_rows': sizes[0], 'median_rows': median, 'max_rows': sizes[-1],
+            'max_to_median': round(sizes[-1] / median, 2) if median else None,
+            'top_keys': [(row['song'], row['artist'], row['length'], row['count']) for row in heaviest]}
+
+
+def write_table(spark, df, output_data, name, partition_by=(), keys=None, incremental=False, metrics=None):
+    """
+    Description: This function is used to write an output table. A full run appends to it. An incremental
+    run merges into it: the touched partitions of a partitioned table are rewritten with dynamic partition
+    overwrite, an unpartitioned table is merged on its keys, so running the same files again changes nothing.
+    A table written with other columns or column types, by an older version of etl.py, is refused.
+
+    Parameters:
+        spark: the SparkSession.
+        df: rows to write.
+        output_data: path receiving the parquet tables.
+        name: name of the table.
+        partition_by: partition columns of a new table, an existing table keeps its own.
+        keys: columns identifying a row, all the columns when None.
+        incremental: merge instead of appending.
+        metrics: WriteMetrics recording the write, if any.
+
+    Returns:
+        None
+    """
+    path = output_data + name
+    with metrics.measure(name, path) if metrics else nullcontext():
+        if path_exists(spark, path):
+            # a table migrated to another partition scheme by compact.py keeps it
+            partition_by = partition_columns(spark, path)
+            # e.g. start_time, epoch milliseconds before it became a timestamp: appended files with another
+            # schema would leave the table unreadable without mergeSchema
+            conflicts = schema_conflicts(spark, df, path, partition_by)
+            if conflicts:
+                raise ValueError("{} was written with another schema ({}), rewrite it with a full run into an "
+                                 "empty output".format(path, "; ".join(conflicts)))
+        if incremental and partition_by:
+            overwrite_partitions(spark, df, path, partition_by, keys)
+        elif incremental:
+            merge_table(spark, df, path, keys or df.columns)
+        elif partition_by:
+            df.repartition(*partition_by).write.mode("append").partitionBy(*partition_by).parquet(path)
+        else:
+            df.write.save(path, format='parquet', mode='append')
+
+
+def process_song_data(spark, input_data, output_data, song_df=None, incremental=False, metrics=None):
   
     """
     Description: This function is used to read the song data in the filepath (bucket/song_data)
@@ -32,34 +351,37 @@ def process_song_data(spark, input_data, output_data):
         spark: the cursor object.
         input_path: path to bucket that contains song data.
         output_path: path to destination bucket where the parquet files are saved.
+        song_df: song data already read by read_song_data, read here when None.
+        incremental: merge into the tables instead of appending, see write_table.
+        metrics: WriteMetrics recording the writes, if any.
 
     Returns:
         None
     """  
     print('Begin processing songs data')
-    # get filepath to song data file
-    song_data = input_data + 'song-data/*/*/*/*.json'
-    
-    # read song data file
-    df = spark.read.json(song_data)
+    # read song data file, unless it was read already
+    df = song_df if song_df is not None else read_song_data(spark, input_data, output_data=output_data)
 
     # extract columns to create songs table
     songs_table = df.select(["song_id", "title", "artist_id", "duration", "year"]).dropDuplicates()
     
     print('Save songs table')
     # write songs table to parquet files partitioned by year and artist
-    songs_table.repartition("year", "artist_id").write.mode("append").partitionBy("year", "artist_id").parquet(output_data+'songs_table')
+    write_table(spark, songs_table, output_data, 'songs_table', ["year", "artist_id"], ["song_id"], incremental,
+                metrics)
     
     # extract columns to create artists table
     artists_table = df.select(["artist_id", "artist_name", "artist_location", 'artist_latitude' ,'artist_longitude']).dropDuplicates()
     
     print('Save artists table')
     # write artists table to parquet files
-    artists_table.write.save(output_data+'artists_table', format='parquet', mode='append')
+    write_table(spark, artists_table, output_data, 'artists_table', keys=["artist_id"], incremental=incremental,
+                metrics=metrics)
     print('Completed')
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, song_df=None, salt=0, join_report=False, incremental=False,
+                     files=None, metrics=None):
     
     """
     Description: This function is used to read the log data in the
@@ -70,77 +392,169 @@ def process_log_data(spark, input_data, output_data):
         spark: the cursor object.
         input_path: path to the bucket containing song data.
         output_path: path to destination bucket where  parquet files will be saved.
+        song_df: song data already read by read_song_data or read_song_tables, read here when None.
+        salt: number of salt values of the songplays join, see join_songplays.
+        join_report: print how the plays spread over the partitions of a shuffled join.
+        incremental: merge into the tables instead of appending, see write_table.
+        files: log files to read, all of them when None.
+        metrics: WriteMetrics recording the writes, if any.
 
     Returns:
         None
     """  
     print('Begin processing log data')
     
-    # get filepath to log data file
-    # log_data = input_data + 'log-data/*/*/*.json'
-    log_data = input_data + 'log-data/*.json'
-
-    # read log data file
-    df = spark.read.json(log_data)
+    # read log data file, from the bronze layer when it exists
+    df = read_log_data(spark, input_data, files, output_data)
     
     # filter by actions for song plays
     df = df.filter(df.page == 'NextSong')
 
     # extract columns for users table    
-    users_table = df.select(["userId", "firstName", 'lastName', 'location', 'gender']).dropDuplicates()
+    users_table = build_users_table(df)
     
     print('Save users table')
     # write users table to parquet files
-    users_table.write.save(output_data+'users_table', format='parquet', mode='append')
+    write_table(spark, users_table, output_data, 'users_table', keys=["userId"], incremental=incremental,
+                metrics=metrics)
 
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: x / 1000.0 )
-    df = df.withColumn("timestamp", get_timestamp("ts"))
-    
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: datetime.utcfromtimestamp(x).strftime('%Y-%m-%d %H:%M:%S'))
-    df = df.withColumn("date_sp", get_datetime("timestamp"))
+    # start_time, year and month computed once for the time and songplays tables
+    df = add_time_columns(df)
     
     # extract columns to create time table
-    time_table = df.withColumn("hour", hour(df.date_sp)) \
-    .withColumn("year", year(df.date_sp)) \
-    .withColumn("day", dayofmonth(df.date_sp)) \
-    .withColumn("week", weekofyear(df.date_sp)) \
-    .withColumn("month", month(df.date_sp)) \
-    .withColumn("weekday", dayofweek(df.date_sp)) \
-    .withColumnRenamed('ts', 'start_time') \
-    .select(['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']) \
-    .dropDuplicates()
+    time_table = build_time_table(df)
     
     print('Save time table')
     # write time table to parquet files partitioned by year and month
-    time_table.repartition("year", "month").write.mode("append").partitionBy("year", "month").parquet(output_data+'time_table')
+    write_table(spark, time_table, output_data, 'time_table', ["year", "month"], ["start_time"], incremental,
+                metrics)
     
-    # read in song data to use for songplays table
-    song_df = spark.read.json(input_data + 'song-data/*/*/*/*.json')
+    # song data to use for songplays table, read once and shared with process_song_data
+    if song_df is None:
+        song_df = read_song_data(spark, input_data, output_data=output_data)
 
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = df.join(song_df, [df.song == song_df.title, df.length == song_df.duration, df.artist == song_df.artist_name]) \
-    .select(df.ts, df.userId, df.level, song_df.song_id, song_df.artist_id, df.sessionId, df.location, df.userAgent, df.date_sp) \
-    .withColumn("year", year(df.date_sp)) \
-    .withColumn("month", month(df.date_sp))
+    songplays_table = join_songplays(df, song_df, salt)
+    print('Songplays join: {}{}'.format(join_strategy(songplays_table), ', salt {}'.format(salt) if salt > 1 else ''))
+    if join_report:
+        report = join_key_report(df, int(spark.conf.get("spark.sql.shuffle.partitions")))
+        print('Plays per partition of a shuffled join: min {min_rows}, median {median_rows}, max {max_rows} '
+              '({max_to_median}x the median)'.format(**report))
+        for song, artist, length, count in report['top_keys']:
+            print('    {} plays of {} - {} ({})'.format(count, artist, song, length))
 
     print('Save songplays table - Fact Table')
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.repartition("year", "month").write.mode("append").partitionBy("year", "month").parquet(output_data+'songplays_table')
+    write_table(spark, songplays_table, output_data, 'songplays_table', ["year", "month"], SONGPLAY_KEYS,
+                incremental, metrics)
     print('Completed.')
 
 
-def main():
-    spark = create_spark_session()
+def run_incremental(spark, input_data, output_data, args, metrics=None):
+    """
+    Description: This function is used to load only the song and log files not loaded yet. The new songs
+    are merged first, the new plays are then matched against the whole songs_table and artists_table,
+    and the files are recorded in the manifest once every table is written.
+
+    Parameters:
+        spark: the SparkSession.
+        input_data: path holding song-data and log-data.
+        output_data: path receiving the parquet tables.
+        args: options of parse_args.
+        metrics: WriteMetrics recording the writes, if any.
+
+    Returns:
+        None
+    """
+    manifest = IngestManifest(spark, output_data)
+    song_files = manifest.new_files(list_files(spark, input_data + 'song-data/*/*/*/*.json'))
+    log_files = manifest.new_files(list_files(spark, input_data + 'log-data/*.json'))
+    print('{} new song files, {} new log files'.format(len(song_files), len(log_files)))
+
+    if song_files:
+        song_df = read_song_data(spark, input_data, song_files, output_data)
+        process_song_data(spark, input_data, output_data, song_df, incremental=True, metrics=metrics)
+        song_df.unpersist()
+    if log_files:
+        song_df = read_song_tables(spark, output_data)
+        process_log_data(spark, input_data, output_data, song_df, args.salt, args.join_report,
+                         incremental=True, files=log_files, metrics=metrics)
+        song_df.unpersist()
+
+    manifest.record(song_files, 'song-data')
+    manifest.record(log_files, 'log-data')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load the song and log data into the parquet tables of the lake.')
     # When using S3 or other storage replace input and output data locations appropriately
     # input_data = "s3a://udacity-dend/"
+    parser.add_argument('--input', default='./data/', help='path holding song-data and log-data')
+    parser.add_argument('--output', default='./temp/', help='path receiving the parquet tables')
+    parser.add_argument('--reuse-song-tables', action='store_true',
+                        help='skip the song data and match the songplays against the songs_table and '
+                             'artists_table already written')
+    parser.add_argument('--broadcast-threshold-mb', type=float, default=64,
+                        help='the song side of the songplays join is broadcast under this size, -1 never')
+    parser.add_argument('--salt', type=int, default=0,
+                        help='spread each song of the songplays join over this many partitions, for '
+                             'catalogues too large to broadcast and Spark versions without adaptive skew joins')
+    parser.add_argument('--join-report', action='store_true',
+                        help='print the plays per partition of a shuffled songplays join and the heaviest keys')
+    parser.add_argument('--bronze', action='store_true',
+                        help='convert the new JSON files to the parquet bronze layer of the output and read the '
+                             'records from it; once the layer exists every run does')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only load the input files missing from the ingested_files manifest of the output '
+                             'and merge them into the tables instead of appending')
+    parser.add_argument('--metrics', default='etl_metrics.json', metavar='FILE',
+                        help='JSON file receiving the rows, bytes, files, task time, shuffle and spill of every '
+                             'table write, "" to skip collecting them')
+    return parser.parse_args(argv)
+
+
+def run(spark, args, metrics=None):
+    """
+    Description: This function is used to run the stages chosen by the options of parse_args.
+
+    Parameters:
+        spark: the SparkSession.
+        args: options of parse_args.
+        metrics: WriteMetrics recording the table writes, if any.
+
+    Returns:
+        None
+    """
+    input_data = args.input
+    output_data = args.output
     
-    input_data = "./data/"
-    output_data = "./temp/"
-    
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    if args.bronze or path_exists(spark, output_data + BRONZE_DIR):
+        ingest_bronze(spark, input_data, output_data)
+
+    if args.incremental:
+        run_incremental(spark, input_data, output_data, args, metrics)
+        return
+
+    if args.reuse_song_tables:
+        song_df = read_song_tables(spark, output_data)
+    else:
+        song_df = read_song_data(spark, input_data, output_data=output_data)
+        process_song_data(spark, input_data, output_data, song_df, metrics=metrics)    
+    process_log_data(spark, input_data, output_data, song_df, args.salt, args.join_report, metrics=metrics)
+    song_df.unpersist()
+
+
+def main():
+    args = parse_args()
+    spark = create_spark_session(args.broadcast_threshold_mb)
+    metrics = WriteMetrics(spark) if args.metrics else None
+    try:
+        run(spark, args, metrics)
+    finally:
+        # written for failed runs too, with the writes done until the failure
+        if metrics:
+            metrics.write(args.metrics)
+            print('Write metrics saved to {}'.format(args.metrics))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+from pyspark.sql import Window
+from pyspark.sql.functions import broadcast, col, desc, lit, row_number
+
+# table of the output receiving the input files already loaded by an incremental run
+MANIFEST_TABLE = 'ingested_files'
+
+# suffix of the job group of the staging copy of a merge, see staging_jobs
+STAGING_JOB_GROUP = '-staging'
+
+
+def hadoop_path(spark, path):
+    """
+    Description: This function is used to get a Hadoop Path and its FileSystem, local or S3 alike.
+
+    Returns:
+        (Path, FileSystem) JVM objects.
+    """
+    jvm_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return jvm_path, jvm_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+
+
+def list_files(spark, pattern):
+    """
+    Description: This function is used to list the files matching a glob pattern without reading them.
+
+    Parameters:
+        spark: the SparkSession.
+        pattern: glob pattern such as input_data + 'log-data/*.json'.
+
+    Returns:
+        sorted list of the fully qualified paths.
+    """
+    jvm_path, fs = hadoop_path(spark, pattern)
+    statuses = fs.globStatus(jvm_path) or []
+    return sorted(status.getPath().toString() for status in statuses if status.isFile())
+
+
+def path_exists(spark, path):
+    jvm_path, fs = hadoop_path(spark, path)
+    return fs.exists(jvm_path)
+
+
+def delete_path(spark, path):
+    jvm_path, fs = hadoop_path(spark, path)
+    fs.delete(jvm_path, True)
+
+
+def rename_path(spark, source, target):
+    jvm_source, fs = hadoop_path(spark, source)
+    jvm_target, _ = hadoop_path(spark, target)
+    fs.delete(jvm_target, True)
+    if not fs.rename(jvm_source, jvm_target):
+        raise IOError("Could not rename {} to {}".format(source, target))
+
+
+def partition_columns(spark, path):
+    """
+    Description: This function is used to find the partition columns of a table already written, from
+    the column=value directories below it, so the writes keep following a table migrated by compact.py.
+
+    Returns:
+        list of the partition columns, empty for an unpartitioned table.
+    """
+    jvm_path, fs = hadoop_path(spark, path)
+    columns = []
+    while True:
+        directories = [status.getPath() for status in fs.listStatus(jvm_path)
+                       if status.isDirectory() and '=' in status.getPath().getName()]
+        if not directories:
+            return columns
+        columns.append(directories[0].getName().split('=', 1)[0])
+        jvm_path = directories[0]
+
+
+def schema_conflicts(spark, df, path, partition_by=()):
+    """
+    Description: This function is used to compare the rows about to be written with the table already
+    written, leaving the partition columns out: their types are inferred from the directory names.
+
+    Returns:
+        list of the conflicting columns, e.g. "start_time: bigint in the table, timestamp in the new rows".
+    """
+    table = {field.name: field.dataType.simpleString() for field in spark.read.parquet(path).schema.fields
+             if field.name not in partition_by}
+    rows = {field.name: field.dataType.simpleString() for field in df.schema.fields if field.name not in partition_by}
+    conflicts = []
+    for name in sorted(set(table) | set(rows)):
+        if table.get(name) != rows.get(name):
+            conflicts.append("{}: {} in the table, {} in the new rows".format(
+                name, table.get(name, 'missing'), rows.get(name, 'missing')))
+    return conflicts
+
+
+def table_files(spark, path):
+    """
+    Description: This function is used to measure the parquet files of a table.
+
+    Parameters:
+        spark: the SparkSession.
+        path: path of the table.
+
+    Returns:
+        dict with the files, bytes and partitions (directories holding files) of the table.
+    """
+    jvm_path, fs = hadoop_path(spark, path)
+    files, size, directories = 0, 0, set()
+    iterator = fs.listFiles(jvm_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        if status.getPath().getName().endswith('.parquet'):
+            files += 1
+            size += status.getLen()
+            directories.add(status.getPath().getParent().toString())
+    return {'files': files, 'bytes': size, 'partitions': len(directories)}
+
+
+class IngestManifest:
+    """
+    Description: Input files already loaded into the output tables, kept in the ingested_files parquet
+    table of the output. The files of a run are only recorded once all its tables are written, a failed
+    run is simply started again and the merges below make the second attempt idempotent.
+    """
+
+    def __init__(self, spark, output_data):
+        self.spark = spark
+        self.path = output_data + MANIFEST_TABLE
+        self.files = set()
+        if path_exists(spark, self.path):
+            self.files = {row.path for row in spark.read.parquet(self.path).select("path").collect()}
+
+    def new_files(self, files):
+        """
+        Description: This function is used to keep the files not loaded yet.
+
+        Returns:
+            sorted list of the new files.
+        """
+        return sorted(set(files) - self.files)
+
+    def record(self, files, dataset):
+        """
+        Description: This function is used to add the files of a run to the manifest.
+
+        Parameters:
+            files: paths returned by new_files.
+            dataset: song-data or log-data.
+        """
+        if not files:
+            return
+        ingested_at = datetime.utcnow()
+        rows = [(path, dataset, ingested_at) for path in files]
+        self.spark.createDataFrame(rows, "path string, dataset string, ingested_at timestamp") \
+            .coalesce(1).write.mode("append").parquet(self.path)
+        self.files.update(files)
+
+
+@contextmanager
+def staging_jobs(spark):
+    """
+    Description: This function is used to run the jobs of the with block under the current job group
+    followed by STAGING_JOB_GROUP, so WriteMetrics can tell the staging copy from the final write.
+    """
+    sc = spark.sparkContext
+    group = sc.getLocalProperty('spark.jobGroup.id')
+    if group is None:
+        yield
+        return
+    description = sc.getLocalProperty('spark.job.description') or ''
+    sc.setJobGroup(group + STAGING_JOB_GROUP, description + ' (staging)')
+    try:
+        yield
+    finally:
+        sc.setJobGroup(group, description)
+
+
+def replace_via_staging(spark, df, path, partition_by=()):
+    """
+    Description: This function is used to overwrite a table with rows read from that same table. The
+    rows are written to path_staging first, then copied over the table, so no file is deleted while it
+    is still being read. With partition_by only the partitions present in df are replaced (dynamic
+    partition overwrite), the others are left untouched.
+    """
+    staging = path.rstrip('/') + '_staging'
+    writer = (df.repartition(*partition_by) if partition_by else df).write.mode("overwrite")
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    with staging_jobs(spark):
+        writer.parquet(staging)
+
+    staged = spark.read.parquet(staging)
+    writer = (staged.repartition(*partition_by) if partition_by else staged).write.mode("overwrite")
+    if partition_by:
+        writer = writer.option("partitionOverwriteMode", "dynamic").partitionBy(*partition_by)
+    writer.parquet(path)
+    delete_path(spark, staging)
+
+
+def overwrite_partitions(spark, df, path, partition_by, keys=None):
+    """
+    Description: This function is used to merge new rows into the partitions they fall in. The existing
+    rows of the touched partitions are read back, deduplicated with the new ones on keys (all the
+    columns when None) and the touched partitions alone are rewritten.
+
+    Parameters:
+        spark: the SparkSession.
+        df: new rows, with the partition columns.
+        path: path of the partitioned table.
+        partition_by: partition columns, e.g. ["year", "month"].
+        keys: columns identifying a row.
+
+    Returns:
+        number of partitions rewritten.
+    """
+    partition_by = list(partition_by)
+    touched = df.select(partition_by).distinct().cache()
+    merged = df
+    if path_exists(spark, path):
+        existing = spark.read.parquet(path).join(broadcast(touched), partition_by, "left_semi")
+        missing = [key for key in keys or () if key not in existing.columns]
+        if missing:
+            raise ValueError("{} has no column {}, write it again with a full run".format(path, ", ".join(missing)))
+        merged = existing.unionByName(df.select(existing.columns))
+    merged = merged.dropDuplicates(keys) if keys else merged.dropDuplicates()
+    replace_via_staging(spark, merged, path, partition_by)
+    count = touched.count()
+    touched.unpersist()
+    return count
+
+
+def merge_table(spark, df, path, keys):
+    """
+    Description: This function is used to merge new rows into an unpartitioned table on its keys, the
+    new row replacing the existing one of the same key.
+
+    Parameters:
+        spark: the SparkSession.
+        df: new rows.
+        path: path of the table.
+        keys: columns identifying a row.
+
+    Returns:
+        None
+    """
+    merged = df.withColumn("_merge_order", lit(1))
+    if path_exists(spark, path):
+        existing = spark.read.parquet(path)
+        merged = existing.withColumn("_merge_order", lit(0)) \
+            .unionByName(merged.select(existing.columns + ["_merge_order"]))
+    latest = Window.partitionBy(*keys).orderBy(desc("_merge_order"))
+    merged = merged.withColumn("_merge_rank", row_number().over(latest)) \
+        .filter(col("_merge_rank") == 1) \
+        .drop("_merge_order", "_merge_rank")
+    replace_via_staging(spark, merged, path)
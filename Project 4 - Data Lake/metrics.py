@@ -0,0 +1,157 @@
+import json
+import time
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+
+from incremental import path_exists, table_files, STAGING_JOB_GROUP
+
+# task metrics of the stages summed for every table write, as named by the monitoring REST API. The
+# output of the staging copy of a merge (STAGING_JOB_GROUP) is left out, it is written once more over the table.
+OUTPUT_METRICS = {'outputRecords': 'rows_written',
+                  'outputBytes': 'bytes_written'}
+STAGE_METRICS = {'inputBytes': 'input_bytes',
+                 'executorRunTime': 'task_ms',
+                 'executorCpuTime': 'task_cpu_ns',
+                 'shuffleReadBytes': 'shuffle_read_bytes',
+                 'shuffleWriteBytes': 'shuffle_write_bytes',
+                 'memoryBytesSpilled': 'spill_memory_bytes',
+                 'diskBytesSpilled': 'spill_disk_bytes'}
+
+# the REST API is fed by the listener bus, a stage may show up there a moment after its job returned
+REST_WAIT_SECONDS = 5
+
+
+class WriteMetrics:
+    """
+    Description: Metrics of every table write of a run. Each write runs under its own job group, its
+    stages are found with the status tracker and their task metrics summed from the monitoring REST API
+    of the Spark UI. Without the UI only the tasks, files, rows and seconds are recorded. rows is the
+    change in the rows of the table, rows_written the rows of the files written: a merge rewrites every
+    row of the partitions it touches.
+    """
+
+    def __init__(self, spark):
+        self.spark = spark
+        self.sc = spark.sparkContext
+        self.started_at = datetime.utcnow()
+        self.tables = []
+
+    @contextmanager
+    def measure(self, name, path):
+        """
+        Description: This function is used to record the write of a table done in the with block.
+
+        Parameters:
+            name: name of the table.
+            path: path of the table, to count its files before and after.
+        """
+        group = 'write-{}-{}'.format(len(self.tables), name)
+        before = self.table_state(path)
+        self.sc.setJobGroup(group, 'write ' + name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.sc.setLocalProperty('spark.jobGroup.id', None)
+            self.sc.setLocalProperty('spark.job.description', None)
+            after = self.table_state(path)
+            record = {'table': name, 'seconds': round(seconds, 3), 'rows': after['rows'] - before['rows'],
+                      'files_added': after['files'] - before['files'], 'table_rows': after['rows'],
+                      'table_files': after['files'], 'table_bytes': after['bytes']}
+            record.update(self.stage_metrics(group))
+            self.tables.append(record)
+
+    def table_state(self, path):
+        """
+        Description: This function is used to measure a table around a write, outside of its job group.
+
+        Returns:
+            dict with the rows, files and bytes of the table, zeros when it does not exist.
+        """
+        if not path_exists(self.spark, path):
+            return {'rows': 0, 'files': 0, 'bytes': 0}
+        state = table_files(self.spark, path)
+        state['rows'] = self.spark.read.parquet(path).count()
+        return state
+
+    def stage_ids(self, group):
+        tracker = self.sc.statusTracker()
+        jobs = [tracker.getJobInfo(job_id) for job_id in tracker.getJobIdsForGroup(group)]
+        return sorted({stage_id for job in jobs if job is not None for stage_id in job.stageIds})
+
+    def rest_stage(self, stage_id):
+        """
+        Description: This function is used to get the attempts of a stage from the REST API, once they
+        are no longer running.
+
+        Returns:
+            list of the stage attempts, None without UI.
+        """
+        if not self.sc.uiWebUrl:
+            return None
+        url = '{}/api/v1/applications/{}/stages/{}'.format(self.sc.uiWebUrl, self.sc.applicationId, stage_id)
+        deadline = time.time() + REST_WAIT_SECONDS
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    attempts = json.loads(response.read().decode())
+            except OSError:
+                attempts = []
+            if attempts and all(a['status'] not in ('ACTIVE', 'PENDING') for a in attempts) \
+                    or time.time() > deadline:
+                return attempts
+            time.sleep(0.2)
+
+    def stage_metrics(self, group):
+        """
+        Description: This function is used to sum the task metrics of the stages of a job group.
+
+        Returns:
+            dict with the stages, tasks, STAGE_METRICS and OUTPUT_METRICS, without the metrics of the REST API
+            when it is not reachable.
+        """
+        tracker = self.sc.statusTracker()
+        final_ids = self.stage_ids(group)
+        stage_ids = final_ids + self.stage_ids(group + STAGING_JOB_GROUP)
+        metrics = {'stages': len(stage_ids), 'tasks': 0}
+        for stage_id in stage_ids:
+            info = tracker.getStageInfo(stage_id)
+            metrics['tasks'] += info.numTasks if info is not None else 0
+        for stage_id in stage_ids:
+            attempts = self.rest_stage(stage_id)
+            if attempts is None:
+                break
+            fields = dict(STAGE_METRICS, **OUTPUT_METRICS) if stage_id in final_ids else STAGE_METRICS
+            for attempt in attempts:
+                for field, name in fields.items():
+                    metrics[name] = metrics.get(name, 0) + attempt.get(field, 0)
+        return metrics
+
+    def totals(self):
+        """
+        Description: This function is used to sum the metrics of all the writes of the run.
+        """
+        totals = {}
+        for record in self.tables:
+            for name, value in record.items():
+                if name not in ('table', 'table_rows', 'table_files', 'table_bytes'):
+                    totals[name] = round(totals.get(name, 0) + value, 3)
+        return totals
+
+    def report(self):
+        return {'app_id': self.sc.applicationId,
+                'master': self.sc.master,
+                'default_parallelism': self.sc.defaultParallelism,
+                'spark': self.sc.version,
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'tables': self.tables,
+                'totals': self.totals()}
+
+    def write(self, path):
+        """
+        Description: This function is used to write the metrics of the run as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
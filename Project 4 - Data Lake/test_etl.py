@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+from argparse import Namespace
+
+import pytest
+
+# the tests run Spark in local mode, which needs pyspark and a Java runtime
+pytest.importorskip('pyspark')
+if shutil.which('java') is None and not os.environ.get('JAVA_HOME'):
+    pytest.skip('no Java runtime for Spark', allow_module_level=True)
+
+from benchmark import bench_scaling, generate
+from etl import create_spark_session, parse_args, run
+from metrics import WriteMetrics
+
+TABLES = ['songs_table', 'artists_table', 'users_table', 'time_table', 'songplays_table']
+
+
+def table_rows(spark, output, table):
+    return spark.read.parquet(os.path.join(output, table)).count()
+
+
+def test_write_metrics_are_collected_through_the_rest_api(tmp_path):
+    data_dir, output = str(tmp_path / 'data'), str(tmp_path / 'lake')
+    generate(data_dir, songs=20, artists=10, users=5, days=2, events_per_day=200)
+    spark = create_spark_session(master='local[2]')
+    try:
+        assert spark.sparkContext.uiWebUrl, 'the metrics are read from the REST API of the Spark UI'
+        metrics = WriteMetrics(spark)
+        run(spark, parse_args(['--input', data_dir + '/', '--output', output + '/', '--metrics', '']), metrics)
+        report = metrics.report()
+        assert [record['table'] for record in report['tables']] == TABLES
+        for record in report['tables']:
+            # bytes, rows written and task time only come from the REST API
+            assert record['stages'] > 0 and record['tasks'] > 0, record
+            assert record['files_added'] > 0 and record['bytes_written'] > 0 and record['task_ms'] >= 0, record
+            # into an empty output every row written is a row added
+            assert record['rows'] == record['rows_written'] == table_rows(spark, output, record['table']), record
+        assert report['totals']['rows'] == sum(record['rows'] for record in report['tables'])
+
+        metrics.write(str(tmp_path / 'etl_metrics.json'))
+        with open(str(tmp_path / 'etl_metrics.json')) as f:
+            assert json.load(f) == json.loads(json.dumps(report))
+    finally:
+        spark.stop()
+
+
+def test_incremental_write_metrics_count_the_merge_once(tmp_path):
+    data_dir, output = str(tmp_path / 'data'), str(tmp_path / 'lake')
+    generate(data_dir, songs=20, artists=10, users=5, days=2, events_per_day=200)
+    later = os.path.join(data_dir, 'log-data', '2018-11-02-events.json')
+    os.rename(later, str(tmp_path / 'later.json'))
+    options = ['--input', data_dir + '/', '--output', output + '/', '--metrics', '', '--incremental']
+    spark = create_spark_session(master='local[2]')
+    try:
+        run(spark, parse_args(options))
+        before = table_rows(spark, output, 'songplays_table')
+        os.rename(str(tmp_path / 'later.json'), later)
+        metrics = WriteMetrics(spark)
+        run(spark, parse_args(options), metrics)
+        records = {record['table']: record for record in metrics.report()['tables']}
+        songplays = records['songplays_table']
+        after = table_rows(spark, output, 'songplays_table')
+        assert songplays['rows'] == after - before > 0, songplays
+        # both days fall in the 2018/11 partition, rewritten once: the _staging copy is not counted
+        assert songplays['rows_written'] == after, songplays
+        assert songplays['table_rows'] == after, songplays
+    finally:
+        spark.stop()
+
+
+def test_scaling_benchmark_on_one_core_count(tmp_path):
+    args = Namespace(songs=20, days=2, events_per_day=200, repeat=1)
+    results = bench_scaling(str(tmp_path), [1], [2], args)
+    assert len(results) == 1
+    result = results[0]
+    assert (result['benchmark'], result['scale'], result['cores'], result['events']) == ('etl_scaling', 1, 2, 400)
+    # the first number of cores of a scale is its own baseline
+    assert result['scaling_efficiency'] == 1.0
+    assert result['seconds'] > 0 and result['events_per_second'] > 0
+    assert result['rows'] > 0 and result['stages'] > 0